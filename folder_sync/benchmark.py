@@ -0,0 +1,366 @@
+"""
+Benchmark of sync_folders.py on synthetic trees of realistic shapes. Every scenario generates a folder1 tree in a work
+directory and syncs it with FolderSync into an empty folder2 (cold run), then again without changes (warm run, digest
+index and page cache warm); the mostly-unchanged scenario also mutates a small percentage of its files and syncs them
+(mutated run). Every run is done in a fresh process, which records:
+    - duration, files/s and MB/s (folder1 files and bytes per second of sync)
+    - read/write syscalls and bytes read/written from storage (/proc/self/io, Linux only)
+    - peak RSS of the process
+    - the sync metrics of FolderSync (bytes hashed and copied, phase times, ...)
+Results are saved as JSON together with the commit and the machine they were measured on, and could be compared with
+the results of another commit (--compare); a run slower than --threshold percent is reported as a regression and the
+script exits with status 1.
+
+Scenarios:
+    tiny       - many small files (0-4 KB) in a few hundred folders
+    large      - a few big files (2 GB each)
+    deep       - files in a chain of nested folders
+    wide       - a single folder with many files
+    unchanged  - a medium tree of which a small percentage is mutated between syncs (--mutate)
+--scale multiplies the number of files (and the size of the big files), e.g. --scale 0.01 for a quick check.
+
+usage = python benchmark.py [--scenarios SCENARIO [SCENARIO ...]] [--scale SCALE] [--mutate PERCENT]
+                            [--workdir WORKDIR] [--keep] [-c {hash,quick,sample}] [--hash ALGORITHM]
+                            [--workers WORKERS] [--drop-caches] [--output FILE] [--compare FILE]
+                            [--threshold PERCENT] [-h].
+help = python benchmark.py --help
+
+Examples:
+    -For a quick run of all scenarios, run:
+        python benchmark.py --scale 0.01
+    -For the small files scenarios of the current commit, compared with the results of the previous one, run:
+        python benchmark.py --scenarios tiny wide --output new.json --compare old.json
+"""
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import argparse
+import platform
+import tempfile
+import subprocess
+import contextlib
+import multiprocessing
+from datetime import datetime
+from concurrent.futures import ProcessPoolExecutor
+
+try:
+    import resource
+except ImportError:
+    # Windows: peak RSS is not available
+    resource = None
+
+BLOCK_SIZE = 1048576
+
+
+def write_file(path: str, size: int, rng: random.Random) -> None:
+    """
+    Writes size pseudo-random bytes to path. Big files repeat one random block, prefixed by the block number, so they
+    are generated at disk speed but no two blocks are equal.
+    :param path: file path
+    :param size: file size in bytes
+    :param rng: random generator of the scenario
+    :return: None
+    """
+    with open(path, 'wb') as file:
+        if size <= BLOCK_SIZE:
+            file.write(rng.randbytes(size))
+            return
+        block = rng.randbytes(BLOCK_SIZE)
+        for number, offset in enumerate(range(0, size, BLOCK_SIZE)):
+            prefix = number.to_bytes(8, "little")
+            file.write((prefix + block[len(prefix):])[:size - offset])
+
+
+def generate_tiny(root: str, scale: float, rng: random.Random) -> None:
+    for number in range(max(1, int(100000 * scale))):
+        folder = os.path.join(root, f"dir{number % 300:03}")
+        os.makedirs(folder, exist_ok=True)
+        write_file(os.path.join(folder, f"file{number:06}.txt"), rng.randint(0, 4096), rng)
+
+
+def generate_large(root: str, scale: float, rng: random.Random) -> None:
+    os.makedirs(root, exist_ok=True)
+    for number in range(3):
+        write_file(os.path.join(root, f"large{number}.bin"), max(BLOCK_SIZE, int(2 * 1024 ** 3 * scale)), rng)
+
+
+def generate_deep(root: str, scale: float, rng: random.Random) -> None:
+    folder = root
+    for depth in range(max(1, int(200 * scale))):
+        folder = os.path.join(folder, f"level{depth:03}")
+        os.makedirs(folder)
+        for number in range(25):
+            write_file(os.path.join(folder, f"file{number:02}.txt"), rng.randint(0, 16384), rng)
+
+
+def generate_wide(root: str, scale: float, rng: random.Random) -> None:
+    os.makedirs(root, exist_ok=True)
+    for number in range(max(1, int(50000 * scale))):
+        write_file(os.path.join(root, f"file{number:06}.dat"), rng.randint(0, 8192), rng)
+
+
+def generate_unchanged(root: str, scale: float, rng: random.Random) -> None:
+    for number in range(max(1, int(20000 * scale))):
+        folder = os.path.join(root, f"dir{number % 100:02}", f"sub{number % 7}")
+        os.makedirs(folder, exist_ok=True)
+        write_file(os.path.join(folder, f"file{number:05}.bin"), rng.choice((1024, 65536, 1048576, 4194304)), rng)
+
+
+def mutate(root: str, percent: float, rng: random.Random) -> int:
+    """
+    Rewrites percent of the files of root in place: same size, different content and a newer mtime.
+    :param root: folder1 of the scenario
+    :param percent: percentage of files to mutate
+    :param rng: random generator of the scenario
+    :return: number of mutated files
+    """
+    paths = sorted(os.path.join(dirpath, name) for dirpath, _, filenames in os.walk(root) for name in filenames)
+    mutated = rng.sample(paths, max(1, int(len(paths) * percent / 100)))
+    for path in mutated:
+        size = os.path.getsize(path)
+        length = min(size, 4096)
+        with open(path, 'r+b') as file:
+            # The written range ends within the file, so its size does not change
+            file.seek(rng.randrange(size - length + 1))
+            file.write(rng.randbytes(length))
+    return len(mutated)
+
+
+# Generator of every scenario and whether it also has a mutated run
+SCENARIOS = {
+    "tiny": (generate_tiny, False),
+    "large": (generate_large, False),
+    "deep": (generate_deep, False),
+    "wide": (generate_wide, False),
+    "unchanged": (generate_unchanged, True),
+}
+
+
+def tree_size(root: str) -> tuple:
+    """
+    :param root: folder path
+    :return: (number of files, total size in bytes) of root
+    """
+    files = size = 0
+    for dirpath, _, filenames in os.walk(root):
+        for name in filenames:
+            files += 1
+            size += os.path.getsize(os.path.join(dirpath, name))
+    return files, size
+
+
+def read_proc_io() -> dict:
+    """
+    :return: I/O counters of the current process (syscr, syscw, read_bytes, write_bytes, ...) or {} if not available
+    """
+    try:
+        with open("/proc/self/io") as file:
+            return {name: int(value) for name, value in (line.split(": ") for line in file)}
+    except OSError:
+        return {}
+
+
+def peak_rss() -> int | None:
+    """
+    :return: peak resident set size of the current process in bytes, or None if not available
+    """
+    if resource is None:
+        return None
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in bytes on macOS and in kilobytes on the other systems
+    return max_rss if sys.platform == "darwin" else max_rss * 1024
+
+
+def drop_caches() -> None:
+    """
+    Drops the page cache (Linux, root only), so the cold runs read from storage.
+    :return: None
+    """
+    os.sync()
+    try:
+        with open("/proc/sys/vm/drop_caches", 'w') as file:
+            file.write("3")
+    except OSError as exception:
+        print(f"[WARNING] Page cache could not be dropped: {exception}")
+
+
+def run_sync(scenario_dir: str, options: dict) -> dict:
+    """
+    Runs one sync of scenario_dir/folder1 to scenario_dir/folder2. Used in a fresh process for every run, so the
+    syscall counters and the peak RSS belong to that sync only.
+    :param scenario_dir: work directory of the scenario
+    :param options: FolderSync options (compare, hash, workers)
+    :return: measurements of the sync
+    """
+    import sync_folders
+
+    index = sync_folders.FileIndex(os.path.join(scenario_dir, "index.db"))
+    hash_engine = sync_folders.HashEngine(options["hash"])
+    folder_sync = sync_folders.FolderSync(os.path.join(scenario_dir, "folder1"), os.path.join(scenario_dir, "folder2"),
+                                          None, None, index, options["compare"], hash_engine,
+                                          workers=options["workers"])
+    io_before = read_proc_io()
+    start = time.perf_counter()
+    folder_sync._folder_sync()
+    duration = time.perf_counter() - start
+    io_after = read_proc_io()
+    index.close()
+    hash_engine.close()
+    return {"duration": duration,
+            "io": {name: io_after[name] - io_before.get(name, 0) for name in io_after},
+            "peak_rss": peak_rss(),
+            "metrics": folder_sync.metrics.report()}
+
+
+def measure(scenario_dir: str, run: str, options: dict) -> dict:
+    """
+    Runs run_sync in a fresh process and adds the throughput of the run to its measurements.
+    :param scenario_dir: work directory of the scenario
+    :param run: run name (cold, warm or mutated)
+    :param options: benchmark options
+    :return: measurements of the run
+    """
+    if options["drop_caches"] and run == "cold":
+        drop_caches()
+    with ProcessPoolExecutor(1, mp_context=multiprocessing.get_context("spawn")) as pool:
+        result = pool.submit(run_sync, scenario_dir, options).result()
+    files, size = tree_size(os.path.join(scenario_dir, "folder1"))
+    result.update(run=run, files=files, bytes=size,
+                  files_per_s=files / result["duration"], mb_per_s=size / 1048576 / result["duration"])
+    return result
+
+
+def run_scenario(name: str, options: dict) -> list:
+    """
+    Generates the tree of scenario name and measures its runs.
+    :param name: scenario name
+    :param options: benchmark options
+    :return: list of run measurements
+    """
+    generate, mutated = SCENARIOS[name]
+    scenario_dir = os.path.join(options["workdir"], name)
+    shutil.rmtree(scenario_dir, ignore_errors=True)
+    os.makedirs(scenario_dir)
+    rng = random.Random(name)
+    start = time.perf_counter()
+    generate(os.path.join(scenario_dir, "folder1"), options["scale"], rng)
+    print(f"[{name}] tree generated in {time.perf_counter() - start:.1f}s")
+
+    results = []
+    runs = ("cold", "warm", "mutated") if mutated else ("cold", "warm")
+    for run in runs:
+        if run == "mutated":
+            count = mutate(os.path.join(scenario_dir, "folder1"), options["mutate"], rng)
+            print(f"[{name}] {count} files mutated")
+        result = measure(scenario_dir, run, options)
+        result["scenario"] = name
+        results.append(result)
+        print(f"[{name}] {run:8} {result['duration']:9.3f}s {result['files_per_s']:11.1f} files/s "
+              f"{result['mb_per_s']:9.1f} MB/s  syscalls r/w {result['io'].get('syscr', '-')}/"
+              f"{result['io'].get('syscw', '-')}  peak RSS {(result['peak_rss'] or 0) / 1048576:.1f} MB")
+    if not options["keep"]:
+        shutil.rmtree(scenario_dir, ignore_errors=True)
+    return results
+
+
+def git_commit() -> str | None:
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, check=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare_results(old: dict, new: dict, threshold: float) -> bool:
+    """
+    Prints the duration, throughput, syscalls and peak RSS of every run of new next to the same run of old.
+    :param old: results of the reference commit
+    :param new: results of the current commit
+    :param threshold: a run slower by more than threshold percent is a regression
+    :return: True if a regression was found
+    """
+    old_runs = {(result["scenario"], result["run"]): result for result in old["results"]}
+    print(f"\nCompared with commit {old.get('commit')} ({old.get('date')}):")
+    print(f"{'scenario':10} {'run':8} {'duration (s)':>24} {'change':>8} {'files/s':>10} {'syscalls':>10} "
+          f"{'peak RSS':>9}")
+    regression = False
+    for result in new["results"]:
+        reference = old_runs.get((result["scenario"], result["run"]))
+        if reference is None:
+            continue
+        change = (result["duration"] / reference["duration"] - 1) * 100
+        syscalls = sum(result["io"].get(name, 0) for name in ("syscr", "syscw"))
+        old_syscalls = sum(reference["io"].get(name, 0) for name in ("syscr", "syscw"))
+        rss = (result["peak_rss"] or 0) / max(1, reference["peak_rss"] or 0)
+        marker = ""
+        if change > threshold:
+            marker, regression = "  REGRESSION", True
+        print(f"{result['scenario']:10} {result['run']:8} {reference['duration']:11.3f} -> {result['duration']:9.3f} "
+              f"{change:+7.1f}% {result['files_per_s'] / reference['files_per_s']:9.2f}x "
+              f"{syscalls - old_syscalls:+10} {rss:8.2f}x{marker}")
+    return regression
+
+
+def parse_arguments() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(
+        description="Benchmark of sync_folders.py on synthetic trees; every scenario is synced cold, then warm.",
+        formatter_class=argparse.RawTextHelpFormatter)
+    parser.add_argument("--scenarios", nargs="+", choices=SCENARIOS, default=list(SCENARIOS),
+                        help="Scenarios to run (default: all).")
+    parser.add_argument("--scale", type=float, default=1.0,
+                        help="Multiplier of the number of files and of the big file size (default: %(default)s).")
+    parser.add_argument("--mutate", type=float, default=1.0, metavar="PERCENT",
+                        help="Percentage of files mutated by the 'unchanged' scenario (default: %(default)s).")
+    parser.add_argument("--workdir", type=str,
+                        help="Folder where the trees are generated (default: a temporary folder).\n"
+                             "It should be on the storage which is benchmarked.")
+    parser.add_argument("--keep", action="store_true", help="Keep the generated trees.")
+    parser.add_argument("-c", "--compare-strategy", dest="strategy", choices=("hash", "quick", "sample"),
+                        default="hash", help="FolderSync change detection strategy (default: %(default)s).")
+    parser.add_argument("--hash", type=str, default="sha256",
+                        help="FolderSync hash algorithm (default: %(default)s).")
+    parser.add_argument("--workers", type=int, help="FolderSync worker threads (default: FolderSync default).")
+    parser.add_argument("--drop-caches", action="store_true",
+                        help="Linux, root only. Drop the page cache before every cold run.")
+    parser.add_argument("--output", type=str, default="benchmark_results.json",
+                        help="JSON file where the results are saved (default: %(default)s).")
+    parser.add_argument("--compare", type=str, metavar="FILE", dest="baseline",
+                        help="Results file of another commit, to compare the results with.")
+    parser.add_argument("--threshold", type=float, default=10.0, metavar="PERCENT",
+                        help="A run slower by more than PERCENT than in --compare results is a regression\n"
+                             "(default: %(default)s).")
+    return parser.parse_args()
+
+
+def main():
+    arguments = parse_arguments()
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    options = {"scale": arguments.scale, "mutate": arguments.mutate, "keep": arguments.keep,
+               "compare": arguments.strategy, "hash": arguments.hash, "workers": arguments.workers,
+               "drop_caches": arguments.drop_caches}
+    with contextlib.ExitStack() as stack:
+        options["workdir"] = arguments.workdir or stack.enter_context(tempfile.TemporaryDirectory())
+        results = []
+        for name in arguments.scenarios:
+            results += run_scenario(name, options)
+
+    output = {"commit": git_commit(), "date": datetime.now().isoformat(timespec="seconds"),
+              "machine": {"platform": platform.platform(), "python": platform.python_version(),
+                          "cpus": os.cpu_count()},
+              "options": {name: value for name, value in options.items() if name != "workdir"},
+              "results": results}
+    with open(arguments.output, 'w') as file:
+        json.dump(output, file, indent=2)
+    print(f"Results saved to [{arguments.output}]")
+
+    if arguments.baseline:
+        with open(arguments.baseline) as file:
+            if compare_results(json.load(file), output, arguments.threshold):
+                exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -2,55 +2,3770 @@
 The script synchronizes the contents of folder2 based on folder1, at a specified future time or at regular intervals.
 Once the script was started, the synchronization could also be manually triggered, on-demand, before scheduled time or
 between periodic intervals, at any time, by typing 'sync' in terminal. Type 'quit' in terminal to stop the script.
+The other commands (serve, daemon, snapshots, restore), the library API (sync()) and the features are documented in
+README.md.
 
-usage = python sync_folders.py <folder1> <folder2> [-s SECONDS] [-m MINUTES] [-hr HOURS] [-d DAYS] [-t TIME] [-h].
+usage = python sync_folders.py <folder1> <folder2> [<folder2> ...] [-s SECONDS] [-m MINUTES] [-hr HOURS] [-d DAYS]
+                               [-t TIME] [options] [-h].
 help = python sync_folders.py --help
 
 Examples:
-    -For Scheduled sync at 19:45, run:
+    -For Scheduled sync every day at 19:45, run:
         python sync_folders.py /path/to/folder1 /path/to/folder2 -t 19:45
     -For Periodic sync at every 3 hours 4 minutes and 5 seconds, run:
         python sync_folders.py /path/to/folder1 /path/to/folder2 -hr 3 -m 4 -s 5
 """
 
 import os
+import sys
+import stat
+import re
+import errno
+import bisect
+import heapq
+import queue
+import signal
+import struct
+import json
 import time
 import shutil
 import hashlib
+import hmac
 import logging
+import logging.handlers
 import argparse
 import threading
+from itertools import groupby, islice
+from contextlib import ExitStack, contextmanager
+from collections import Counter, deque, namedtuple
 from datetime import timedelta, datetime, date
-from concurrent.futures import ThreadPoolExecutor, as_completed
+from concurrent.futures import Future, ThreadPoolExecutor
 
+try:
+    import fcntl
+except ImportError:
+    # Windows: reflink copies are not available
+    fcntl = None
 
-def get_logger(filename) -> logging.Logger:
+try:
+    import resource
+except ImportError:
+    # Windows: the peak memory is not reported
+    resource = None
+
+
+# Level of the per-file events (copies, deletes, folders created and removed), logged only with --log-level files
+FILE_EVENT = 15
+
+
+class JsonFormatter(logging.Formatter):
+    """
+    Formats log records as compact JSON lines: {"time", "level", "message", "function"}, and "exception" if any.
+    """
+
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {"time": self.formatTime(record, self.datefmt), "level": record.levelname,
+                 "message": record.getMessage(), "function": record.funcName}
+        if record.exc_info:
+            entry["exception"] = self.formatException(record.exc_info)
+        return json.dumps(entry)
+
+
+class LogQueueHandler(logging.handlers.QueueHandler):
+    """
+    Puts the records in the queue of a LogWriter. Unlike QueueHandler, records are not formatted by the logging
+    thread: messages and exceptions are formatted by the writer thread.
+    """
+
+    def __init__(self, writer):
+        super().__init__(writer.queue)
+        self.writer = writer
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        return record
+
+    def close(self) -> None:
+        # Called by logging.shutdown() at exit: the queued records are written before the process ends
+        self.writer.stop()
+        super().close()
+
+
+class LogWriter:
+    """
+    Writes the log records on a background thread: the records queued since the last write are formatted and written
+    together, with a single write and flush. The log file is rotated when it exceeds max_bytes or every hour/day
+    (rotate), the rotated files being compressed to <filename>.1.gz (the newest) ... <filename>.<backups>.gz.
+    """
+    # Records formatted and written together, at most
+    BATCH_SIZE = 1000
+    ROTATE_SECONDS = {"hourly": 3600, "daily": 86400}
+
+    def __init__(self, filename: str, formatter: logging.Formatter, max_bytes: int = 0, rotate: str | None = None,
+                 backups: int = 5):
+        self.filename = os.path.abspath(filename)
+        self.formatter = formatter
+        self.max_bytes = max_bytes
+        self.rotate = rotate
+        self.backups = backups
+        self.queue = queue.SimpleQueue()
+        self.file = open(self.filename, 'a', encoding="utf-8")
+        self.rotate_at = self.next_rotation(time.time())
+        self.thread = threading.Thread(target=self.run, name="log-writer", daemon=True)
+        self.thread.start()
+
+    def next_rotation(self, now: float) -> float | None:
+        if not self.rotate:
+            return None
+        seconds = self.ROTATE_SECONDS[self.rotate]
+        # Rotated at the start of the local hour/day
+        offset = time.localtime(now).tm_gmtoff
+        return (now + offset) // seconds * seconds + seconds - offset
+
+    def run(self) -> None:
+        running = True
+        while running:
+            records = [self.queue.get()]
+            while len(records) < self.BATCH_SIZE:
+                try:
+                    records.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+            if None in records:
+                running = False
+                records = [record for record in records if record is not None]
+            lines = []
+            for record in records:
+                try:
+                    lines.append(self.formatter.format(record) + "\n")
+                except Exception:
+                    lines.append(f"Log record could not be formatted: {record.msg!r} {record.args!r}\n")
+            try:
+                self.file.write("".join(lines))
+                self.file.flush()
+                if (self.max_bytes and self.file.tell() >= self.max_bytes) or \
+                        (self.rotate_at and time.time() >= self.rotate_at):
+                    self.do_rotation()
+            except OSError as exception:
+                print(f"[ERROR] Log file [{self.filename}] could not be written: {exception}", file=sys.stderr)
+        self.file.close()
+
+    def do_rotation(self) -> None:
+        """
+        Compresses the log file to <filename>.1.gz, after shifting the older ones, and starts a new log file.
+        """
+        import gzip
+        self.file.close()
+        for number in range(self.backups - 1, 0, -1):
+            if os.path.exists(f"{self.filename}.{number}.gz"):
+                os.replace(f"{self.filename}.{number}.gz", f"{self.filename}.{number + 1}.gz")
+        if self.backups:
+            with open(self.filename, 'rb') as source, gzip.open(f"{self.filename}.1.gz", 'wb') as target:
+                shutil.copyfileobj(source, target)
+        os.remove(self.filename)
+        self.file = open(self.filename, 'a', encoding="utf-8")
+        self.rotate_at = self.next_rotation(time.time())
+
+    def stop(self) -> None:
+        if self.thread.is_alive():
+            self.queue.put(None)
+            self.thread.join()
+
+
+def setup_logging(filename: str = "folder_sync_logs.log", level: str = "files", log_format: str = "text",
+                  max_bytes: int = 0, rotate: str | None = None, backups: int = 5) -> logging.Logger:
+    """
+    Used to configure the script logger: the records are queued by the logging threads and written to filename by a
+    LogWriter thread.
+    :param filename: name of the file where logs are saved
+    :param level: "files" to log the per-file events, "summary" to log only the sync summaries and the errors
+    :param log_format: "text" or "json" (one JSON object per line)
+    :param max_bytes: rotate the log file when it is bigger than max_bytes (0: no size limit)
+    :param rotate: "hourly" or "daily" to rotate the log file periodically
+    :param backups: number of compressed rotated files kept
+    :return: logging.Logger object
+    """
+    logging.addLevelName(FILE_EVENT, "F")
+    logging.addLevelName(logging.INFO, "I")
+    logging.addLevelName(logging.WARNING, "W")
+    if log_format == "json":
+        formatter = JsonFormatter(datefmt="%y-%m-%d %H:%M:%S")
+    else:
+        formatter = logging.Formatter("[{asctime}][{levelname}] {message} - {funcName}", "%y-%m-%d %H:%M:%S",
+                                      style="{")
+    for handler in list(logger.handlers):
+        logger.removeHandler(handler)
+        handler.close()
+    logger.addHandler(LogQueueHandler(LogWriter(filename, formatter, max_bytes, rotate, backups)))
+    logger.setLevel(FILE_EVENT if level == "files" else logging.INFO)
+    logger.propagate = False
+    return logger
+
+
+logger = logging.getLogger("folder_sync")
+# Used as a library, nothing is logged unless the application configures logging (or calls setup_logging())
+logger.addHandler(logging.NullHandler())
+# Suffix of the temporary files written before being renamed into place, ignored when folders are scanned
+TEMP_SUFFIX = ".sync.tmp"
+
+
+def remove_temp(tmp_path: str) -> None:
+    """
+    Removes the temporary file left by an interrupted write, before a new one is written: it could be a hard link of
+    a destination file (see FileCopier.hardlink()), which would be overwritten through the link if it was truncated.
+    :param tmp_path: temporary file path
+    :return: None
+    """
+    try:
+        os.remove(tmp_path)
+    except FileNotFoundError:
+        pass
+
+
+class FileIndex:
+    """
+    Persistent index which maps a file path to its (size, mtime_ns, inode, digest), stored in a SQLite database.
+    A cached digest is trusted only while the stat tuple of the file is unchanged and it was generated with the same
+    hash algorithm. verified_at is the time a scrub last read the file and found the digest correct; a new digest
+    clears it.
+    Updates are committed in batches; an interrupted sync loses at most the last uncommitted batch, which is simply
+    hashed again on the next run.
+    """
+    COMMIT_EVERY = 1000
+
+    def __init__(self, db_path: str):
+        import sqlite3
+        self.db_path = db_path
+        # sqlite3 connection is shared between the executor threads, so every access is serialized
+        self.lock = threading.Lock()
+        self.pending = 0
+        self.connection = sqlite3.connect(db_path, check_same_thread=False)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("PRAGMA synchronous=NORMAL")
+        self.connection.execute("""CREATE TABLE IF NOT EXISTS files (
+                                       path TEXT PRIMARY KEY,
+                                       size INTEGER NOT NULL,
+                                       mtime_ns INTEGER NOT NULL,
+                                       inode INTEGER NOT NULL,
+                                       digest TEXT NOT NULL,
+                                       algorithm TEXT NOT NULL DEFAULT 'md5',
+                                       verified_at REAL)""")
+        columns = [row[1] for row in self.connection.execute("PRAGMA table_info(files)")]
+        if "algorithm" not in columns:
+            # Index created before digests were tagged with their algorithm, all of them are md5
+            self.connection.execute("ALTER TABLE files ADD COLUMN algorithm TEXT NOT NULL DEFAULT 'md5'")
+        if "verified_at" not in columns:
+            self.connection.execute("ALTER TABLE files ADD COLUMN verified_at REAL")
+        self.connection.commit()
+
+    def get_digest(self, path: str, stat_result: os.stat_result, algorithm: str) -> str | None:
+        """
+        Returns the cached digest of path if its metadata did not change since the digest was stored.
+        :param path: absolute file path
+        :param stat_result: current os.stat() result of path
+        :param algorithm: hash algorithm of the requested digest
+        :return: digest or None
+        """
+        with self.lock:
+            row = self.connection.execute("SELECT size, mtime_ns, inode, algorithm, digest FROM files WHERE path = ?",
+                                          (path,)).fetchone()
+        if row and row[:4] == (stat_result.st_size, stat_result.st_mtime_ns, stat_result.st_ino, algorithm):
+            return row[4]
+        return None
+
+    def set_digest(self, path: str, stat_result: os.stat_result, digest: str, algorithm: str) -> None:
+        """
+        Stores the digest of path together with the metadata it was computed for.
+        :param path: absolute file path
+        :param stat_result: os.stat() result of path, taken before hashing
+        :param digest: hash value of path
+        :param algorithm: hash algorithm used to generate digest
+        :return: None
+        """
+        with self.lock:
+            self.connection.execute("INSERT OR REPLACE INTO files (path, size, mtime_ns, inode, digest, algorithm) "
+                                    "VALUES (?, ?, ?, ?, ?, ?)",
+                                    (path, stat_result.st_size, stat_result.st_mtime_ns, stat_result.st_ino, digest,
+                                     algorithm))
+            self._commit_batch()
+
+    def get_verified(self, path: str, stat_result: os.stat_result, algorithm: str) -> float | None:
+        """
+        :param path: absolute file path
+        :param stat_result: current os.stat() result of path
+        :param algorithm: hash algorithm of the digest the file must have been verified against
+        :return: time (epoch seconds) path was last verified, None if it was not verified since it changed
+        """
+        with self.lock:
+            row = self.connection.execute("SELECT size, mtime_ns, inode, algorithm, verified_at FROM files "
+                                          "WHERE path = ?", (path,)).fetchone()
+        if row and row[:4] == (stat_result.st_size, stat_result.st_mtime_ns, stat_result.st_ino, algorithm):
+            return row[4]
+        return None
+
+    def set_verified(self, path: str, stat_result: os.stat_result, digest: str, algorithm: str,
+                     verified_at: float) -> None:
+        """
+        Stores the digest of path, read from the disk at verified_at.
+        :return: None
+        """
+        with self.lock:
+            self.connection.execute("INSERT OR REPLACE INTO files (path, size, mtime_ns, inode, digest, algorithm, "
+                                    "verified_at) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                                    (path, stat_result.st_size, stat_result.st_mtime_ns, stat_result.st_ino, digest,
+                                     algorithm, verified_at))
+            self._commit_batch()
+
+    def remove(self, path: str) -> None:
+        """
+        Removes path and, if it is a folder, everything below it from the index.
+        :param path: absolute file or folder path
+        :return: None
+        """
+        prefix = path.rstrip(os.sep) + os.sep
+        with self.lock:
+            self.connection.execute("DELETE FROM files WHERE path = ? OR substr(path, 1, ?) = ?",
+                                    (path, len(prefix), prefix))
+            self._commit_batch()
+
+    def _commit_batch(self) -> None:
+        self.pending += 1
+        if self.pending >= self.COMMIT_EVERY:
+            self.connection.commit()
+            self.pending = 0
+
+    def commit(self) -> None:
+        with self.lock:
+            self.connection.commit()
+            self.pending = 0
+
+    def close(self) -> None:
+        with self.lock:
+            self.connection.commit()
+            self.connection.close()
+
+
+class TokenBucket:
+    """
+    Token bucket shared by several threads: acquire() takes amount tokens, refilled at rate tokens per second, and
+    sleeps while the bucket is in debt. At most BURST seconds of tokens are accumulated while the bucket is not used.
+    A rate of 0 means unlimited.
+    """
+    BURST = 0.5
+
+    def __init__(self, rate: float = 0):
+        self.lock = threading.Lock()
+        self.rate = rate
+        self.tokens = 0.0
+        self.updated = time.monotonic()
+
+    def set_rate(self, rate: float) -> None:
+        with self.lock:
+            self.rate = rate
+            self.tokens = min(self.tokens, rate * self.BURST)
+
+    def acquire(self, amount: float, stopped: threading.Event | None = None) -> float:
+        """
+        :param amount: tokens to take (bytes or operations)
+        :param stopped: event which interrupts the wait when it is set
+        :return: seconds slept
+        """
+        if not self.rate:
+            return 0.0
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.tokens + (now - self.updated) * self.rate, self.rate * self.BURST) - amount
+            self.updated = now
+            # Threads queue up behind the debt, so every one of them waits for the tokens it took
+            delay = -self.tokens / self.rate if self.tokens < 0 else 0.0
+        if delay:
+            if stopped is None:
+                time.sleep(delay)
+            else:
+                stopped.wait(delay)
+        return delay
+
+
+class IOThrottle:
+    """
+    Limits the read bandwidth, the write bandwidth and the file operations per second of the syncs, with token
+    buckets shared by all the worker threads. Limits could be changed at any time (e.g. from the console).
+    With a latency target, the effective limits are halved whenever the average duration of the throttled I/O calls
+    exceeds the target, and raised back by 10% of the configured limits per ADJUST_INTERVAL while it does not.
+    """
+    ADJUST_INTERVAL = 1.0
+    MIN_FACTOR = 0.05
+    # Smallest chunk in which kernel copies are split when a bandwidth limit is set
+    MIN_CHUNK_SIZE = 65536
+
+    def __init__(self, read_limit: float = 0, write_limit: float = 0, ops_limit: float = 0,
+                 latency_target: float | None = None):
+        self.lock = threading.Lock()
+        self.limits = {"read": read_limit, "write": write_limit, "ops": ops_limit}
+        self.buckets = {kind: TokenBucket(limit) for kind, limit in self.limits.items()}
+        self.latency_target = latency_target
+        self.factor = 1.0
+        self.latency = None
+        self.adjusted = time.monotonic()
+        # Seconds the threads were delayed by the limits, since the last take_waited()
+        self.waited = 0.0
+
+    @property
+    def enabled(self) -> bool:
+        return any(self.limits.values())
+
+    def set_limit(self, kind: str, limit: float) -> None:
+        """
+        :param kind: "read" or "write" (bytes per second) or "ops" (operations per second)
+        :param limit: new limit, 0 for unlimited
+        """
+        with self.lock:
+            self.limits[kind] = limit
+            self.buckets[kind].set_rate(limit * self.factor)
+
+    def describe(self) -> str:
+        rates = []
+        for kind, unit, scale in (("read", "MB/s", 1048576), ("write", "MB/s", 1048576), ("ops", "ops/s", 1)):
+            limit = self.limits[kind]
+            rates.append(f"{kind} {limit * self.factor / scale:g} {unit}" if limit else f"{kind} unlimited")
+        description = ", ".join(rates)
+        if self.latency_target:
+            description += f" (latency target {self.latency_target * 1000:g} ms, at {self.factor:.0%} of the limits)"
+        return description
+
+    def chunk_size(self, default: int) -> int:
+        """
+        :param default: chunk size used without limits
+        :return: chunk size which keeps the bandwidth buckets from bursting
+        """
+        rates = [self.buckets[kind].rate for kind in ("read", "write") if self.buckets[kind].rate]
+        if not rates:
+            return default
+        return max(self.MIN_CHUNK_SIZE, min(default, int(min(rates) * TokenBucket.BURST)))
+
+    @contextmanager
+    def io(self, read: int = 0, write: int = 0, ops: int = 0):
+        """
+        Waits for the tokens of an I/O call, then measures the call for the latency target.
+        :param read: bytes which will be read
+        :param write: bytes which will be written
+        :param ops: file operations (open, stat, remove, ...)
+        """
+        if not self.enabled:
+            yield
+            return
+        self.acquire(read, write, ops)
+        start = time.perf_counter()
+        yield
+        if self.latency_target:
+            self.observe(time.perf_counter() - start)
+
+    def acquire(self, read: int = 0, write: int = 0, ops: int = 0) -> None:
+        """
+        Waits for the tokens of an I/O done elsewhere (e.g. in another process), which is not measured.
+        """
+        waited = 0.0
+        for kind, amount in (("read", read), ("write", write), ("ops", ops)):
+            if amount > 0:
+                waited += self.buckets[kind].acquire(amount)
+        if waited:
+            with self.lock:
+                self.waited += waited
+
+    def observe(self, seconds: float) -> None:
+        with self.lock:
+            self.latency = seconds if self.latency is None else 0.9 * self.latency + 0.1 * seconds
+            now = time.monotonic()
+            if now - self.adjusted < self.ADJUST_INTERVAL:
+                return
+            self.adjusted = now
+            if self.latency > self.latency_target:
+                factor = max(self.MIN_FACTOR, self.factor / 2)
+            else:
+                factor = min(1.0, self.factor + 0.1)
+            if factor != self.factor:
+                logger.info(f"I/O latency {self.latency * 1000:.1f} ms, throttle at {factor:.0%} of the limits")
+                self.factor = factor
+                for kind, limit in self.limits.items():
+                    self.buckets[kind].set_rate(limit * factor)
+
+    def take_waited(self) -> float:
+        with self.lock:
+            waited, self.waited = self.waited, 0.0
+        return waited
+
+
+# Engines of a process pool worker, by algorithm, created by the first file the worker hashes
+_worker_engines = {}
+
+
+def _hash_file_worker(algorithm: str, file_path: str) -> str:
+    """
+    Entry point for hashing in a process pool; every worker process creates its own engine, reused for its files.
+    :param algorithm: hash algorithm name
+    :param file_path: file path
+    :return: hash value of file_path
+    """
+    engine = _worker_engines.get(algorithm)
+    if engine is None:
+        engine = _worker_engines[algorithm] = HashEngine(algorithm)
+    return engine.hash_file(file_path)
+
+
+class HashEngine:
+    """
+    Hashes files with a selectable algorithm. Files are read into a per-thread reusable buffer, so no bytes object is
+    allocated per chunk. They are not mapped in memory: a mapped file truncated while it is hashed (trees are synced
+    live) would kill the process with SIGBUS, instead of failing the one file. The two files of a pair are hashed
+    concurrently, in threads or, for CPU-bound hashing, in a process pool.
+    """
+    BUFFER_SIZE = 1048576
+    # Files bigger than this are read with a sequential access hint, so the kernel reads ahead more
+    SEQUENTIAL_THRESHOLD = 64 * 1048576
+    # Available algorithms, probed once per process
+    algorithms = None
+
+    def __init__(self, algorithm: str = "sha256", processes: int = 0, throttle: IOThrottle | None = None):
+        if algorithm not in self.available_algorithms():
+            raise ValueError(f"Hash algorithm [{algorithm}] is not available. Use one of: "
+                             f"{', '.join(self.available_algorithms())}")
+        self.algorithm = algorithm
+        self.processes = processes
+        self.throttle = throttle or IOThrottle()
+        self.local = threading.local()
+        if processes:
+            from concurrent.futures import ProcessPoolExecutor
+            self.pair_executor = ProcessPoolExecutor(processes)
+        else:
+            self.pair_executor = ThreadPoolExecutor()
+
+    @classmethod
+    def available_algorithms(cls) -> list:
+        """
+        Used to list the hash algorithms which can be used; xxhash and blake3 need their optional packages.
+        :return: list of algorithm names
+        """
+        if cls.algorithms is None:
+            algorithms = ["md5", "sha256", "blake2b"]
+            for optional in ("xxhash", "blake3"):
+                try:
+                    __import__(optional)
+                    algorithms.append(optional)
+                except ImportError:
+                    pass
+            cls.algorithms = algorithms
+        return list(cls.algorithms)
+
+    def new_hasher(self):
+        """
+        Creates a new hash object of the engine algorithm.
+        :return: hash object with update() and hexdigest() methods
+        """
+        if self.algorithm == "xxhash":
+            import xxhash
+            return xxhash.xxh3_128()
+        if self.algorithm == "blake3":
+            import blake3
+            return blake3.blake3()
+        return hashlib.new(self.algorithm)
+
+    def _buffer(self) -> memoryview:
+        if not hasattr(self.local, "buffer"):
+            self.local.buffer = memoryview(bytearray(self.BUFFER_SIZE))
+        return self.local.buffer
+
+    def hash_file(self, file_path: str) -> str:
+        """
+        Generates hash value of file_path.
+        :param file_path: file path
+        :return: hash value of file_path
+        """
+        hasher = self.new_hasher()
+        with self.throttle.io(ops=1):
+            file = open(file_path, 'rb', buffering=0)
+        with file:
+            size = os.fstat(file.fileno()).st_size
+            if size >= self.SEQUENTIAL_THRESHOLD and hasattr(os, "posix_fadvise"):
+                os.posix_fadvise(file.fileno(), 0, 0, os.POSIX_FADV_SEQUENTIAL)
+            buffer, remaining = self._buffer(), size
+            while True:
+                with self.throttle.io(read=min(len(buffer), remaining)):
+                    read_size = file.readinto(buffer)
+                if not read_size:
+                    break
+                hasher.update(buffer[:read_size])
+                remaining -= read_size
+        return hasher.hexdigest()
+
+    def hash_pair(self, file1_path: str, file2_path: str) -> tuple:
+        """
+        Hashes two files concurrently: file2 in the engine pool, file1 in the calling thread (or in the pool as well,
+        for the process mode).
+        :param file1_path: first file path
+        :param file2_path: second file path
+        :return: (hash value of file1_path, hash value of file2_path)
+        """
+        if self.processes:
+            # The worker processes can not share the token buckets, so the files are accounted before hashing
+            if self.throttle.enabled:
+                self.throttle.acquire(read=os.path.getsize(file1_path) + os.path.getsize(file2_path), ops=2)
+            future1 = self.pair_executor.submit(_hash_file_worker, self.algorithm, file1_path)
+            future2 = self.pair_executor.submit(_hash_file_worker, self.algorithm, file2_path)
+            return future1.result(), future2.result()
+        future2 = self.pair_executor.submit(self.hash_file, file2_path)
+        return self.hash_file(file1_path), future2.result()
+
+    def close(self) -> None:
+        self.pair_executor.shutdown()
+
+
+class DeltaTransfer:
+    """
+    rsync-style block delta. The destination file is split in blocks with a weak rolling checksum (Adler-32) and a
+    strong checksum each. The source file is scanned with the rolling checksum to find blocks already present in the
+    destination, so the destination is rebuilt by writing only the regions which changed.
+    A delta is a list of operations: ("copy", destination offset, length) and ("data", source offset, length).
+    """
+    MIN_BLOCK_SIZE = 4096
+    MAX_BLOCK_SIZE = 1048576
+    READ_SIZE = 4 * 1048576
+    ADLER_MOD = 65521
+
+    def __init__(self, threshold: int, throttle: IOThrottle | None = None, fsync: bool = True):
+        # Files smaller than threshold bytes are copied in full
+        self.threshold = threshold
+        self.throttle = throttle or IOThrottle()
+        self.fsync = fsync
+
+    @classmethod
+    def block_size_for(cls, size: int) -> int:
+        """
+        Block size grows with the square root of the file size (like rsync), rounded to 4KB.
+        :param size: file size
+        :return: block size
+        """
+        block_size = int(size ** 0.5) // cls.MIN_BLOCK_SIZE * cls.MIN_BLOCK_SIZE
+        return max(cls.MIN_BLOCK_SIZE, min(cls.MAX_BLOCK_SIZE, block_size))
+
+    @staticmethod
+    def strong_hash(data) -> bytes:
+        return hashlib.blake2b(data, digest_size=16).digest()
+
+    def signature(self, file_path: str, block_size: int) -> dict:
+        """
+        Computes the block checksums of file_path. Only full blocks are part of the signature.
+        :param file_path: destination file path
+        :param block_size: block size
+        :return: {weak checksum: {strong checksum: block offset}}
+        """
+        import zlib
+        signature = {}
+        with open(file_path, 'rb') as file:
+            offset = 0
+            while True:
+                with self.throttle.io(read=block_size):
+                    block = file.read(block_size)
+                if len(block) != block_size:
+                    break
+                signature.setdefault(zlib.adler32(block), {}).setdefault(self.strong_hash(block), offset)
+                offset += block_size
+        return signature
+
+    def delta(self, src_path: str, signature: dict, block_size: int) -> list:
+        """
+        Scans src_path with a rolling checksum and matches its blocks against the destination signature.
+        Byte-by-byte rolling is expensive in Python, so once the unmatched data exceeds a budget, the scan falls back to
+        block-aligned matching for the rest of the file.
+        :param src_path: source file path
+        :param signature: destination signature, from signature()
+        :param block_size: block size used for the signature
+        :return: list of delta operations
+        """
+        import zlib
+        operations = []
+
+        def add(kind, offset, length):
+            if operations and operations[-1][0] == kind and \
+                    operations[-1][1] + operations[-1][2] == offset:
+                operations[-1] = (kind, operations[-1][1], operations[-1][2] + length)
+            else:
+                operations.append((kind, offset, length))
+
+        mod = self.ADLER_MOD
+        remaining = os.path.getsize(src_path)
+        rolling_budget = max(block_size * 64, remaining // 20)
+        buffer, buffer_offset, position, literal_start = b"", 0, 0, 0
+        weak_a = weak_b = 0
+        rolling, end_of_file = False, False
+        with open(src_path, 'rb') as src:
+            while True:
+                # Keep one byte after the window in the buffer, needed to roll the checksum
+                if len(buffer) - position <= block_size and not end_of_file:
+                    with self.throttle.io(read=min(self.READ_SIZE, max(remaining, 0))):
+                        chunk = src.read(self.READ_SIZE)
+                    remaining -= len(chunk)
+                    end_of_file = not chunk
+                    buffer, buffer_offset, position = buffer[position:] + chunk, buffer_offset + position, 0
+                    continue
+                if len(buffer) - position < block_size:
+                    break
+                if not rolling:
+                    weak = zlib.adler32(buffer[position:position + block_size])
+                    weak_a, weak_b = weak & 0xffff, weak >> 16
+                candidates = signature.get((weak_b << 16) | weak_a)
+                match = candidates.get(self.strong_hash(buffer[position:position + block_size])) \
+                    if candidates else None
+                if match is not None:
+                    file_position = buffer_offset + position
+                    if file_position > literal_start:
+                        add("data", literal_start, file_position - literal_start)
+                    add("copy", match, block_size)
+                    position += block_size
+                    literal_start = file_position + block_size
+                    rolling = False
+                elif rolling_budget <= 0 or position + block_size >= len(buffer):
+                    position += block_size
+                    rolling = False
+                else:
+                    out_byte, in_byte = buffer[position], buffer[position + block_size]
+                    weak_a = (weak_a - out_byte + in_byte) % mod
+                    weak_b = (weak_b - block_size * out_byte - 1 + weak_a) % mod
+                    position += 1
+                    rolling_budget -= 1
+                    rolling = True
+            end = buffer_offset + len(buffer)
+            if end > literal_start:
+                add("data", literal_start, end - literal_start)
+        return operations
+
+    def sync_file(self, src_path: str, dst_path: str) -> int:
+        """
+        Updates dst_path to the content of src_path, writing only the changed regions.
+        If every matched block is found at its own offset, dst_path is patched in place; otherwise it is rebuilt in a
+        temporary file (from its own blocks and source data) which replaces it. A dst_path with several hard links is
+        always rebuilt, so the other links (e.g. linked duplicates) keep their content. A patch interrupted in place
+        leaves dst_path with the mtime of its last write, not the src_path one (copied once the patch is complete), so
+        it is detected as changed by the next sync.
+        :param src_path: source file path
+        :param dst_path: destination file path, which exists
+        :return: number of bytes written to the destination
+        """
+        src_size = os.path.getsize(src_path)
+        block_size = self.block_size_for(src_size)
+        operations = self.delta(src_path, self.signature(dst_path, block_size), block_size)
+
+        output_offset, in_place = 0, os.stat(dst_path).st_nlink == 1
+        for kind, offset, length in operations:
+            if kind == "copy" and offset != output_offset:
+                in_place = False
+                break
+            output_offset += length
+
+        written = 0
+        with open(src_path, 'rb') as src:
+            if in_place:
+                with open(dst_path, 'r+b') as dst:
+                    for kind, offset, length in operations:
+                        if kind == "data":
+                            written += self._patch_range(src, dst, offset, length)
+                    dst.truncate(src_size)
+                    if self.fsync:
+                        os.fsync(dst.fileno())
+            else:
+                tmp_path = dst_path + TEMP_SUFFIX
+                remove_temp(tmp_path)
+                with open(dst_path, 'rb') as old, open(tmp_path, 'wb') as dst:
+                    for kind, offset, length in operations:
+                        source = old if kind == "copy" else src
+                        source.seek(offset)
+                        while length > 0:
+                            with self.throttle.io(read=min(length, self.READ_SIZE)):
+                                chunk = source.read(min(length, self.READ_SIZE))
+                            if not chunk:
+                                break
+                            with self.throttle.io(write=len(chunk)):
+                                dst.write(chunk)
+                            length -= len(chunk)
+                    written = dst.tell()
+                    if self.fsync:
+                        dst.flush()
+                        os.fsync(dst.fileno())
+                shutil.copystat(src_path, tmp_path)
+                os.replace(tmp_path, dst_path)
+                return written
+        shutil.copystat(src_path, dst_path)
+        return written
+
+    def _patch_range(self, src, dst, offset: int, length: int) -> int:
+        """
+        Copies the range [offset, offset + length) of src over the same range of dst, skipping the chunks which are
+        already equal.
+        :return: number of bytes written
+        """
+        written = 0
+        while length > 0:
+            src.seek(offset)
+            dst.seek(offset)
+            with self.throttle.io(read=2 * min(length, self.READ_SIZE)):
+                chunk = src.read(min(length, self.READ_SIZE))
+                current = dst.read(len(chunk))
+            if not chunk:
+                break
+            if current != chunk:
+                dst.seek(offset)
+                with self.throttle.io(write=len(chunk)):
+                    dst.write(chunk)
+                written += len(chunk)
+            offset += len(chunk)
+            length -= len(chunk)
+        return written
+
+
+class SyncJournal:
+    """
+    Write-ahead journal of a sync pass, in JSON lines. Every batch of paths is recorded before the workers apply it
+    and marked done afterwards; every local copy is recorded with its temporary file, and big copies record the
+    offset up to which the temporary file was fsynced. After an interruption, the paths of the batches which were not
+    done are synced first and the recorded copies are resumed from their offset (or their temporary file is removed),
+    then the normal sync skips the work which was completed, by metadata and index digests.
+    Records: {"op": "batch", "id", "paths"}, {"op": "done", "id"}, {"op": "copy", "src", "dst", "tmp", "size",
+    "mtime_ns"}, {"op": "offset", "dst", "offset"} and {"op": "copied", "dst"}.
+    """
+    # A copy checkpoints its progress every CHECKPOINT_BYTES
+    CHECKPOINT_BYTES = 64 * 1048576
+
+    @staticmethod
+    def default_path(folder1: str, folders: list, directory: str = ".") -> str:
+        """
+        :return: journal path of a sync of folder1 to folders, in directory
+        """
+        key = "\n".join(os.path.abspath(folder) if not RemoteDestination.is_remote(folder) else folder
+                        for folder in [folder1] + list(folders))
+        return os.path.join(directory, f"folder_sync_journal_{hashlib.md5(key.encode()).hexdigest()[:12]}.jsonl")
+
+    def __init__(self, path: str):
+        self.path = path
+        self.lock = threading.Lock()
+        self.file = None
+        self.next_id = 0
+        # dst path -> last checkpointed offset, of the copies in progress
+        self.offsets = {}
+
+    def load(self) -> tuple:
+        """
+        Reads the journal left by an interrupted sync. The last line could be partially written, it is ignored.
+        :return: (set of paths of the batches which were not done, {dst path: copy record with its "offset"})
+        """
+        batches, copies = {}, {}
+        try:
+            with open(self.path, encoding="utf-8") as file:
+                for line in file:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        break
+                    if record["op"] == "batch":
+                        batches[record["id"]] = record["paths"]
+                    elif record["op"] == "done":
+                        batches.pop(record["id"], None)
+                    elif record["op"] == "copy":
+                        copies[record["dst"]] = {"offset": 0, **record}
+                    elif record["op"] == "offset" and record["dst"] in copies:
+                        copies[record["dst"]]["offset"] = record["offset"]
+                    elif record["op"] == "copied":
+                        copies.pop(record["dst"], None)
+        except FileNotFoundError:
+            pass
+        return {path for paths in batches.values() for path in paths}, copies
+
+    def begin(self) -> None:
+        """
+        Starts the journal of a new sync pass, replacing the previous one.
+        """
+        with self.lock:
+            if self.file is None:
+                self.file = open(self.path, 'w', encoding="utf-8")
+            else:
+                self.file.seek(0)
+                self.file.truncate()
+            self.next_id = 0
+            self.offsets = {}
+
+    def write(self, record: dict, sync: bool = False) -> None:
+        with self.lock:
+            self.file.write(json.dumps(record) + "\n")
+            self.file.flush()
+            if sync:
+                os.fsync(self.file.fileno())
+
+    def batch(self, paths: list) -> int:
+        """
+        Records a batch of paths (relative to folder1) before it is applied.
+        :return: id of the batch, for batch_done()
+        """
+        with self.lock:
+            batch_id, self.next_id = self.next_id, self.next_id + 1
+        self.write({"op": "batch", "id": batch_id, "paths": paths})
+        return batch_id
+
+    def batch_done(self, batch_id: int) -> None:
+        self.write({"op": "done", "id": batch_id})
+
+    def copy_started(self, src_path: str, dst_path: str, tmp_path: str, src_stat: os.stat_result,
+                     offset: int = 0) -> None:
+        """
+        Records a copy before its temporary file is written; offset is given when an interrupted copy is resumed.
+        """
+        self.offsets[dst_path] = offset
+        self.write({"op": "copy", "src": src_path, "dst": dst_path, "tmp": tmp_path, "size": src_stat.st_size,
+                    "mtime_ns": src_stat.st_mtime_ns, "offset": offset})
+
+    def checkpoint(self, dst_path: str, tmp_file, offset: int) -> None:
+        """
+        Records the progress of a copy, every CHECKPOINT_BYTES. The temporary file is fsynced before the offset is
+        recorded, so a recorded offset is always backed by data on disk.
+        :param dst_path: destination file path
+        :param tmp_file: temporary file being written
+        :param offset: bytes written to the temporary file
+        """
+        if offset - self.offsets.get(dst_path, 0) < self.CHECKPOINT_BYTES:
+            return
+        os.fsync(tmp_file.fileno())
+        self.write({"op": "offset", "dst": dst_path, "offset": offset}, sync=True)
+        self.offsets[dst_path] = offset
+
+    def copy_done(self, dst_path: str) -> None:
+        self.offsets.pop(dst_path, None)
+        self.write({"op": "copied", "dst": dst_path})
+
+    def end(self) -> None:
+        """
+        Ends the journal of a completed sync pass: nothing has to be resumed.
+        """
+        with self.lock:
+            if self.file is not None:
+                self.file.close()
+                self.file = None
+            try:
+                os.remove(self.path)
+            except FileNotFoundError:
+                pass
+
+    def close(self) -> None:
+        # The journal of an interrupted pass is kept, to be resumed by the next run
+        with self.lock:
+            if self.file is not None:
+                self.file.close()
+                self.file = None
+
+
+class FileCopier:
+    """
+    Copies files with the cheapest method supported by the source and destination filesystems, in this order:
+    reflink clone (FICLONE ioctl, btrfs/xfs), os.copy_file_range, os.sendfile and a buffered copy.
+    A method which fails as unsupported for a (source device, destination device) pair is not tried again for it.
+    File metadata is preserved like shutil.copy2 does. Copies are written to a temporary file (path + TEMP_SUFFIX),
+    fsynced and renamed into place.
+    Files of at least parallel_size bytes which could not be cloned are copied in parallel: the destination is
+    preallocated, and ranges of range_size bytes are copied by streams threads with os.copy_file_range (or os.pread
+    and os.pwrite) at their offsets, so a single big file is copied at the bandwidth of the device instead of the
+    bandwidth of one stream. The ranges are consumed in order, so the file digest could be computed while it is copied.
+    """
+    METHODS = ("reflink", "copy_file_range", "sendfile", "buffered")
+    FICLONE = 0x40049409
+    CHUNK_SIZE = 64 * 1048576
+    BUFFER_SIZE = 1048576
+    # Parallel copy defaults: files of PARALLEL_SIZE bytes or more, copied by STREAMS threads in ranges of RANGE_SIZE
+    PARALLEL_SIZE = 256 * 1048576
+    STREAMS = 4
+    RANGE_SIZE = 8 * 1048576
+    # errno values meaning that a method is not supported for the given files
+    UNSUPPORTED_ERRORS = {errno.EXDEV, errno.EINVAL, errno.ENOSYS, errno.EOPNOTSUPP, errno.ENOTTY, errno.EBADF}
+
+    def __init__(self, throttle: IOThrottle | None = None, fsync: bool = True, streams: int | None = None,
+                 range_size: int | None = None, parallel_size: int | None = None):
+        # (source st_dev, destination st_dev) -> methods which failed as unsupported
+        self.unsupported = {}
+        self.lock = threading.Lock()
+        self.throttle = throttle or IOThrottle()
+        # fsync the copies before they are renamed into place
+        self.fsync = fsync
+        # Parallel copy of the big files; disabled with streams 1 or parallel_size 0
+        self.streams = streams or self.STREAMS
+        self.range_size = range_size or self.RANGE_SIZE
+        self.parallel_size = self.PARALLEL_SIZE if parallel_size is None else parallel_size
+
+    def available_methods(self, devices: tuple) -> list:
+        """
+        Used to list the copy methods which could work between two devices, in order of preference.
+        :param devices: (source st_dev, destination st_dev)
+        :return: list of method names
+        """
+        linux = sys.platform.startswith("linux")
+        platform_support = {
+            "reflink": fcntl is not None and linux,
+            "copy_file_range": hasattr(os, "copy_file_range"),
+            "sendfile": hasattr(os, "sendfile") and linux,
+            "buffered": True,
+        }
+        with self.lock:
+            unsupported = self.unsupported.get(devices, set())
+        return [method for method in self.METHODS if platform_support[method] and method not in unsupported]
+
+    def copy(self, src_path: str, dst_path: str, journal=None, hasher=None) -> str:
+        """
+        Copies src_path content and metadata to dst_path, through a temporary file which is fsynced and renamed over
+        dst_path, so dst_path is never left partially written. With a journal, the copy is recorded and the progress
+        of a big copy is checkpointed, so an interrupted copy could be resumed.
+        :param src_path: source file path
+        :param dst_path: destination file path
+        :param journal: SyncJournal or None
+        :param hasher: hash object updated with the content of src_path by the parallel copy
+        :return: name of the method used ("parallel" if hasher was updated with the whole content)
+        """
+        tmp_path = dst_path + TEMP_SUFFIX
+        if journal:
+            journal.copy_started(src_path, dst_path, tmp_path, os.stat(src_path))
+        with self._discard_on_error([tmp_path]):
+            method = self._copy_to_temp(src_path, dst_path, 0, journal, hasher)
+            self._commit(src_path, tmp_path, dst_path)
+        if journal:
+            journal.copy_done(dst_path)
+        return method
+
+    def resume(self, src_path: str, dst_path: str, offset: int, journal=None) -> str:
+        """
+        Completes an interrupted copy, whose temporary file holds the first offset bytes of src_path.
+        :param src_path: source file path
+        :param dst_path: destination file path
+        :param offset: size of the temporary file content which was fsynced
+        :param journal: SyncJournal or None
+        :return: name of the method used
+        """
+        if journal:
+            journal.copy_started(src_path, dst_path, dst_path + TEMP_SUFFIX, os.stat(src_path), offset)
+        with self._discard_on_error([dst_path + TEMP_SUFFIX]):
+            method = self._copy_to_temp(src_path, dst_path, offset, journal)
+            self._commit(src_path, dst_path + TEMP_SUFFIX, dst_path)
+        if journal:
+            journal.copy_done(dst_path)
+        return method
+
+    def _copy_to_temp(self, src_path: str, dst_path: str, offset: int, journal, hasher=None) -> str:
+        with self.throttle.io(ops=2):
+            if not offset:
+                remove_temp(dst_path + TEMP_SUFFIX)
+            src = open(src_path, 'rb', buffering=0)
+            dst = open(dst_path + TEMP_SUFFIX, 'r+b' if offset else 'wb', buffering=0)
+        with src, dst:
+            if offset:
+                dst.truncate(offset)
+                dst.seek(offset)
+            size = os.fstat(src.fileno()).st_size
+            devices = (os.fstat(src.fileno()).st_dev, os.fstat(dst.fileno()).st_dev)
+            checkpoint = None
+            if journal and size - offset >= journal.CHECKPOINT_BYTES:
+                def checkpoint(position):
+                    journal.checkpoint(dst_path, dst, position)
+            methods = self.available_methods(devices)
+            if self.is_parallel(size - offset):
+                # A clone is still cheaper than any copy
+                methods = [method for method in methods if method == "reflink"] + ["parallel"]
+            for method in methods:
+                if method == "parallel":
+                    self._copy_parallel(src, [dst], size, devices, offset, checkpoint, None if offset else hasher)
+                    break
+                if self._try_copy(method, src, dst, size, devices, offset, checkpoint):
+                    break
+            if self.fsync:
+                os.fsync(dst.fileno())
+        return method
+
+    def is_parallel(self, size: int) -> bool:
+        """
+        :return: True if size bytes are copied by the parallel copy
+        """
+        return self.streams > 1 and bool(self.parallel_size) and size >= self.parallel_size
+
+    @staticmethod
+    @contextmanager
+    def _discard_on_error(tmp_paths: list):
+        # The temporary files of a failed copy are removed; an interrupted process leaves them to be resumed
+        try:
+            yield
+        except Exception:
+            for tmp_path in tmp_paths:
+                try:
+                    os.remove(tmp_path)
+                except FileNotFoundError:
+                    pass
+            raise
+
+    @staticmethod
+    def _commit(src_path: str, tmp_path: str, dst_path: str) -> None:
+        shutil.copystat(src_path, tmp_path)
+        os.replace(tmp_path, dst_path)
+
+    def copy_many(self, src_path: str, dst_paths: list, journal=None, hasher=None) -> bool:
+        """
+        Copies src_path content and metadata to several destinations, reading it only once: destinations supporting
+        reflink are cloned (no data is read), the other ones are written from a shared buffer. Like copy(), every
+        destination is written to a temporary file, renamed into place when complete.
+        :param src_path: source file path
+        :param dst_paths: destination file paths
+        :param journal: SyncJournal or None
+        :param hasher: hash object, updated with the content of src_path when it is read
+        :return: True if hasher was updated with the whole content of src_path
+        """
+        if len(dst_paths) == 1:
+            return self.copy(src_path, dst_paths[0], journal, hasher) == "parallel"
+        with self.throttle.io(ops=1):
+            src = open(src_path, 'rb', buffering=0)
+        with self._discard_on_error([dst_path + TEMP_SUFFIX for dst_path in dst_paths]):
+            hashed = self._copy_many_to_temp(src, src_path, dst_paths, journal, hasher)
+            for dst_path in dst_paths:
+                self._commit(src_path, dst_path + TEMP_SUFFIX, dst_path)
+                if journal:
+                    journal.copy_done(dst_path)
+        return hashed
+
+    def _copy_many_to_temp(self, src, src_path: str, dst_paths: list, journal, hasher=None) -> bool:
+        with src, ExitStack() as stack:
+            src_stat = os.fstat(src.fileno())
+            files, streamed = [], []
+            for dst_path in dst_paths:
+                if journal:
+                    journal.copy_started(src_path, dst_path, dst_path + TEMP_SUFFIX, src_stat)
+                with self.throttle.io(ops=1):
+                    remove_temp(dst_path + TEMP_SUFFIX)
+                    dst = stack.enter_context(open(dst_path + TEMP_SUFFIX, 'wb', buffering=0))
+                files.append(dst)
+                devices = (src_stat.st_dev, os.fstat(dst.fileno()).st_dev)
+                if "reflink" not in self.available_methods(devices) or \
+                        not self._try_copy("reflink", src, dst, src_stat.st_size, devices):
+                    streamed.append(dst)
+            if streamed and self.is_parallel(src_stat.st_size):
+                self._copy_parallel(src, streamed, src_stat.st_size, None, hasher=hasher)
+            else:
+                buffer = memoryview(bytearray(self.throttle.chunk_size(self.BUFFER_SIZE)))
+                remaining = src_stat.st_size
+                while streamed:
+                    with self.throttle.io(read=min(len(buffer), max(remaining, 0))):
+                        read_size = src.readinto(buffer)
+                    if not read_size:
+                        break
+                    remaining -= read_size
+                    with self.throttle.io(write=read_size * len(streamed)):
+                        for dst in streamed:
+                            dst.write(buffer[:read_size])
+                    if hasher:
+                        hasher.update(buffer[:read_size])
+            if self.fsync:
+                for dst in files:
+                    os.fsync(dst.fileno())
+            return bool(streamed and hasher)
+
+    def clone(self, existing_path: str, dst_path: str, src_path: str) -> bool:
+        """
+        Replaces dst_path with a reflink clone of existing_path, a file with the same content as src_path (no data is
+        copied, the blocks are shared until one of the files is modified), with src_path metadata.
+        :param existing_path: file with the content of src_path, on the filesystem of dst_path
+        :param dst_path: destination file path
+        :param src_path: source file path
+        :return: True if dst_path was cloned, False if reflink is not supported
+        """
+        if fcntl is None:
+            return False
+        tmp_path = dst_path + TEMP_SUFFIX
+        with self._discard_on_error([tmp_path]):
+            with self.throttle.io(ops=2):
+                remove_temp(tmp_path)
+                existing = open(existing_path, 'rb', buffering=0)
+                dst = open(tmp_path, 'wb', buffering=0)
+            with existing, dst:
+                devices = (os.fstat(existing.fileno()).st_dev, os.fstat(dst.fileno()).st_dev)
+                cloned = "reflink" in self.available_methods(devices) and \
+                    self._try_copy("reflink", existing, dst, os.fstat(existing.fileno()).st_size, devices)
+                if cloned and self.fsync:
+                    os.fsync(dst.fileno())
+            if not cloned:
+                os.remove(tmp_path)
+                return False
+            self._commit(src_path, tmp_path, dst_path)
+        return True
+
+    def hardlink(self, existing_path: str, dst_path: str) -> bool:
+        """
+        Replaces dst_path with a hard link to existing_path.
+        :param existing_path: file with the content and metadata dst_path should have
+        :param dst_path: destination file path
+        :return: True if dst_path was linked, False if hard links are not supported (or existing_path is on another
+                 filesystem, or has too many links)
+        """
+        tmp_path = dst_path + TEMP_SUFFIX
+        try:
+            if os.path.lexists(dst_path) and os.path.samefile(existing_path, dst_path):
+                return True
+            with self.throttle.io(ops=2):
+                remove_temp(tmp_path)
+                os.link(existing_path, tmp_path)
+                os.replace(tmp_path, dst_path)
+        except OSError as error:
+            if error.errno not in (errno.EXDEV, errno.EPERM, errno.EMLINK, errno.EOPNOTSUPP):
+                raise
+            return False
+        return True
+
+    def _try_copy(self, method: str, src, dst, size: int, devices: tuple, offset: int = 0, checkpoint=None) -> bool:
+        """
+        Copies src to dst with method, from offset.
+        :return: True if the file was copied, False if the method is not supported for devices
+        """
+        try:
+            getattr(self, f"_copy_{method}")(src, dst, size, offset, checkpoint)
+            return True
+        except OSError as error:
+            # Only a method which failed before writing anything can be replaced by the next one
+            if error.errno not in self.UNSUPPORTED_ERRORS or dst.tell() > offset or \
+                    os.fstat(dst.fileno()).st_size > offset:
+                raise
+            with self.lock:
+                self.unsupported.setdefault(devices, set()).add(method)
+            return False
+
+    def _copy_parallel(self, src, dsts: list, size: int, devices: tuple | None, offset: int = 0, checkpoint=None,
+                       hasher=None) -> None:
+        """
+        Copies src to every file of dsts from offset, in ranges copied concurrently by the streams threads. The
+        destinations are preallocated (posix_fallocate), so the ranges are written into allocated blocks. With a
+        single destination and no hasher, the ranges are copied in the kernel with os.copy_file_range; otherwise they
+        are read once with os.pread and written to every destination with os.pwrite. The ranges are consumed in
+        order, at most 2 * streams at a time, to update hasher and checkpoint the copied prefix.
+        :param devices: (source st_dev, destination st_dev) of a single destination, or None
+        """
+        for dst in dsts:
+            self._preallocate(dst, offset, size)
+        zero_copy = len(dsts) == 1 and hasher is None and devices is not None and \
+            "copy_file_range" in self.available_methods(devices)
+        range_size = self.throttle.chunk_size(self.range_size)
+        with ThreadPoolExecutor(max_workers=self.streams) as executor:
+            ranges = deque()
+            position = offset
+            try:
+                while position < size or ranges:
+                    while position < size and len(ranges) < 2 * self.streams:
+                        length = min(range_size, size - position)
+                        ranges.append((length, executor.submit(self._copy_range, src, dsts, position, length,
+                                                               devices if zero_copy else None)))
+                        position += length
+                    length, future = ranges.popleft()
+                    data = future.result()
+                    if hasher:
+                        hasher.update(data)
+                    offset += length
+                    if checkpoint:
+                        checkpoint(offset)
+            except BaseException:
+                for _, future in ranges:
+                    future.cancel()
+                raise
+
+    def _copy_range(self, src, dsts: list, offset: int, length: int, devices: tuple | None) -> bytes | None:
+        """
+        Copies length bytes of src at offset to the same offset of dsts: with os.copy_file_range if devices is given
+        (and supported), otherwise with os.pread and os.pwrite.
+        :return: the bytes copied, or None if they were copied in the kernel
+        """
+        end = offset + length
+        if devices is not None:
+            try:
+                with self.throttle.io(read=length, write=length):
+                    while offset < end:
+                        copied = os.copy_file_range(src.fileno(), dsts[0].fileno(), end - offset, offset, offset)
+                        if not copied:
+                            raise OSError(errno.EIO, f"Unexpected end of file at {offset}")
+                        offset += copied
+                return None
+            except OSError as error:
+                # Nothing was written by a copy_file_range call which failed as unsupported
+                if error.errno not in self.UNSUPPORTED_ERRORS:
+                    raise
+                with self.lock:
+                    self.unsupported.setdefault(devices, set()).add("copy_file_range")
+                length = end - offset
+        with self.throttle.io(read=length):
+            data = os.pread(src.fileno(), length, offset)
+        if len(data) < length:
+            raise OSError(errno.EIO, f"Unexpected end of file at {offset + len(data)}")
+        with self.throttle.io(write=length * len(dsts)):
+            for dst in dsts:
+                view, position = memoryview(data), offset
+                while view:
+                    written = os.pwrite(dst.fileno(), view, position)
+                    view, position = view[written:], position + written
+        return data
+
+    def _preallocate(self, dst, offset: int, size: int) -> None:
+        # Allocates the blocks of dst up to size; the file size is set even where posix_fallocate is not supported
+        if size <= offset:
+            return
+        try:
+            if hasattr(os, "posix_fallocate"):
+                os.posix_fallocate(dst.fileno(), offset, size - offset)
+                return
+        except OSError as error:
+            if error.errno not in self.UNSUPPORTED_ERRORS:
+                raise
+        os.ftruncate(dst.fileno(), size)
+
+    def _copy_reflink(self, src, dst, size: int, offset: int = 0, checkpoint=None) -> None:
+        # Only metadata is written by a clone, which replaces the whole content (also when resuming)
+        with self.throttle.io(ops=1):
+            fcntl.ioctl(dst.fileno(), self.FICLONE, src.fileno())
+
+    def _copy_copy_file_range(self, src, dst, size: int, offset: int = 0, checkpoint=None) -> None:
+        chunk_size = self.throttle.chunk_size(self.CHUNK_SIZE)
+        while offset < size:
+            length = min(chunk_size, size - offset)
+            with self.throttle.io(read=length, write=length):
+                copied = os.copy_file_range(src.fileno(), dst.fileno(), length, offset, offset)
+            if not copied:
+                break
+            offset += copied
+            if checkpoint:
+                checkpoint(offset)
+
+    def _copy_sendfile(self, src, dst, size: int, offset: int = 0, checkpoint=None) -> None:
+        # sendfile writes at the current position of dst
+        chunk_size = self.throttle.chunk_size(self.CHUNK_SIZE)
+        while offset < size:
+            length = min(chunk_size, size - offset)
+            with self.throttle.io(read=length, write=length):
+                copied = os.sendfile(dst.fileno(), src.fileno(), offset, length)
+            if not copied:
+                break
+            offset += copied
+            if checkpoint:
+                checkpoint(offset)
+
+    def _copy_buffered(self, src, dst, size: int, offset: int = 0, checkpoint=None) -> None:
+        buffer = memoryview(bytearray(self.throttle.chunk_size(self.BUFFER_SIZE)))
+        src.seek(offset)
+        while True:
+            # Only the bytes left are accounted, so a small file is not charged a whole buffer (or two)
+            with self.throttle.io(read=min(len(buffer), max(size - offset, 0))):
+                read_size = src.readinto(buffer)
+            if not read_size:
+                break
+            with self.throttle.io(write=read_size):
+                dst.write(buffer[:read_size])
+            offset += read_size
+            if checkpoint:
+                checkpoint(offset)
+
+
+class BoundedExecutor:
+    """
+    Thread pool with a bounded queue: submit() blocks while max_pending tasks are waiting or running, so work can be
+    fed while folders are walked without materializing it. Futures are not kept; task exceptions are collected.
+    """
+
+    def __init__(self, workers: int, max_pending: int):
+        self.executor = ThreadPoolExecutor(max_workers=workers)
+        self.slots = threading.BoundedSemaphore(max_pending)
+        self.errors = []
+        self.lock = threading.Lock()
+
+    def submit(self, function, *args) -> None:
+        self.slots.acquire()
+        self.executor.submit(function, *args).add_done_callback(self._task_done)
+
+    def _task_done(self, future) -> None:
+        self.slots.release()
+        if future.exception() is not None:
+            with self.lock:
+                self.errors.append(future.exception())
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.executor.shutdown(wait=True)
+
+
+class SharedWorkerPool:
+    """
+    Worker threads shared by the jobs of the daemon. Tasks are queued per job and the jobs are grouped by device:
+    the workers take tasks from the devices in turn, and from the jobs of a device in turn, so a big job does not
+    starve the other jobs of its device, and at most device_workers tasks run on a device at the same time.
+    """
+
+    def __init__(self, workers: int, device_workers: int | None = None):
+        self.device_workers = device_workers or workers
+        self.condition = threading.Condition()
+        # device -> {job -> queue of (function, args, callback)}; dicts keep the round-robin order
+        self.queues = {}
+        self.running = Counter()
+        self.stopped = False
+        self.threads = [threading.Thread(target=self._work, daemon=True) for _ in range(workers)]
+        for thread in self.threads:
+            thread.start()
+
+    def submit(self, device, job: str, function, args: tuple, callback) -> None:
+        """
+        Queues a task; callback is called with the exception raised by the task, or None.
+        """
+        with self.condition:
+            self.queues.setdefault(device, {}).setdefault(job, deque()).append((function, args, callback))
+            self.condition.notify()
+
+    def executor(self, device, job: str, max_pending: int):
+        """
+        :return: JobExecutor of job, which runs its tasks in this pool
+        """
+        return JobExecutor(self, device, job, max_pending)
+
+    def _next_task(self) -> tuple | None:
+        with self.condition:
+            while not self.stopped:
+                for device, jobs in self.queues.items():
+                    if self.running[device] >= self.device_workers:
+                        continue
+                    job, tasks = next(iter(jobs.items()))
+                    task = tasks.popleft()
+                    # Move the job, then the device, to the end of the round-robin order
+                    del jobs[job]
+                    if tasks:
+                        jobs[job] = tasks
+                    del self.queues[device]
+                    if jobs:
+                        self.queues[device] = jobs
+                    self.running[device] += 1
+                    return device, task
+                self.condition.wait()
+            return None
+
+    def _work(self) -> None:
+        while (next_task := self._next_task()) is not None:
+            device, (function, args, callback) = next_task
+            error = None
+            try:
+                function(*args)
+            except BaseException as exception:
+                error = exception
+            with self.condition:
+                self.running[device] -= 1
+                self.condition.notify_all()
+            callback(error)
+
+    def shutdown(self) -> None:
+        with self.condition:
+            self.stopped = True
+            self.condition.notify_all()
+
+
+class JobExecutor:
+    """
+    BoundedExecutor interface for the tasks of one job, run by a SharedWorkerPool: submit() blocks while max_pending
+    tasks of the job are waiting or running, and exiting the context waits for all of them.
+    """
+
+    def __init__(self, pool: SharedWorkerPool, device, job: str, max_pending: int):
+        self.pool = pool
+        self.device = device
+        self.job = job
+        self.slots = threading.BoundedSemaphore(max_pending)
+        self.errors = []
+        self.condition = threading.Condition()
+        self.pending = 0
+
+    def submit(self, function, *args) -> None:
+        self.slots.acquire()
+        with self.condition:
+            self.pending += 1
+        self.pool.submit(self.device, self.job, function, args, self._task_done)
+
+    def _task_done(self, error: BaseException | None) -> None:
+        self.slots.release()
+        with self.condition:
+            if error is not None:
+                self.errors.append(error)
+            self.pending -= 1
+            self.condition.notify_all()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        with self.condition:
+            self.condition.wait_for(lambda: not self.pending)
+
+
+class CopyScheduler:
+    """
+    Runs the copies of a sync in priority order instead of walk order: copies are queued in a heap by key (the lowest
+    first) and run by a pool of workers. Files of at least background_size bytes go to a background lane, served by
+    background_workers of the workers (which copy small files while it is empty): the other workers are always free
+    for the small files, and the large files are copied while small files are pending.
+    At most max_pending copies are queued: submit() blocks while the queue is full, so the priority order applies to a
+    window of the sync work, which keeps the memory bounded.
+    With a SharedWorkerPool (daemon mode), no thread is started: every copy is a task of the pool, which takes the
+    next copy from the heaps when it runs, with at most workers copies (background_workers of the background lane)
+    running at the same time.
+    """
+
+    def __init__(self, workers: int, max_pending: int, background_size: int = 0, background_workers: int = 1,
+                 pool: SharedWorkerPool | None = None, device=None, job: str | None = None):
+        self.workers = workers
+        self.background_size = background_size
+        self.background_workers = background_workers
+        self.max_pending = max_pending
+        self.condition = threading.Condition()
+        # lane -> heap of (key, sequence, function, args); the sequence keeps the submission order of equal keys
+        self.heaps = {"foreground": [], "background": []}
+        self.sequence = 0
+        self.pending = 0
+        self.stopped = False
+        self.errors = []
+        self.pool = pool
+        self.device = device
+        self.job = job
+        # Pool mode: copy tasks submitted to the pool and not done, and background copies running
+        self.runners = 0
+        self.background_running = 0
+        self.threads = [] if pool else [threading.Thread(target=self._work, args=(worker < background_workers,),
+                                                         daemon=True) for worker in range(workers)]
+        for thread in self.threads:
+            thread.start()
+
+    def submit(self, key: tuple, size: int, function, *args) -> None:
+        """
+        Queues function(*args), a copy of size bytes, with priority key.
+        In pool mode, submit() is called by the tasks of the pool, which could all be waiting for the queue: while
+        the queue is full, the calling thread runs the next copies itself.
+        """
+        lane = "background" if self.background_size and size >= self.background_size else "foreground"
+        while True:
+            with self.condition:
+                if self.pending < self.max_pending:
+                    heapq.heappush(self.heaps[lane], (key, self.sequence, function, args))
+                    self.sequence += 1
+                    self.pending += 1
+                    self.condition.notify_all()
+                    if self.pool:
+                        self._start_runner()
+                    return
+                task = self._take() if self.pool else None
+                if task is None:
+                    self.condition.wait()
+                    continue
+            self._run(*task)
+
+    def _next_task(self, lanes: tuple) -> tuple | None:
+        with self.condition:
+            while True:
+                for lane in lanes:
+                    if self.heaps[lane]:
+                        return heapq.heappop(self.heaps[lane])
+                if self.stopped and not self.pending:
+                    return None
+                self.condition.wait()
+
+    def _work(self, background: bool) -> None:
+        lanes = ("background", "foreground") if background else ("foreground",)
+        while (task := self._next_task(lanes)) is not None:
+            self._run(task, False)
+
+    def _run(self, task: tuple, background: bool) -> None:
+        _, _, function, args = task
+        try:
+            function(*args)
+        except Exception as exception:
+            with self.condition:
+                self.errors.append(exception)
+        with self.condition:
+            self.pending -= 1
+            if background:
+                self.background_running -= 1
+            if self.pool:
+                self._start_runner()
+            self.condition.notify_all()
+
+    def _take(self) -> tuple | None:
+        """
+        Pool mode: pops the next copy, from the background lane while less than background_workers background copies
+        are running. Called with the condition held.
+        :return: (task, background), or None if no copy could run now
+        """
+        if self.heaps["background"] and self.background_running < self.background_workers:
+            self.background_running += 1
+            return heapq.heappop(self.heaps["background"]), True
+        if self.heaps["foreground"]:
+            return heapq.heappop(self.heaps["foreground"]), False
+        return None
+
+    def _start_runner(self) -> None:
+        """
+        Pool mode: submits a copy task to the pool, if a queued copy could run and less than workers tasks are
+        submitted. Called with the condition held.
+        """
+        runnable = self.heaps["foreground"] or \
+            (self.heaps["background"] and self.background_running < self.background_workers)
+        if runnable and self.runners < self.workers:
+            self.runners += 1
+            self.pool.submit(self.device, self.job, self._run_next, (), self._runner_done)
+
+    def _run_next(self) -> None:
+        with self.condition:
+            task = self._take()
+        if task is not None:
+            self._run(*task)
+
+    def _runner_done(self, error: BaseException | None) -> None:
+        with self.condition:
+            self.runners -= 1
+            if error is not None:
+                self.errors.append(error)
+            self._start_runner()
+            self.condition.notify_all()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        with self.condition:
+            self.stopped = True
+            self.condition.notify_all()
+            if self.pool:
+                self.condition.wait_for(lambda: not self.pending and not self.runners)
+        for thread in self.threads:
+            thread.join()
+
+
+class FilterRules:
+    """
+    Compiled include/exclude rules of the command line or of one .syncignore file, matched against paths relative to
+    the folder of the rules (base). Patterns are rsync-like:
+        *.tmp       - a name at any depth ("*" and "?" do not match "/", "**" matches anything)
+        build/      - a trailing "/" matches folders only
+        /dist, a/b  - a leading "/", or a "/" inside the pattern, anchors it to the base folder
+    The first matching rule decides. All the rules are compiled into one regular expression (one alternative per
+    rule), so a path is matched with a single regex call.
+    """
+
+    def __init__(self, rules: list, base: str = ""):
+        """
+        :param rules: list of (include, pattern); include is True for include rules, False for exclude rules
+        :param base: folder of the rules, relative to folder1
+        """
+        self.base = base
+        self.includes = [include for include, _ in rules]
+        # Position in rules of every alternative of the regexes
+        self.positions = {}
+        alternatives = {"file": [], "folder": []}
+        for position, (_, pattern) in enumerate(rules):
+            folder_only = pattern.endswith("/")
+            regex = self.translate(pattern.rstrip("/"))
+            for kind in ("folder",) if folder_only else ("file", "folder"):
+                alternatives[kind].append((regex, position))
+        self.regexes = {}
+        for kind, items in alternatives.items():
+            self.positions[kind] = [position for _, position in items]
+            self.regexes[kind] = re.compile("|".join(f"({regex})" for regex, _ in items)) if items else None
+
+    @staticmethod
+    def translate(pattern: str) -> str:
+        """
+        :return: regular expression matching the paths of a glob pattern
+        """
+        anchored = pattern.startswith("/") or "/" in pattern
+        pattern = pattern.lstrip("/")
+        regex, i = [], 0
+        while i < len(pattern):
+            char = pattern[i]
+            if pattern.startswith("**/", i):
+                regex.append("(?:.*/)?")
+                i += 3
+                continue
+            if pattern.startswith("**", i):
+                regex.append(".*")
+                i += 2
+                continue
+            if char == "*":
+                regex.append("[^/]*")
+            elif char == "?":
+                regex.append("[^/]")
+            elif char == "[" and "]" in pattern[i + 2:]:
+                end = pattern.index("]", i + 2)
+                content = pattern[i + 1:end]
+                if content.startswith("!"):
+                    content = "^" + content[1:]
+                regex.append("[" + content.replace("\\", "\\\\") + "]")
+                i = end
+            else:
+                regex.append(re.escape(char))
+            i += 1
+        return ("" if anchored else "(?:.*/)?") + "".join(regex)
+
+    @classmethod
+    def parse(cls, lines, base: str = "") -> "FilterRules":
+        """
+        Parses the lines of a .syncignore file: "+ pattern" includes, "- pattern" or a bare pattern excludes; empty
+        lines and lines starting with "#" are skipped.
+        """
+        rules = []
+        for line in lines:
+            line = line.strip()
+            if not line or line.startswith("#"):
+                continue
+            if line[:2] in ("+ ", "- "):
+                rules.append((line[0] == "+", line[2:].strip()))
+            else:
+                rules.append((False, line))
+        return cls(rules, base)
+
+    def first_match(self, relpath: str, is_dir: bool) -> int | None:
+        """
+        :param relpath: path relative to folder1, inside the base folder
+        :param is_dir: True if relpath is a folder
+        :return: position of the first rule matching relpath, or None
+        """
+        kind = "folder" if is_dir else "file"
+        if self.regexes[kind] is None:
+            return None
+        match = self.regexes[kind].fullmatch(relpath[len(self.base) + 1:] if self.base else relpath)
+        return None if match is None else self.positions[kind][match.lastindex - 1]
+
+    def match(self, relpath: str, is_dir: bool) -> bool | None:
+        """
+        :param relpath: path relative to folder1, inside the base folder
+        :param is_dir: True if relpath is a folder
+        :return: True if relpath is included, False if it is excluded, None if no rule matches it
+        """
+        position = self.first_match(relpath, is_dir)
+        return None if position is None else self.includes[position]
+
+
+class PathFilter:
+    """
+    Decides which paths are synced: the command line rules are checked first, then the rules of the .syncignore file
+    of the path folder, then those of its parent folders; a path no rule matches is synced. Excluded paths are neither
+    copied nor removed from the destinations, and excluded folders are not walked.
+    The rules which apply in a folder are a chain: a tuple of FilterRules, the deepest .syncignore first.
+    """
+    IGNORE_FILE = ".syncignore"
+    # Chains of folders kept for excluded(), which checks random paths (watch mode, remote manifests)
+    CACHE_SIZE = 4096
+
+    def __init__(self, folder1: str, rules: list | None = None):
+        """
+        :param folder1: synced folder, where .syncignore files are read
+        :param rules: command line rules, list of (include, pattern)
+        """
+        self.folder1 = folder1
+        self.rules = FilterRules(rules or [])
+        self.chains = {}
+
+    def child_chain(self, chain: tuple, folder: str, has_ignore_file: bool = True) -> tuple:
+        """
+        :param chain: rules chain of the parent folder
+        :param folder: folder relative to folder1
+        :param has_ignore_file: False if folder is known not to hold a .syncignore file
+        :return: rules chain of folder
+        """
+        if not has_ignore_file:
+            return chain
+        try:
+            with open(os.path.join(self.folder1, folder, self.IGNORE_FILE), encoding="utf-8") as file:
+                rules = FilterRules.parse(file, folder)
+        except (FileNotFoundError, NotADirectoryError):
+            return chain
+        return (rules,) + chain
+
+    def chain(self, folder: str) -> tuple:
+        """
+        :param folder: folder relative to folder1 ("" for folder1)
+        :return: rules chain of folder, built from the .syncignore files of folder and of its parents
+        """
+        if folder in self.chains:
+            return self.chains[folder]
+        parent = os.path.dirname(folder)
+        chain = self.child_chain(self.chain(parent) if folder else (), folder)
+        if len(self.chains) >= self.CACHE_SIZE:
+            self.chains.clear()
+        self.chains[folder] = chain
+        return chain
+
+    def is_excluded(self, relpath: str, is_dir: bool, chain: tuple) -> bool:
+        """
+        :param relpath: path relative to folder1
+        :param is_dir: True if relpath is a folder
+        :param chain: rules chain of relpath folder
+        :return: True if relpath is excluded (its parent folders are not checked)
+        """
+        for rules in (self.rules,) + chain:
+            decision = rules.match(relpath, is_dir)
+            if decision is not None:
+                return not decision
+        return False
+
+    def excluded(self, relpath: str, is_dir: bool) -> bool:
+        """
+        :param relpath: path relative to folder1
+        :param is_dir: True if relpath is a folder
+        :return: True if relpath, or one of its parent folders, is excluded
+        """
+        if not relpath:
+            return False
+        parent = os.path.dirname(relpath)
+        return self.excluded(parent, True) or self.is_excluded(relpath, is_dir, self.chain(parent))
+
+
+def walk_tree(root: str, path_filter: PathFilter | None = None, relpath: str = "", chain: tuple = ()):
+    """
+    Walks root depth-first, every folder being listed sorted by name and followed by its content, so the paths come
+    in the order of their components (e.g. "a", "a/b", "a.txt"): two trees walked this way can be merge-joined. Only
+    the listings of the folders being walked are kept in memory. Like os.walk, symbolic links to folders are listed
+    as folders but not followed.
+    :param root: walked folder
+    :param path_filter: PathFilter; excluded paths are skipped and excluded folders are not listed
+    :param relpath: folder of root to walk, used by the recursion
+    :param chain: rules chain of the parent of relpath, used by the recursion
+    :return: generator of (path relative to root, os.stat() result or None for a folder)
+    """
+    try:
+        with os.scandir(os.path.join(root, relpath)) as iterator:
+            entries = sorted((entry for entry in iterator if not entry.name.endswith(TEMP_SUFFIX)),
+                             key=lambda entry: entry.name)
+    except (FileNotFoundError, NotADirectoryError):
+        return
+    if path_filter:
+        chain = path_filter.child_chain(chain, relpath, any(entry.name == PathFilter.IGNORE_FILE for entry in entries))
+    for entry in entries:
+        child = os.path.join(relpath, entry.name) if relpath else entry.name
+        is_dir = entry.is_dir()
+        if path_filter and path_filter.is_excluded(child, is_dir, chain):
+            continue
+        if is_dir:
+            yield child, None
+            if not entry.is_symlink():
+                yield from walk_tree(root, path_filter, child, chain)
+        else:
+            yield child, entry.stat()
+
+
+# kind: "mkdir", "rmdir", "create", "update", "compare" (content must be compared), "delete" or "skip" (unchanged)
+# destination: folder2 path the action applies to
+# tier: change detection tier which decided the action, for file actions
+# src_stat / dst_stat: stat results of the folder1 / folder2 entry (dst_stat of a "create" or "mkdir" action is the
+#                      entry of another type which must be removed first)
+SyncAction = namedtuple("SyncAction", "kind destination relpath tier src_stat dst_stat")
+
+
+class SyncPlanner:
+    """
+    Generates the actions which make every destination folder equal to folder1. Every folder is listed once in folder1
+    and once in every destination with os.scandir, the sorted entries are merge-joined and the stat results of the
+    listing are reused, so no extra exists()/stat() calls are needed. Metadata change detection tiers (size, mtime) are
+    decided while planning.
+    The actions of one folder1 file, for all destinations, are generated one after the other.
+    Paths excluded by the path filter get no action (in folder1 and in the destinations), and excluded folders are
+    not listed: the filter is decided from the names and the entry types of the listing, without stat() calls.
+    A path which cannot be stat-ed (e.g. a dangling symbolic link, or a file removed since its folder was listed) or
+    a folder which cannot be listed is counted as an error and gets no action, and the other paths are still planned.
+    """
+
+    def __init__(self, folder1: str, destinations: list, tiers: tuple, throttle: IOThrottle | None = None,
+                 path_filter: PathFilter | None = None, metrics: "SyncMetrics | None" = None):
+        self.folder1 = folder1
+        self.destinations = destinations
+        self.tiers = tiers
+        self.throttle = throttle or IOThrottle()
+        self.path_filter = path_filter or PathFilter(folder1)
+        # Paths which cannot be listed or stat-ed are counted as errors, and get no action
+        self.metrics = metrics or SyncMetrics()
+
+    def compare_stats(self, src_stat: os.stat_result, dst_stat: os.stat_result) -> tuple | None:
+        """
+        Runs the metadata change detection tiers.
+        :param src_stat: stat result of folder1 file
+        :param dst_stat: stat result of destination file
+        :return: (tier, changed) or None if content must be compared
+        """
+        for tier in self.tiers:
+            if tier == "size" and src_stat.st_size != dst_stat.st_size:
+                return tier, True
+            if tier == "mtime" and src_stat.st_mtime_ns == dst_stat.st_mtime_ns:
+                return tier, False
+        return None
+
+    def file_action(self, destination: str, relpath: str, src_stat: os.stat_result,
+                    dst_stat: os.stat_result | None) -> SyncAction:
+        if dst_stat is None:
+            return SyncAction("create", destination, relpath, "missing", src_stat, None)
+        decision = self.compare_stats(src_stat, dst_stat)
+        if decision is None:
+            return SyncAction("compare", destination, relpath, None, src_stat, dst_stat)
+        tier, changed = decision
+        return SyncAction("update" if changed else "skip", destination, relpath, tier, src_stat, dst_stat)
+
+    def scan(self, folder: str) -> list:
+        # Temporary files of copies in progress (or interrupted) are not synced
+        try:
+            with self.throttle.io(ops=1), os.scandir(folder) as entries:
+                return sorted((entry for entry in entries if not entry.name.endswith(TEMP_SUFFIX)),
+                              key=lambda entry: entry.name)
+        except FileNotFoundError:
+            return []
+
+    @staticmethod
+    def merge(src_entries: list, dst_lists: list):
+        """
+        Merge-joins the folder1 entries with the entries of every destination, all sorted by name.
+        :return: generator of (name, folder1 entry or None, [destination entry or None for every destination])
+        """
+        lists = [src_entries] + dst_lists
+        positions = [0] * len(lists)
+        while True:
+            heads = [entries[position].name for entries, position in zip(lists, positions) if position < len(entries)]
+            if not heads:
+                return
+            name = min(heads)
+            row = []
+            for i, entries in enumerate(lists):
+                if positions[i] < len(entries) and entries[positions[i]].name == name:
+                    row.append(entries[positions[i]])
+                    positions[i] += 1
+                else:
+                    row.append(None)
+            yield name, row[0], row[1:]
+
+    def plan(self):
+        """
+        Plans the sync of the whole tree.
+        :return: generator of SyncAction; the "mkdir" action of a folder comes before the actions of its content
+        """
+        return self.plan_path("")
+
+    def plan_path(self, relpath: str):
+        """
+        Plans the sync of one path, which could be a file, a folder (planned recursively) or a removed entry.
+        :param relpath: path relative to folder1 and to the destinations
+        :return: generator of SyncAction
+        """
+        # Like the listings of _plan_folder(), folder1 symbolic links are followed and destination ones are not: a
+        # destination link to a folder is replaced, never walked
+        try:
+            src_stat = self._stat(self.folder1, relpath)
+            dst_stats = [self._stat(destination, relpath, follow_symlinks=False) for destination in self.destinations]
+        except OSError as exception:
+            self.metrics.fail(os.path.join(self.folder1, relpath), exception)
+            return
+        src_is_dir = src_stat is not None and stat.S_ISDIR(src_stat.st_mode)
+        if relpath:
+            reference = src_stat or next((dst_stat for dst_stat in dst_stats if dst_stat is not None), None)
+            if reference is None or self.path_filter.excluded(relpath, stat.S_ISDIR(reference.st_mode)):
+                return
+        parent = os.path.dirname(relpath)
+        dst_exists = []
+        for destination, dst_stat in zip(self.destinations, dst_stats):
+            if src_stat is not None and parent and dst_stat is None:
+                # e.g. a journaled path, whose folder was removed from the destination since: created first
+                parent_stat = self._stat(destination, parent, follow_symlinks=False)
+                if parent_stat is None or not stat.S_ISDIR(parent_stat.st_mode):
+                    yield SyncAction("mkdir", destination, parent, None, self._stat(self.folder1, parent), parent_stat)
+            dst_is_dir = dst_stat is not None and stat.S_ISDIR(dst_stat.st_mode)
+            dst_exists.append(dst_is_dir)
+            if src_is_dir:
+                if not dst_is_dir:
+                    yield SyncAction("mkdir", destination, relpath, None, src_stat, dst_stat)
+            elif src_stat is not None:
+                if dst_is_dir:
+                    yield SyncAction("create", destination, relpath, "missing", src_stat, dst_stat)
+                else:
+                    yield self.file_action(destination, relpath, src_stat, dst_stat)
+            elif dst_stat is not None:
+                yield SyncAction("rmdir" if dst_is_dir else "delete", destination, relpath, None, None, None)
+        if src_is_dir:
+            yield from self._plan_folder(relpath, tuple(dst_exists),
+                                         self.path_filter.chain(os.path.dirname(relpath)) if relpath else ())
+
+    def _plan_folder(self, relpath: str, dst_exists: tuple, parent_chain: tuple):
+        stack = [(relpath, dst_exists, parent_chain)]
+        while stack:
+            folder, dst_exists, parent_chain = stack.pop()
+            try:
+                src_entries = self.scan(os.path.join(self.folder1, folder))
+                dst_lists = [self.scan(os.path.join(destination, folder)) if exists else []
+                             for destination, exists in zip(self.destinations, dst_exists)]
+            except OSError as exception:
+                # Without both listings, nothing is copied to or removed from the folder
+                self.metrics.fail(os.path.join(self.folder1, folder), exception)
+                continue
+            chain = self.path_filter.child_chain(
+                parent_chain, folder, any(entry.name == PathFilter.IGNORE_FILE for entry in src_entries))
+            subfolders = []
+            for name, src, dsts in self.merge(src_entries, dst_lists):
+                child = os.path.join(folder, name) if folder else name
+                entry = src if src is not None else next(dst for dst in dsts if dst is not None)
+                if self.path_filter.is_excluded(child, entry.is_dir(follow_symlinks=src is not None), chain):
+                    continue
+                src_is_dir = src is not None and src.is_dir()
+                try:
+                    src_stat = src.stat() if src is not None else None
+                except OSError as exception:
+                    self.metrics.fail(os.path.join(self.folder1, child), exception)
+                    continue
+                child_exists = []
+                for destination, dst in zip(self.destinations, dsts):
+                    dst_is_dir = dst is not None and dst.is_dir(follow_symlinks=False)
+                    child_exists.append(dst_is_dir)
+                    try:
+                        action = self._child_action(destination, child, src_stat, src_is_dir, dst, dst_is_dir)
+                    except OSError as exception:
+                        self.metrics.fail(os.path.join(destination, child), exception)
+                        continue
+                    if action is not None:
+                        yield action
+                # Like os.walk, symbolic links to folders are not followed
+                if src_is_dir and not src.is_symlink():
+                    subfolders.append((child, tuple(child_exists), chain))
+            stack.extend(reversed(subfolders))
+
+    def _child_action(self, destination: str, relpath: str, src_stat: os.stat_result | None, src_is_dir: bool,
+                      dst: os.DirEntry | None, dst_is_dir: bool) -> SyncAction | None:
+        """
+        :return: action of a listed folder1 entry (or of a destination entry missing from folder1) for destination
+        """
+        if src_stat is None:
+            if dst is not None:
+                return SyncAction("rmdir" if dst_is_dir else "delete", destination, relpath, None, None, None)
+        elif src_is_dir:
+            if not dst_is_dir:
+                return SyncAction("mkdir", destination, relpath, None, src_stat,
+                                  dst.stat(follow_symlinks=False) if dst else None)
+        elif dst_is_dir:
+            return SyncAction("create", destination, relpath, "missing", src_stat, dst.stat(follow_symlinks=False))
+        else:
+            return self.file_action(destination, relpath, src_stat, dst.stat() if dst else None)
+        return None
+
+    @staticmethod
+    def _stat(folder: str, relpath: str, follow_symlinks: bool = True) -> os.stat_result | None:
+        """
+        :return: os.stat() result of the path, None if it does not exist
+        :raise OSError: if it cannot be stat-ed, e.g. a dangling symbolic link followed
+        """
+        path = os.path.join(folder, relpath)
+        try:
+            return os.stat(path, follow_symlinks=follow_symlinks)
+        except FileNotFoundError:
+            if follow_symlinks and os.path.islink(path):
+                raise
+            return None
+
+
+class InotifyWatcher:
+    """
+    Watches a folder tree for changes through Linux inotify (called with ctypes). Every folder of the tree has its own
+    watch; watches are added and removed as folders are created, moved or deleted.
+    """
+    IN_MODIFY = 0x00000002
+    IN_ATTRIB = 0x00000004
+    IN_CLOSE_WRITE = 0x00000008
+    IN_MOVED_FROM = 0x00000040
+    IN_MOVED_TO = 0x00000080
+    IN_CREATE = 0x00000100
+    IN_DELETE = 0x00000200
+    IN_DELETE_SELF = 0x00000400
+    IN_MOVE_SELF = 0x00000800
+    IN_Q_OVERFLOW = 0x00004000
+    IN_IGNORED = 0x00008000
+    IN_ONLYDIR = 0x01000000
+    IN_ISDIR = 0x40000000
+    IN_CLOEXEC = 0o2000000
+    IN_NONBLOCK = 0o4000
+    WATCH_MASK = (IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE |
+                  IN_DELETE_SELF | IN_MOVE_SELF | IN_ONLYDIR)
+    EVENT_HEADER = struct.Struct("iIII")
+
+    def __init__(self, root: str):
+        import ctypes
+        import ctypes.util
+        self.root = os.path.abspath(root)
+        self.libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6", use_errno=True)
+        self.fd = self.libc.inotify_init1(self.IN_NONBLOCK | self.IN_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        # watch descriptor -> watched folder path, relative to root
+        self.watches = {}
+        # Set when the kernel event queue overflowed, so changes were lost and a full sync is needed
+        self.overflow = False
+        self.add_tree("")
+
+    def add_tree(self, relpath: str) -> None:
+        """
+        Adds a watch for relpath folder and all its subfolders.
+        :param relpath: folder path, relative to root
+        :return: None
+        """
+        for dirpath, _, _ in os.walk(os.path.join(self.root, relpath)):
+            wd = self.libc.inotify_add_watch(self.fd, os.fsencode(dirpath), self.WATCH_MASK)
+            if wd >= 0:
+                self.watches[wd] = os.path.normpath(os.path.relpath(dirpath, self.root))
+
+    def remove_tree(self, relpath: str) -> None:
+        """
+        Removes the watches of relpath folder and of all its subfolders.
+        :param relpath: folder path, relative to root
+        :return: None
+        """
+        prefix = relpath + os.sep
+        for wd, path in list(self.watches.items()):
+            if path == relpath or path.startswith(prefix):
+                self.libc.inotify_rm_watch(self.fd, wd)
+                del self.watches[wd]
+
+    def read_events(self, timeout: float | None) -> set:
+        """
+        Waits up to timeout seconds for events and returns the paths they refer to.
+        :param timeout: seconds to wait, None to wait until an event is received
+        :return: set of changed paths, relative to root
+        """
+        import select
+        changed = set()
+        readable, _, _ = select.select([self.fd], [], [], timeout)
+        if not readable:
+            return changed
+        try:
+            data = os.read(self.fd, 65536)
+        except BlockingIOError:
+            return changed
+        offset = 0
+        while offset < len(data):
+            wd, mask, _, length = self.EVENT_HEADER.unpack_from(data, offset)
+            offset += self.EVENT_HEADER.size
+            name = os.fsdecode(data[offset:offset + length].rstrip(b"\0"))
+            offset += length
+            if mask & self.IN_Q_OVERFLOW:
+                self.overflow = True
+                continue
+            if mask & self.IN_IGNORED:
+                self.watches.pop(wd, None)
+                continue
+            folder = self.watches.get(wd)
+            if folder is None:
+                continue
+            path = os.path.normpath(os.path.join(folder, name))
+            if mask & self.IN_ISDIR:
+                if mask & (self.IN_CREATE | self.IN_MOVED_TO):
+                    self.add_tree(path)
+                elif mask & (self.IN_DELETE | self.IN_MOVED_FROM):
+                    self.remove_tree(path)
+            changed.add(path)
+        return changed
+
+    def close(self) -> None:
+        os.close(self.fd)
+
+
+class SyncMetrics:
+    """
+    Counters and timings of one sync pass, updated by all the worker threads.
+    Phase times are summed over the threads which worked in parallel, so they show where the work went (walk, hash,
+    copy, delete or waiting for the I/O limits) rather than the wall clock duration of the sync.
+    """
+    COUNTERS = ("files_scanned", "files_copied", "bytes_hashed", "bytes_copied", "files_linked", "bytes_linked",
+                "deletes", "folders_created", "folders_removed", "errors")
+    # "throttle" is the time the threads waited for the I/O limits
+    PHASES = ("walk", "hash", "copy", "delete", "throttle")
+    # Per-file latency histograms: upper bounds of the buckets, in seconds
+    OPERATIONS = ("hash", "sample", "copy")
+    BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5, 10, 60)
+    # Failed paths listed in the report; the other failures are only counted
+    MAX_FAILURES = 100
+
+    def __init__(self, job: str | None = None):
+        self.lock = threading.Lock()
+        # Daemon job name, part of the report
+        self.job = job
+        self.reset()
+
+    def reset(self, mode: str = "full") -> None:
+        with self.lock:
+            self.mode = mode
+            self.started = datetime.now()
+            self.start_time = time.perf_counter()
+            self.duration = 0.0
+            self.peak_memory = 0
+            self.counters = Counter(dict.fromkeys(self.COUNTERS, 0))
+            self.tiers = Counter()
+            self.skipped = Counter()
+            self.phases = dict.fromkeys(self.PHASES, 0.0)
+            self.histograms = {operation: [0] * (len(self.BUCKETS) + 1) for operation in self.OPERATIONS}
+            self.latency_sums = dict.fromkeys(self.OPERATIONS, 0.0)
+            self.failures = []
+
+    def add(self, name: str, value: int = 1) -> None:
+        with self.lock:
+            self.counters[name] += value
+
+    def fail(self, path: str, error: Exception | str) -> None:
+        """
+        Counts an error of one path (exception or error message); the sync goes on with the other paths.
+        """
+        logger.error(f"Sync of [{path}] failed: {error}")
+        with self.lock:
+            self.counters["errors"] += 1
+            if len(self.failures) < self.MAX_FAILURES:
+                self.failures.append({"path": path, "error": str(error)})
+
+    def count_tier(self, tier: str, changed: bool) -> None:
+        """
+        Counts a file resolved by a change detection tier; unchanged files are also counted as skipped by that tier.
+        """
+        with self.lock:
+            self.tiers[tier] += 1
+            if not changed:
+                self.skipped[tier] += 1
+
+    def add_time(self, phase: str, seconds: float, operation: str | None = None, files: int = 1) -> None:
+        with self.lock:
+            self.phases[phase] += seconds
+            if operation:
+                self.histograms[operation][bisect.bisect_left(self.BUCKETS, seconds)] += files
+                self.latency_sums[operation] += seconds * files
+
+    @contextmanager
+    def measure(self, phase: str, operation: str | None = None, files: int = 1):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add_time(phase, time.perf_counter() - start, operation, files)
+
+    def timed(self, phase: str, iterable):
+        """
+        Yields the items of iterable, adding the time spent to produce them (e.g. by the plan generator) to phase.
+        """
+        iterator, elapsed = iter(iterable), 0.0
+        try:
+            while True:
+                start = time.perf_counter()
+                try:
+                    item = next(iterator)
+                except StopIteration:
+                    return
+                finally:
+                    elapsed += time.perf_counter() - start
+                yield item
+        finally:
+            self.add_time(phase, elapsed)
+
+    def finish(self) -> None:
+        with self.lock:
+            self.duration = time.perf_counter() - self.start_time
+            self.peak_memory = self.peak_rss()
+
+    @staticmethod
+    def peak_rss() -> int:
+        """
+        :return: peak resident memory of the process since it started, in bytes (0 if it is not available)
+        """
+        if resource is None:
+            return 0
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        # Kilobytes on Linux, bytes on macOS
+        return peak if sys.platform == "darwin" else peak * 1024
+
+    def report(self) -> dict:
+        """
+        :return: the metrics of the sync pass, as a JSON serializable dict
+        """
+        with self.lock:
+            latency = {}
+            for operation, counts in self.histograms.items():
+                latency[operation] = {
+                    "buckets": dict(zip([str(bound) for bound in self.BUCKETS] + ["+Inf"], counts)),
+                    "count": sum(counts), "sum": round(self.latency_sums[operation], 6)}
+            report = {"job": self.job} if self.job else {}
+            return {**report, "started": self.started.isoformat(timespec="seconds"), "mode": self.mode,
+                    "duration_seconds": round(self.duration, 6), "peak_memory_bytes": self.peak_memory,
+                    **self.counters,
+                    "failures": list(self.failures), "tiers": dict(self.tiers), "skipped": dict(self.skipped),
+                    "phase_seconds": {phase: round(seconds, 6) for phase, seconds in self.phases.items()},
+                    "latency_seconds": latency}
+
+    def prometheus(self) -> str:
+        """
+        :return: the metrics of the sync pass, in Prometheus text exposition format
+        """
+        report = self.report()
+        lines = ["# HELP folder_sync_last_sync_timestamp_seconds Start time of the last sync.",
+                 "# TYPE folder_sync_last_sync_timestamp_seconds gauge",
+                 f"folder_sync_last_sync_timestamp_seconds {self.started.timestamp()}",
+                 "# HELP folder_sync_last_sync_duration_seconds Duration of the last sync.",
+                 "# TYPE folder_sync_last_sync_duration_seconds gauge",
+                 f"folder_sync_last_sync_duration_seconds {report['duration_seconds']}",
+                 "# HELP folder_sync_peak_memory_bytes Peak resident memory of the process, at the end of the last sync.",
+                 "# TYPE folder_sync_peak_memory_bytes gauge",
+                 f"folder_sync_peak_memory_bytes {report['peak_memory_bytes']}"]
+        for name in self.COUNTERS:
+            lines += [f"# HELP folder_sync_{name} {name.replace('_', ' ').capitalize()} by the last sync.",
+                      f"# TYPE folder_sync_{name} gauge",
+                      f"folder_sync_{name} {report[name]}"]
+        for name, label, values, help_text in (
+                ("tier_files", "tier", report["tiers"], "Files resolved by every change detection tier"),
+                ("skipped_files", "reason", report["skipped"], "Unchanged files, by the tier which skipped them"),
+                ("phase_seconds", "phase", report["phase_seconds"], "Time spent in every phase, summed over threads")):
+            lines += [f"# HELP folder_sync_{name} {help_text} by the last sync.", f"# TYPE folder_sync_{name} gauge"]
+            lines += [f'folder_sync_{name}{{{label}="{key}"}} {value}' for key, value in values.items()]
+        lines += ["# HELP folder_sync_file_latency_seconds Per-file latency of the last sync, by operation.",
+                  "# TYPE folder_sync_file_latency_seconds histogram"]
+        for operation, histogram in report["latency_seconds"].items():
+            cumulative = 0
+            for bound, count in histogram["buckets"].items():
+                cumulative += count
+                lines.append(f'folder_sync_file_latency_seconds_bucket{{operation="{operation}",le="{bound}"}} '
+                             f'{cumulative}')
+            lines += [f'folder_sync_file_latency_seconds_sum{{operation="{operation}"}} {histogram["sum"]}',
+                      f'folder_sync_file_latency_seconds_count{{operation="{operation}"}} {histogram["count"]}']
+        return "\n".join(lines) + "\n"
+
+
+class MetricsExporter:
+    """
+    Publishes the metrics of every sync pass: appended as one JSON line to report_path, written in Prometheus text
+    format to prometheus_path (e.g. for the node_exporter textfile collector) and served over HTTP on port. The
+    metrics (which name the synced paths) are served without authentication, so only on localhost by default.
+    """
+    DEFAULT_HOST = "127.0.0.1"
+
+    def __init__(self, report_path: str | None = None, prometheus_path: str | None = None, port: int | None = None,
+                 host: str = DEFAULT_HOST):
+        self.report_path = report_path
+        self.prometheus_path = prometheus_path
+        self.server = None
+        if port:
+            # http.server is imported only to serve the metrics, it is slow to import
+            import http.server
+
+            class MetricsRequestHandler(http.server.BaseHTTPRequestHandler):
+                def do_GET(self) -> None:
+                    body = self.server.text.encode()
+                    self.send_response(200)
+                    self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+                    self.send_header("Content-Length", str(len(body)))
+                    self.end_headers()
+                    self.wfile.write(body)
+
+                def log_message(self, format, *args) -> None:
+                    # Scrapes are not logged
+                    pass
+
+            self.server = http.server.ThreadingHTTPServer((host, port), MetricsRequestHandler)
+            self.server.text = ""
+            threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def export(self, metrics: SyncMetrics) -> None:
+        if self.report_path:
+            with open(self.report_path, 'a') as file:
+                file.write(json.dumps(metrics.report()) + "\n")
+        if self.prometheus_path or self.server:
+            text = metrics.prometheus()
+            if self.prometheus_path:
+                # Written to a temporary file and renamed, so a scrape never reads a partial file
+                temp_path = self.prometheus_path + ".tmp"
+                with open(temp_path, 'w') as file:
+                    file.write(text)
+                os.replace(temp_path, self.prometheus_path)
+            if self.server:
+                self.server.text = text
+
+    def close(self) -> None:
+        if self.server:
+            self.server.shutdown()
+            self.server.server_close()
+
+
+class SyncConnection:
+    """
+    Framed messages over a TCP socket, used by the sync server and its clients. A message is a JSON header with an
+    optional binary payload, sent as: frame (header length, payload length, compressed flag), header, payload.
+    Payloads are compressed with zlib or zstd (if the zstandard package is installed), when it makes them smaller.
+    The lengths of a received message are checked before it is read, and its payload is not decompressed beyond
+    MAX_PAYLOAD, so a peer cannot make the other side allocate more: a message over the limits closes the connection.
+    """
+    FRAME = struct.Struct("!IIB")
+    CHUNK_SIZE = 1048576
+    # Limits of a received message: the largest payloads are the signatures and patch operations of huge files
+    MAX_HEADER = 1048576
+    MAX_PAYLOAD = 128 * 1048576
+
+    def __init__(self, sock: "socket.socket", compression: str = "none"):
+        self.sock = sock
+        self.reader = sock.makefile("rb")
+        self.compression = compression
+        self.send_lock = threading.Lock()
+        # True while the "data" messages of a received file are not fully read
+        self.stream_open = False
+
+    @staticmethod
+    def available_compressions() -> list:
+        compressions = ["none", "zlib"]
+        try:
+            import zstandard
+            compressions.append("zstd")
+        except ImportError:
+            pass
+        return compressions
+
+    def send(self, header: dict, data: bytes = b"") -> None:
+        import zlib
+        compressed = 0
+        if data and self.compression != "none":
+            if self.compression == "zstd":
+                import zstandard
+                packed = zstandard.ZstdCompressor().compress(data)
+            else:
+                packed = zlib.compress(data, 1)
+            if len(packed) < len(data):
+                data, compressed = packed, 1
+        encoded = json.dumps(header).encode()
+        with self.send_lock:
+            self.sock.sendall(self.FRAME.pack(len(encoded), len(data), compressed) + encoded)
+            if data:
+                self.sock.sendall(data)
+
+    def receive(self, max_header: int | None = None, max_payload: int | None = None) -> tuple:
+        """
+        Reads the next message.
+        :param max_header: largest header accepted, MAX_HEADER by default
+        :param max_payload: largest payload accepted (compressed and decompressed), MAX_PAYLOAD by default
+        :return: (header, payload); header is None if the connection was closed
+        :raise ConnectionError: if the message exceeds the limits or is malformed
+        """
+        max_header = self.MAX_HEADER if max_header is None else max_header
+        max_payload = self.MAX_PAYLOAD if max_payload is None else max_payload
+        frame = self.reader.read(self.FRAME.size)
+        if len(frame) < self.FRAME.size:
+            return None, b""
+        header_length, data_length, compressed = self.FRAME.unpack(frame)
+        if header_length > max_header or data_length > max_payload:
+            raise ConnectionError(f"Message of {header_length} + {data_length} bytes exceeds the limits "
+                                  f"({max_header} + {max_payload} bytes)")
+        try:
+            header = json.loads(self.reader.read(header_length))
+        except ValueError as exception:
+            raise ConnectionError(f"Malformed message header: {exception}")
+        if not isinstance(header, dict) or "op" not in header:
+            raise ConnectionError("Malformed message header: no op")
+        data = self.reader.read(data_length)
+        if compressed:
+            data = self.decompress(data, max_payload)
+        return header, data
+
+    def decompress(self, data: bytes, limit: int) -> bytes:
+        """
+        :return: data decompressed, if it does not exceed limit bytes
+        :raise ConnectionError: if it exceeds limit bytes, or is not a complete compressed stream
+        """
+        import zlib
+        if self.compression == "zstd":
+            import io
+            import zstandard
+            with zstandard.ZstdDecompressor().stream_reader(io.BytesIO(data)) as reader:
+                decompressed = reader.read(limit + 1)
+            complete = True
+        else:
+            decompressor = zlib.decompressobj()
+            try:
+                decompressed = decompressor.decompress(data, limit + 1)
+            except zlib.error as exception:
+                raise ConnectionError(f"Malformed message payload: {exception}")
+            complete = decompressor.eof
+        if len(decompressed) > limit:
+            raise ConnectionError(f"Message payload exceeds {limit} bytes once decompressed")
+        if not complete:
+            raise ConnectionError("Malformed message payload: incomplete compressed stream")
+        return decompressed
+
+    def send_file(self, file_path: str, throttle: IOThrottle | None = None) -> None:
+        """
+        Streams file_path content as "data" messages, followed by an "end" message.
+        """
+        throttle = throttle or IOThrottle()
+        with open(file_path, 'rb') as file:
+            remaining = os.fstat(file.fileno()).st_size
+            while True:
+                with throttle.io(read=min(self.CHUNK_SIZE, max(remaining, 0))):
+                    chunk = file.read(self.CHUNK_SIZE)
+                if not chunk:
+                    break
+                remaining -= len(chunk)
+                self.send({"op": "data"}, chunk)
+        self.send({"op": "end"})
+
+    def stream(self):
+        """
+        Reads the payloads of "data" messages, until the "end" message.
+        :return: generator of payloads
+        """
+        while True:
+            header, data = self.receive()
+            if header is None or header["op"] != "data":
+                self.stream_open = False
+                return
+            yield data
+
+    def request(self, header: dict, data: bytes = b"") -> tuple:
+        """
+        Sends a message and waits for its response.
+        :return: (response header, response payload)
+        """
+        self.send(header, data)
+        response, data = self.receive()
+        if response is None:
+            raise ConnectionError("Connection closed by the sync server")
+        if "error" in response:
+            raise OSError(f"Sync server error: {response['error']}")
+        return response, data
+
+
+class SyncRequestHandler:
+    """
+    Serves one client connection of SyncServer, in a thread of its TCP server. Every request is answered with an
+    "ack" message (or an "error" one), except "manifest", which is answered with one or several "manifest" messages.
+    When the server has a token, the "hello" response carries a nonce, and the client must answer it with an "auth"
+    request (HMAC-SHA256 of the nonce with the token) before any other request; the connection is closed otherwise.
+    """
+    # Largest request header accepted before authentication; the requests accepted then have no payload
+    UNAUTHENTICATED_HEADER = 4096
+
+    def __init__(self, request, client_address: tuple, server: "SyncServer"):
+        self.request = request
+        self.client_address = client_address
+        self.server = server
+        self.handle()
+
+    def handle(self) -> None:
+        connection = SyncConnection(self.request)
+        # Walk of the served folder, continued by the paged "manifest" requests
+        self.manifest = None
+        self.nonce = None
+        self.authenticated = self.server.token is None
+        while True:
+            try:
+                # Until the client is authenticated, only the small "hello" and "auth" requests are accepted
+                header, data = connection.receive() if self.authenticated else \
+                    connection.receive(self.UNAUTHENTICATED_HEADER, 0)
+            except ConnectionError as exception:
+                logger.warning(f"Connection of {self.client_address[0]} closed: {exception}")
+                break
+            if header is None or header["op"] == "bye":
+                break
+            if not self.authenticated and header["op"] not in ("hello", "auth"):
+                logger.warning(f"Request [{header['op']}] of {self.client_address[0]} refused: not authenticated")
+                connection.send({"op": "ack", "error": "Authentication required", "path": header.get("path")})
+                break
+            connection.stream_open = header["op"] in ("put", "patch")
+            try:
+                response = getattr(self, f"op_{header['op']}")(connection, header, data)
+            except Exception as exception:
+                logger.exception(exception)
+                if connection.stream_open:
+                    # Skip the rest of the failed file content, to stay in sync with the client
+                    for _ in connection.stream():
+                        pass
+                response = {"op": "ack", "error": str(exception)}
+            if response is not None:
+                connection.send({**response, "path": header.get("path")})
+            if not self.authenticated and header["op"] == "auth":
+                break
+
+    def path(self, relpath: str, follow: bool = True) -> str:
+        """
+        Maps a client path to a path inside the served root. Paths escaping the root are rejected, also through
+        symbolic links: the path is resolved, or only its folder when the entry itself is replaced or removed (not
+        followed).
+        :param relpath: path relative to the served root
+        :param follow: False if the entry is not read or written through (it could be a link leading outside)
+        """
+        normalized = os.path.normpath(relpath)
+        if os.path.isabs(normalized) or normalized == ".." or normalized.startswith(".." + os.sep):
+            raise ValueError(f"Path [{relpath}] is outside of the served folder")
+        path = os.path.join(self.server.root, normalized)
+        resolved = os.path.realpath(path if follow else os.path.dirname(path))
+        if resolved != self.server.root and not resolved.startswith(self.server.root + os.sep):
+            raise ValueError(f"Path [{relpath}] is outside of the served folder")
+        return path
+
+    def op_hello(self, connection: SyncConnection, header: dict, data: bytes) -> dict:
+        compression = header.get("compression", "none")
+        if compression not in SyncConnection.available_compressions():
+            compression = "zlib"
+        response = {"op": "ack", "compression": compression}
+        if not self.authenticated:
+            self.nonce = os.urandom(16).hex()
+            response["nonce"] = self.nonce
+        # The client switches to the agreed compression after reading this response
+        connection.send(response)
+        connection.compression = compression
+        return None
+
+    def op_auth(self, connection: SyncConnection, header: dict, data: bytes) -> dict:
+        if self.nonce is None or not hmac.compare_digest(SyncServer.proof(self.server.token, self.nonce),
+                                                         str(header.get("proof"))):
+            logger.warning(f"Authentication of {self.client_address[0]} failed")
+            raise PermissionError("Authentication failed")
+        self.authenticated = True
+        return {"op": "ack"}
+
+    def op_manifest(self, connection: SyncConnection, header: dict, data: bytes) -> None:
+        """
+        Sends the served folder entries, as [path, is folder, size, mtime_ns], in the order of walk_tree(). With
+        "page", one message of at most page entries is sent, and the next request with "continue" sends the next
+        entries of the same walk, so the client merges the manifest while it is received. Otherwise the whole manifest
+        is sent, in messages of up to 10000 entries.
+        """
+        if not header.get("continue") or self.manifest is None:
+            self.manifest = walk_tree(self.server.root)
+        page = header.get("page") or 10000
+        while True:
+            entries = [[relpath, stat_result is None, stat_result.st_size if stat_result else 0,
+                        stat_result.st_mtime_ns if stat_result else 0]
+                       for relpath, stat_result in islice(self.manifest, page)]
+            more = len(entries) == page
+            connection.send({"op": "manifest", "more": more}, json.dumps(entries).encode())
+            if "page" in header or not more:
+                return None
+
+    def op_digests(self, connection: SyncConnection, header: dict, data: bytes) -> dict:
+        hash_engine = self.server.hash_engine(header["algorithm"])
+        digests = []
+        for relpath in json.loads(data):
+            path = os.path.abspath(self.path(relpath))
+            stat_result = os.stat(path)
+            digest = self.server.index.get_digest(path, stat_result, hash_engine.algorithm) \
+                if self.server.index else None
+            if digest is None:
+                digest = hash_engine.hash_file(path)
+                if self.server.index:
+                    self.server.index.set_digest(path, stat_result, digest, hash_engine.algorithm)
+            digests.append(digest)
+        return {"op": "digests", "digests": digests}
+
+    def op_mkdir(self, connection: SyncConnection, header: dict, data: bytes) -> dict:
+        path = self.path(header["path"], follow=False)
+        if os.path.lexists(path) and not os.path.isdir(path):
+            os.remove(path)
+        os.makedirs(path, exist_ok=True)
+        return {"op": "ack"}
+
+    def op_delete(self, connection: SyncConnection, header: dict, data: bytes) -> dict:
+        path = self.path(header["path"], follow=False)
+        if os.path.isdir(path) and not os.path.islink(path):
+            shutil.rmtree(path)
+        elif os.path.lexists(path):
+            os.remove(path)
+        if self.server.index:
+            self.server.index.remove(os.path.abspath(path))
+        return {"op": "ack"}
+
+    def op_put(self, connection: SyncConnection, header: dict, data: bytes) -> dict:
+        path = self.path(header["path"], follow=False)
+        tmp_path = path + TEMP_SUFFIX
+        remove_temp(tmp_path)
+        with open(tmp_path, 'wb') as file:
+            for chunk in connection.stream():
+                file.write(chunk)
+            self.fsync(file)
+        self._commit(tmp_path, path, header)
+        return {"op": "ack"}
+
+    def op_signature(self, connection: SyncConnection, header: dict, data: bytes) -> dict:
+        signature = self.server.delta.signature(self.path(header["path"]), header["block_size"])
+        blocks = [[weak, strong.hex(), offset] for weak, strongs in signature.items()
+                  for strong, offset in strongs.items()]
+        connection.send({"op": "signature", "path": header["path"]}, json.dumps(blocks).encode())
+        return None
+
+    def op_patch(self, connection: SyncConnection, header: dict, data: bytes) -> dict:
+        """
+        Rebuilds a file from blocks of its current version ("copy" operations) and literal data streamed by the
+        client ("data" operations, in order). The operations, which could be many for a huge file, are the payload.
+        """
+        path = self.path(header["path"])
+        tmp_path = path + TEMP_SUFFIX
+        literal, literal_offset = b"", 0
+        stream = connection.stream()
+        remove_temp(tmp_path)
+        with open(path, 'rb') as old, open(tmp_path, 'wb') as file:
+            for kind, offset, length in json.loads(data):
+                if kind == "copy":
+                    old.seek(offset)
+                    file.write(old.read(length))
+                    continue
+                while length > 0:
+                    if literal_offset == len(literal):
+                        literal, literal_offset = next(stream, None), 0
+                        if literal is None:
+                            raise ValueError(f"Missing delta data for [{header['path']}]")
+                    chunk = literal[literal_offset:literal_offset + length]
+                    file.write(chunk)
+                    literal_offset += len(chunk)
+                    length -= len(chunk)
+            self.fsync(file)
+        for _ in stream:
+            pass
+        self._commit(tmp_path, path, header)
+        return {"op": "ack"}
+
+    def fsync(self, file) -> None:
+        if self.server.fsync:
+            file.flush()
+            os.fsync(file.fileno())
+
+    def _commit(self, tmp_path: str, path: str, header: dict) -> None:
+        """
+        Replaces path with the received tmp_path and applies the folder1 file metadata.
+        """
+        if os.path.isdir(path) and not os.path.islink(path):
+            shutil.rmtree(path)
+        os.chmod(tmp_path, header["mode"])
+        os.utime(tmp_path, ns=(header["mtime_ns"], header["mtime_ns"]))
+        os.replace(tmp_path, path)
+        if self.server.index and header.get("digest"):
+            # The client already hashed the content it sent
+            self.server.index.set_digest(os.path.abspath(path), os.stat(path), header["digest"], header["algorithm"])
+
+
+class SyncServer:
+    """
+    Agent started with 'sync_folders.py serve <folder>' on the machine which holds a destination folder. Clients sync
+    to it over TCP: manifests and digests are computed next to the data and only changed files, or changed blocks of
+    big files, are transferred. Every connection is served by a SyncRequestHandler, in a thread of a
+    socketserver.ThreadingTCPServer.
+    """
+    DEFAULT_PORT = 8730
+    # Environment variable holding the shared token of the server and its clients
+    TOKEN_VARIABLE = "FOLDER_SYNC_TOKEN"
+
+    def __init__(self, address: tuple, root: str, index: FileIndex | None = None, fsync: bool = True,
+                 token: str | None = None):
+        """
+        :param token: shared token the clients must prove they know, None to serve without authentication
+        """
+        import socketserver
+        self.root = os.path.realpath(root)
+        self.token = token
+        self.index = index
+        # fsync the received files before they are renamed into place
+        self.fsync = fsync
+        self.delta = DeltaTransfer(0)
+        self.hash_engines = {}
+        self.lock = threading.Lock()
+        self.tcp_server = socketserver.ThreadingTCPServer(
+            address, lambda request, client_address, _: SyncRequestHandler(request, client_address, self),
+            bind_and_activate=False)
+        self.tcp_server.daemon_threads = True
+        self.tcp_server.allow_reuse_address = True
+        try:
+            self.tcp_server.server_bind()
+            self.tcp_server.server_activate()
+        except BaseException:
+            self.tcp_server.server_close()
+            raise
+        self.server_address = self.tcp_server.server_address
+
+    def serve_forever(self, poll_interval: float = 0.5) -> None:
+        self.tcp_server.serve_forever(poll_interval)
+
+    def shutdown(self) -> None:
+        self.tcp_server.shutdown()
+
+    def server_close(self) -> None:
+        self.tcp_server.server_close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.server_close()
+
+    def hash_engine(self, algorithm: str) -> HashEngine:
+        with self.lock:
+            if algorithm not in self.hash_engines:
+                self.hash_engines[algorithm] = HashEngine(algorithm)
+            return self.hash_engines[algorithm]
+
+    @staticmethod
+    def proof(token: str, nonce: str) -> str:
+        """
+        :return: answer to the nonce of a server, proving that the token is known without sending it
+        """
+        return hmac.new(token.encode(), nonce.encode(), hashlib.sha256).hexdigest()
+
+
+# Remote manifest entry, with the stat attributes used by the change detection tiers
+RemoteEntry = namedtuple("RemoteEntry", "is_dir st_size st_mtime_ns")
+
+
+class RemoteDestination:
+    """
+    Destination folder served by a SyncServer, given as sync://host:port.
+    The client compares the server manifest with folder1, asks the server for the digests of the files the metadata
+    tiers could not decide, and sends the changes. Big files are sent as block deltas against the server signature;
+    the other requests are pipelined, their acknowledgements being read by a separate thread.
+    """
+
+    def __init__(self, url: str, compression: str = "none", token: str | None = None):
+        """
+        :param token: token of the server, FOLDER_SYNC_TOKEN by default
+        """
+        import urllib.parse
+        parsed = urllib.parse.urlsplit(url)
+        self.url = url
+        self.address = (parsed.hostname, parsed.port or SyncServer.DEFAULT_PORT)
+        self.compression = compression
+        self.token = token or os.environ.get(SyncServer.TOKEN_VARIABLE)
+
+    def connect(self, sock: "socket.socket") -> SyncConnection:
+        """
+        Opens the session: agrees on the compression and answers the authentication challenge of the server.
+        :return: SyncConnection of the session
+        """
+        connection = SyncConnection(sock)
+        response, _ = connection.request({"op": "hello", "compression": self.compression})
+        connection.compression = response["compression"]
+        if "nonce" in response:
+            if not self.token:
+                raise PermissionError(f"[{self.url}] requires a token: set {SyncServer.TOKEN_VARIABLE}")
+            connection.request({"op": "auth", "proof": SyncServer.proof(self.token, response["nonce"])})
+        return connection
+
+    @staticmethod
+    def is_remote(folder: str) -> bool:
+        return folder.startswith("sync://")
+
+    # Manifest entries received per "manifest" request, and files compared per "digests" request
+    PAGE_SIZE = 10000
+    DIGESTS_BATCH = 1000
+    # Changes sent per window: the walk is paused while a window is sent, so at most CHANGES_WINDOW changes are kept
+    # in memory (the priority order applies within a window)
+    CHANGES_WINDOW = 16384
+
+    def remote_manifest(self, connection: SyncConnection):
+        """
+        Requests the server manifest page by page, while it is merged with folder1.
+        :return: generator of (path, RemoteEntry), in the order of walk_tree()
+        """
+        request = {"op": "manifest", "page": self.PAGE_SIZE}
+        while True:
+            header, data = connection.request(request)
+            for relpath, is_dir, size, mtime_ns in json.loads(data):
+                yield relpath, RemoteEntry(is_dir, size, mtime_ns)
+            if not header["more"]:
+                return
+            request = {**request, "continue": True}
+
+    @staticmethod
+    def merge_manifests(local, remote):
+        """
+        Merge-joins the folder1 walk with the remote manifest, both in the order of walk_tree().
+        :param local: generator of (path, os.stat() result or None for a folder)
+        :param remote: generator of (path, RemoteEntry)
+        :return: generator of (path, True if path is in folder1, os.stat() result or None, RemoteEntry or None)
+        """
+        local_item, remote_item = next(local, None), next(remote, None)
+        while local_item or remote_item:
+            local_key = local_item[0].split(os.sep) if local_item else None
+            remote_key = remote_item[0].split(os.sep) if remote_item else None
+            if remote_key is None or (local_key is not None and local_key < remote_key):
+                yield local_item[0], True, local_item[1], None
+                local_item = next(local, None)
+            elif local_key is None or remote_key < local_key:
+                yield remote_item[0], False, None, remote_item[1]
+                remote_item = next(remote, None)
+            else:
+                yield local_item[0], True, local_item[1], remote_item[1]
+                local_item, remote_item = next(local, None), next(remote, None)
+
+    def compare_digests(self, connection: SyncConnection, folder_sync, files: list) -> list:
+        """
+        Compares folder1 files with the digests of their remote versions, computed by the server.
+        :param files: list of (path, os.stat() result)
+        :return: the changed files, as (path, os.stat() result, True)
+        """
+        response, _ = connection.request({"op": "digests", "algorithm": folder_sync.hash_engine.algorithm},
+                                         json.dumps([relpath for relpath, _ in files]).encode())
+        changed = []
+        for (relpath, stat_result), remote_digest in zip(files, response["digests"]):
+            different = folder_sync.file_digest(os.path.join(folder_sync.folder1, relpath), stat_result) != remote_digest
+            folder_sync.count_tier("hash", different)
+            if different:
+                changed.append((relpath, stat_result, True))
+        return changed
+
+    def sync(self, folder_sync, planned=None) -> None:
+        """
+        Syncs the remote folder from folder_sync.folder1. folder1 is walked while the server manifest is received
+        page by page, the files are compared in batches and the changes are sent in windows of CHANGES_WINDOW, so the
+        memory used does not depend on the tree size. The changes are behind the walk of the server, so they are not
+        listed again in its manifest.
+        :param folder_sync: FolderSync object, which provides folder1, its digests and the sync options
+        :param planned: dry run: function called with every action, as (kind, path), instead of applying it
+        :return: None
+        """
+        import socket
+        folder1 = folder_sync.folder1
+        planner = folder_sync.planner()
+        path_filter = planner.path_filter
+        with socket.create_connection(self.address) as sock:
+            connection = self.connect(sock)
+
+            # Entries removed from folder1, or replaced by an entry of another type; changed files, as (path,
+            # os.stat() result, True if the remote file could be patched with a delta)
+            removed, mkdirs, changed, to_compare = [], [], [], []
+            # Remote folder whose content is skipped: removed with it, or excluded
+            skipped = None
+            merged = self.merge_manifests(walk_tree(folder1, path_filter), self.remote_manifest(connection))
+            for relpath, in_local, stat_result, entry in folder_sync.metrics.timed("walk", merged):
+                if len(removed) + len(mkdirs) + len(changed) >= self.CHANGES_WINDOW:
+                    self.send_changes(connection, folder_sync, removed, mkdirs, changed, planned)
+                    removed, mkdirs, changed = [], [], []
+                if not in_local:
+                    if skipped and relpath.startswith(skipped + os.sep):
+                        continue
+                    # Excluded remote paths are left alone
+                    if not path_filter.excluded(relpath, entry.is_dir):
+                        removed.append(relpath)
+                    skipped = relpath if entry.is_dir else None
+                    continue
+                if entry and entry.is_dir != (stat_result is None):
+                    removed.append(relpath)
+                    skipped = relpath if entry.is_dir else None
+                    entry = None
+                if stat_result is None:
+                    if entry is None:
+                        mkdirs.append(relpath)
+                    continue
+                folder_sync.metrics.add("files_scanned")
+                if entry is None:
+                    folder_sync.count_tier("missing", True)
+                    changed.append((relpath, stat_result, False))
+                    continue
+                decision = planner.compare_stats(stat_result, entry)
+                if decision is None:
+                    to_compare.append((relpath, stat_result))
+                    if len(to_compare) >= self.DIGESTS_BATCH:
+                        changed += self.compare_digests(connection, folder_sync, to_compare)
+                        to_compare = []
+                else:
+                    folder_sync.count_tier(*decision)
+                    if decision[1]:
+                        changed.append((relpath, stat_result, True))
+            if to_compare:
+                changed += self.compare_digests(connection, folder_sync, to_compare)
+            self.send_changes(connection, folder_sync, removed, mkdirs, changed, planned)
+            connection.send({"op": "bye"})
+
+    def send_changes(self, connection: SyncConnection, folder_sync, removed: list, mkdirs: list, changed: list,
+                     planned=None) -> None:
+        """
+        Sends a window of changes, in walk order within every kind: deletes, then folders, then files. The requests
+        are pipelined, and all their acknowledgements are read before the walk goes on.
+        :param removed: paths to remove
+        :param mkdirs: folders to create
+        :param changed: changed files, as (path, os.stat() result, True if the remote file could be patched)
+        :param planned: dry run: function called with every change, as (kind, path), instead of sending it
+        :return: None
+        """
+        if planned:
+            for kind, relpaths in (("delete", removed), ("mkdir", mkdirs),
+                                   ("update", [relpath for relpath, _, _ in changed])):
+                for relpath in relpaths:
+                    planned(kind, f"{self.url}/{relpath}")
+            return
+        # Block deltas need the server signature first, so they are not pipelined
+        pipelined, deltas = [], []
+        for relpath, stat_result, patchable in changed:
+            if folder_sync.delta and patchable and stat_result.st_size >= folder_sync.delta.threshold:
+                deltas.append((relpath, stat_result))
+            else:
+                pipelined.append((relpath, stat_result))
+        if folder_sync.priority:
+            # Priority order, the files of the background lane and the deltas (large files) last
+            pipelined.sort(key=lambda item: (bool(folder_sync.background_size) and
+                                             item[1].st_size >= folder_sync.background_size,
+                                             folder_sync.copy_priority(*item)))
+        else:
+            for relpath, stat_result in deltas:
+                self.send_delta(connection, folder_sync, relpath, stat_result)
+            deltas = []
+
+        requests = len(removed) + len(mkdirs) + len(pipelined)
+        acknowledgements = threading.Thread(target=self.read_acknowledgements,
+                                            args=(connection, requests, folder_sync.metrics))
+        acknowledgements.start()
+        metrics = folder_sync.metrics
+        with metrics.measure("delete"):
+            for relpath in removed:
+                logger.log(FILE_EVENT, "Remove [%s] from [%s].", relpath, self.url)
+                connection.send({"op": "delete", "path": relpath})
+        metrics.add("deletes", len(removed))
+        for relpath in mkdirs:
+            logger.log(FILE_EVENT, "Creating folder [%s] in [%s]", relpath, self.url)
+            connection.send({"op": "mkdir", "path": relpath})
+        metrics.add("folders_created", len(mkdirs))
+        for relpath, stat_result in pipelined:
+            logger.log(FILE_EVENT, "Sync file [%s] to [%s].", relpath, self.url)
+            with metrics.measure("copy", "copy"):
+                connection.send(self.file_header("put", folder_sync, relpath, stat_result))
+                connection.send_file(os.path.join(folder_sync.folder1, relpath), folder_sync.throttle)
+            metrics.add("files_copied")
+            metrics.add("bytes_copied", stat_result.st_size)
+        acknowledgements.join()
+        for relpath, stat_result in deltas:
+            self.send_delta(connection, folder_sync, relpath, stat_result)
+
+    @staticmethod
+    def file_header(op: str, folder_sync, relpath: str, stat_result: os.stat_result) -> dict:
+        file1_path = os.path.join(folder_sync.folder1, relpath)
+        return {"op": op, "path": relpath, "mode": stat.S_IMODE(stat_result.st_mode),
+                "mtime_ns": stat_result.st_mtime_ns, "algorithm": folder_sync.hash_engine.algorithm,
+                "digest": folder_sync.cached_digest(file1_path, stat_result)}
+
+    def send_delta(self, connection: SyncConnection, folder_sync, relpath: str, stat_result: os.stat_result) -> None:
+        """
+        Sends a big changed file as a block delta against the signature of its remote version.
+        """
+        with folder_sync.metrics.measure("copy", "copy"):
+            literal = self.send_patch(connection, folder_sync, relpath, stat_result)
+        folder_sync.metrics.add("files_copied")
+        folder_sync.metrics.add("bytes_copied", literal)
+        logger.log(FILE_EVENT, "Delta update of [%s] in [%s]: %d bytes sent.", relpath, self.url, literal)
+
+    def send_patch(self, connection: SyncConnection, folder_sync, relpath: str, stat_result: os.stat_result) -> int:
+        file1_path = os.path.join(folder_sync.folder1, relpath)
+        block_size = DeltaTransfer.block_size_for(stat_result.st_size)
+        _, data = connection.request({"op": "signature", "path": relpath, "block_size": block_size})
+        signature = {}
+        for weak, strong, offset in json.loads(data):
+            signature.setdefault(weak, {})[bytes.fromhex(strong)] = offset
+        operations = folder_sync.delta.delta(file1_path, signature, block_size)
+        connection.send(self.file_header("patch", folder_sync, relpath, stat_result),
+                        json.dumps([(kind, offset if kind == "copy" else 0, length)
+                                    for kind, offset, length in operations]).encode())
+        literal = 0
+        with open(file1_path, 'rb') as file:
+            for kind, offset, length in operations:
+                if kind != "data":
+                    continue
+                literal += length
+                file.seek(offset)
+                while length > 0 and (chunk := file.read(min(length, SyncConnection.CHUNK_SIZE))):
+                    connection.send({"op": "data"}, chunk)
+                    length -= len(chunk)
+        connection.send({"op": "end"})
+        response, _ = connection.receive()
+        if response is None or "error" in response:
+            raise OSError(f"Delta update of [{relpath}] in [{self.url}] failed")
+        return literal
+
+    def read_acknowledgements(self, connection: SyncConnection, count: int, metrics: SyncMetrics) -> None:
+        for _ in range(count):
+            response, _ = connection.receive()
+            if response is None:
+                logger.error(f"Connection to [{self.url}] closed before all requests were acknowledged")
+                metrics.add("errors")
+                return
+            if "error" in response:
+                metrics.fail(f"{self.url}/{response.get('path')}", response["error"])
+
+
+class SnapshotStore:
+    """
+    Snapshot target, given as snapshot://path: every sync records folder1 as a snapshot instead of mirroring it.
+    Files are split into content-defined chunks, each unique chunk being stored once, compressed, in
+    path/chunks/<id[:2]>/<id> (its id is its BLAKE2b digest); a snapshot is a manifest, path/snapshots/<id>.jsonl.gz,
+    listing the folders and files of folder1 in the order of walk_tree(), with the chunks of every file.
+    A sync is incremental: folder1 is merge-joined with the last snapshot manifest, the files whose size and mtime did
+    not change reuse their chunks without being read, and only the new chunks of the changed files are written. An
+    insertion in a file only changes the chunks around it: chunk boundaries depend on the content, not on offsets.
+    """
+    # Chunk sizes: a boundary follows the first run of ANCHOR_RUN anchor bytes (about half the byte values, set by
+    # ANCHOR_TABLE) after MIN_CHUNK bytes, found with a regular expression on the translated bytes; in random data,
+    # about 512 KB after MIN_CHUNK (chunks of about 768 KB). The table never changes, so the same content is always
+    # split the same way.
+    MIN_CHUNK = 256 * 1024
+    MAX_CHUNK = 4 * 1048576
+    ANCHOR_RUN = 18
+    ANCHOR_TABLE = bytes(hashlib.sha256(bytes([byte])).digest()[0] & 1 for byte in range(256))
+    ANCHOR = re.compile(b"\x01{%d}" % ANCHOR_RUN)
+    READ_SIZE = 2 * MAX_CHUNK
+    # First byte of a chunk file: compression of the rest of the file
+    FORMATS = {"none": b"n", "zlib": b"z", "zstd": b"s"}
+
+    def __init__(self, url: str, compression: str = "zlib", throttle: IOThrottle | None = None, fsync: bool = True):
+        """
+        :param url: snapshot://path, or the store path
+        :param compression: compression of the chunks, "none", "zlib" or "zstd"
+        """
+        self.url = url
+        self.path = url[len("snapshot://"):] if self.is_snapshot(url) else url
+        self.compression = compression
+        self.throttle = throttle or IOThrottle()
+        self.fsync = fsync
+
+    @staticmethod
+    def is_snapshot(folder: str) -> bool:
+        return folder.startswith("snapshot://")
+
+    def chunk_path(self, chunk_id: str) -> str:
+        return os.path.join(self.path, "chunks", chunk_id[:2], chunk_id)
+
+    def manifest_path(self, snapshot_id: str) -> str:
+        return os.path.join(self.path, "snapshots", f"{snapshot_id}.jsonl.gz")
+
+    def snapshot_ids(self) -> list:
+        """
+        :return: ids of the snapshots of the store, the oldest first
+        """
+        try:
+            names = os.listdir(os.path.join(self.path, "snapshots"))
+        except FileNotFoundError:
+            return []
+        return sorted(name[:-len(".jsonl.gz")] for name in names if name.endswith(".jsonl.gz"))
+
+    def summary(self, snapshot_id: str) -> dict:
+        """
+        :return: totals of a snapshot, recorded when it was completed
+        """
+        with open(os.path.join(self.path, "snapshots", f"{snapshot_id}.json"), encoding="utf-8") as file:
+            return json.load(file)
+
+    def read_manifest(self, snapshot_id: str):
+        """
+        :return: generator of the entries of a snapshot, in the order of walk_tree(): dicts with path, mode and
+                 mtime_ns, and dir True for folders, or size and chunks for files
+        """
+        import gzip
+        if snapshot_id not in self.snapshot_ids():
+            raise ValueError(f"Snapshot [{snapshot_id}] not found in [{self.path}]")
+        with gzip.open(self.manifest_path(snapshot_id), "rt", encoding="utf-8") as file:
+            next(file)  # header
+            for line in file:
+                yield json.loads(line)
+
+    @classmethod
+    def cut_point(cls, data) -> int:
+        """
+        :param data: bytes starting at a chunk boundary
+        :return: size of the chunk starting data
+        """
+        if len(data) <= cls.MIN_CHUNK:
+            return len(data)
+        # The anchor run must end after MIN_CHUNK bytes, so it may start before
+        start = cls.MIN_CHUNK - cls.ANCHOR_RUN
+        match = cls.ANCHOR.search(data[start:cls.MAX_CHUNK].translate(cls.ANCHOR_TABLE))
+        return start + match.end() if match else min(len(data), cls.MAX_CHUNK)
+
+    def chunks(self, file):
+        """
+        :param file: file open for binary reading
+        :return: generator of the chunks of the file content
+        """
+        buffer, remaining = b"", os.fstat(file.fileno()).st_size
+        while True:
+            with self.throttle.io(read=min(self.READ_SIZE, max(remaining, 0))):
+                data = file.read(self.READ_SIZE)
+            remaining -= len(data)
+            buffer = buffer + data if buffer else data
+            while len(buffer) >= self.MAX_CHUNK or (buffer and not data):
+                size = self.cut_point(buffer)
+                yield buffer[:size]
+                buffer = buffer[size:]
+            if not data:
+                return
+
+    def put_chunk(self, data: bytes) -> tuple:
+        """
+        Stores a chunk, unless the store already has it.
+        :return: (chunk id, bytes written to the store, 0 if the chunk was already stored)
+        """
+        import zlib
+        chunk_id = hashlib.blake2b(data, digest_size=32).hexdigest()
+        path = self.chunk_path(chunk_id)
+        if os.path.exists(path):
+            return chunk_id, 0
+        compression = self.compression
+        if compression == "zstd":
+            import zstandard
+            packed = zstandard.ZstdCompressor().compress(data)
+        elif compression == "zlib":
+            packed = zlib.compress(data, 6)
+        if compression == "none" or len(packed) >= len(data):
+            compression, packed = "none", data
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # Chunks are written once and never modified: a temporary file per thread is renamed into place
+        tmp_path = f"{path}.{threading.get_ident()}{TEMP_SUFFIX}"
+        with self.throttle.io(write=len(packed) + 1, ops=2), open(tmp_path, 'wb') as file:
+            file.write(self.FORMATS[compression])
+            file.write(packed)
+            if self.fsync:
+                file.flush()
+                os.fsync(file.fileno())
+        os.replace(tmp_path, path)
+        return chunk_id, len(packed) + 1
+
+    def get_chunk(self, chunk_id: str) -> bytes:
+        """
+        :return: content of a chunk, checked against its id
+        """
+        import zlib
+        path = self.chunk_path(chunk_id)
+        with self.throttle.io(read=os.path.getsize(path), ops=1), open(path, 'rb') as file:
+            packed = file.read()
+        compression = {tag: name for name, tag in self.FORMATS.items()}[packed[:1]]
+        if compression == "zstd":
+            import zstandard
+            data = zstandard.ZstdDecompressor().decompress(packed[1:])
+        elif compression == "zlib":
+            data = zlib.decompress(packed[1:])
+        else:
+            data = packed[1:]
+        if hashlib.blake2b(data, digest_size=32).hexdigest() != chunk_id:
+            raise ValueError(f"Chunk [{chunk_id}] of [{self.path}] is corrupted")
+        return data
+
+    def store_file(self, file_path: str, metrics: SyncMetrics) -> list:
+        """
+        Splits a file into chunks and stores the new ones.
+        :return: ids of the chunks of the file
+        """
+        chunk_ids = []
+        with metrics.measure("copy", "copy"), open(file_path, 'rb') as file:
+            for chunk in self.chunks(file):
+                chunk_id, written = self.put_chunk(chunk)
+                chunk_ids.append(chunk_id)
+                metrics.add("bytes_copied", written)
+        metrics.add("files_copied")
+        return chunk_ids
+
+    def new_snapshot_id(self) -> str:
+        snapshot_id = time.strftime("%Y%m%dT%H%M%SZ", time.gmtime())
+        existing, suffix = set(self.snapshot_ids()), 1
+        while (snapshot_id if suffix == 1 else f"{snapshot_id}-{suffix}") in existing:
+            suffix += 1
+        return snapshot_id if suffix == 1 else f"{snapshot_id}-{suffix}"
+
+    @staticmethod
+    def unchanged(entry: dict | None, stat_result: os.stat_result) -> bool:
+        """
+        :return: True if a folder1 file has the size and mtime of its entry in the last snapshot
+        """
+        return entry is not None and not entry.get("dir") and entry["size"] == stat_result.st_size and \
+            entry["mtime_ns"] == stat_result.st_mtime_ns
+
+    def sync(self, folder_sync, planned=None) -> str | None:
+        """
+        Records a snapshot of folder_sync.folder1. Changed files are chunked by the workers of folder_sync (those of
+        the shared pool, in daemon mode) while folder1 is walked, at most 2 * workers files ahead of the manifest,
+        which is written in walk order and renamed into place once complete, so only complete snapshots are listed.
+        :param folder_sync: FolderSync object, which provides folder1 and the sync options
+        :param planned: dry run: function called with every file which would be chunked, as ("snapshot", path),
+                        instead of recording a snapshot
+        :return: id of the new snapshot, None for a dry run
+        """
+        import gzip
+        folder1, metrics = folder_sync.folder1, folder_sync.metrics
+        ids = self.snapshot_ids()
+        previous = ((entry["path"], entry) for entry in self.read_manifest(ids[-1])) if ids else iter(())
+        merged = RemoteDestination.merge_manifests(walk_tree(folder1, folder_sync.planner().path_filter), previous)
+        if planned:
+            for relpath, in_local, stat_result, entry in merged:
+                if in_local and stat_result is not None and not self.unchanged(entry, stat_result):
+                    planned("snapshot", f"{self.url}/{relpath}")
+            return None
+
+        snapshot_id = self.new_snapshot_id()
+        tmp_path = self.manifest_path(snapshot_id) + TEMP_SUFFIX
+        os.makedirs(os.path.dirname(tmp_path), exist_ok=True)
+        totals = {"files": 0, "folders": 0, "bytes": 0}
+        written = metrics.counters["bytes_copied"]
+        # (manifest entry, chunk ids or future of the chunk ids of a file being stored, None for a folder)
+        pending = deque()
+
+        def store(path: str, chunks: Future) -> None:
+            try:
+                chunks.set_result(self.store_file(path, metrics))
+            except Exception as exception:
+                chunks.set_exception(exception)
+
+        def write_entries(limit: int) -> None:
+            while len(pending) > limit:
+                entry, chunks = pending.popleft()
+                if chunks is not None:
+                    try:
+                        entry["chunks"] = chunks if isinstance(chunks, list) else chunks.result()
+                    except Exception as exception:
+                        # The file is left out of the snapshot
+                        metrics.fail(entry["path"], exception)
+                        continue
+                    totals["files"] += 1
+                manifest.write(json.dumps(entry) + "\n")
+
+        with gzip.open(tmp_path, "wt", encoding="utf-8") as manifest, \
+                folder_sync.executor(2 * folder_sync.workers) as executor:
+            manifest.write(json.dumps({"snapshot": snapshot_id, "source": os.path.abspath(folder1),
+                                       "created": datetime.now().isoformat()}) + "\n")
+            for relpath, in_local, stat_result, entry in metrics.timed("walk", merged):
+                if not in_local:
+                    continue
+                path = os.path.join(folder1, relpath)
+                if stat_result is None:
+                    folder_stat = os.stat(path)
+                    totals["folders"] += 1
+                    pending.append(({"path": relpath, "dir": True, "mode": stat.S_IMODE(folder_stat.st_mode),
+                                     "mtime_ns": folder_stat.st_mtime_ns}, None))
+                else:
+                    metrics.add("files_scanned")
+                    totals["bytes"] += stat_result.st_size
+                    record = {"path": relpath, "mode": stat.S_IMODE(stat_result.st_mode),
+                              "mtime_ns": stat_result.st_mtime_ns, "size": stat_result.st_size}
+                    if self.unchanged(entry, stat_result):
+                        folder_sync.count_tier("mtime", False)
+                        pending.append((record, entry["chunks"]))
+                    else:
+                        folder_sync.count_tier("missing" if entry is None else "mtime", True)
+                        chunks = Future()
+                        executor.submit(store, path, chunks)
+                        pending.append((record, chunks))
+                write_entries(2 * folder_sync.workers)
+            write_entries(0)
+        totals["bytes_written"] = metrics.counters["bytes_copied"] - written
+        if self.fsync:
+            with open(tmp_path, 'rb') as file:
+                os.fsync(file.fileno())
+        os.replace(tmp_path, self.manifest_path(snapshot_id))
+        with open(os.path.join(self.path, "snapshots", f"{snapshot_id}.json"), "w", encoding="utf-8") as file:
+            json.dump({"snapshot": snapshot_id, "source": os.path.abspath(folder1),
+                       "created": datetime.now().isoformat(), **totals}, file)
+        logger.info(f"Snapshot [{snapshot_id}] of [{folder1}] stored in [{self.path}]: {totals['files']} files "
+                    f"({totals['bytes']} bytes), {totals['bytes_written']} bytes of new chunks written.")
+        return snapshot_id
+
+    def restore(self, snapshot_id: str, target: str, prefix: str = "") -> int:
+        """
+        Restores the files and folders of a snapshot into target. Files are written to a temporary file renamed into
+        place, with their mode and mtime; folders get their mode and mtime once their content is restored.
+        :param snapshot_id: id of the snapshot
+        :param target: folder restored into
+        :param prefix: restore only this path of the snapshot (a file, or a folder with its content)
+        :return: number of files restored
+        """
+        prefix = prefix.strip(os.sep)
+        restored, folders = 0, []
+        os.makedirs(target, exist_ok=True)
+        for entry in self.read_manifest(snapshot_id):
+            relpath = entry["path"]
+            if prefix and relpath != prefix and not relpath.startswith(prefix + os.sep):
+                continue
+            path = os.path.join(target, relpath)
+            # Folders are completed once the walk leaves them, the deepest first
+            while folders and not relpath.startswith(folders[-1][0] + os.sep):
+                self.complete_folder(target, folders.pop())
+            if entry.get("dir"):
+                os.makedirs(path, exist_ok=True)
+                folders.append((relpath, entry))
+                continue
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            tmp_path = path + TEMP_SUFFIX
+            with open(tmp_path, 'wb') as file:
+                for chunk_id in entry["chunks"]:
+                    data = self.get_chunk(chunk_id)
+                    with self.throttle.io(write=len(data)):
+                        file.write(data)
+                if self.fsync:
+                    file.flush()
+                    os.fsync(file.fileno())
+            os.chmod(tmp_path, entry["mode"])
+            os.utime(tmp_path, ns=(entry["mtime_ns"], entry["mtime_ns"]))
+            os.replace(tmp_path, path)
+            logger.log(FILE_EVENT, "Restored file [%s] from snapshot [%s].", relpath, snapshot_id)
+            restored += 1
+        while folders:
+            self.complete_folder(target, folders.pop())
+        return restored
+
+    @staticmethod
+    def complete_folder(target: str, folder: tuple) -> None:
+        relpath, entry = folder
+        path = os.path.join(target, relpath)
+        os.chmod(path, entry["mode"])
+        os.utime(path, ns=(entry["mtime_ns"], entry["mtime_ns"]))
+
+
+class FixedRateSchedule:
+    """
+    Runs at start + k * interval. The times do not depend on the sync duration, so the period does not drift; the
+    times which passed while a sync was running are skipped.
+    """
+
+    def __init__(self, interval: timedelta, start: datetime | None = None):
+        self.interval = interval
+        self.start = start or datetime.now()
+
+    def next_run(self, after: datetime) -> datetime:
+        """
+        :param after: reference time
+        :return: first time of the schedule after the reference time
+        """
+        if after < self.start:
+            return self.start
+        return self.start + ((after - self.start) // self.interval + 1) * self.interval
+
+    def __str__(self) -> str:
+        return f"every {self.interval}"
+
+
+class CronSchedule:
+    """
+    Cron expression with 5 fields: minute, hour, day of month, month, day of week (0 or 7 is Sunday).
+    Every field is '*' or a list of values, ranges (1-5) and steps (*/15, 8-18/2); months and days of week could also
+    be given by name (jan, mon). Like cron, when both day fields are restricted, a day matching any of them is run.
+    """
+    FIELDS = (("minute", 0, 59), ("hour", 0, 23), ("day", 1, 31), ("month", 1, 12), ("weekday", 0, 7))
+    NAMES = {
+        "month": ["jan", "feb", "mar", "apr", "may", "jun", "jul", "aug", "sep", "oct", "nov", "dec"],
+        "weekday": ["sun", "mon", "tue", "wed", "thu", "fri", "sat"],
+    }
+    ALIASES = {"@hourly": "0 * * * *", "@daily": "0 0 * * *", "@weekly": "0 0 * * 0", "@monthly": "0 0 1 * *",
+               "@yearly": "0 0 1 1 *"}
+    # A schedule without a run in this many days is invalid (e.g. February 30)
+    MAX_DAYS = 5 * 366
+
+    def __init__(self, expression: str):
+        self.expression = expression
+        fields = self.ALIASES.get(expression.strip(), expression).split()
+        if len(fields) != len(self.FIELDS):
+            raise ValueError(f"Cron expression [{expression}] must have 5 fields: minute hour day month weekday")
+        self.minutes, self.hours, self.days, self.months, weekdays = (
+            self.parse_field(text, *field) for text, field in zip(fields, self.FIELDS))
+        # 7 is Sunday too
+        self.weekdays = {weekday % 7 for weekday in weekdays}
+        self.any_day, self.any_weekday = fields[2] == "*", fields[4] == "*"
+        self.next_run(datetime.now())
+
+    @classmethod
+    def parse_field(cls, text: str, name: str, minimum: int, maximum: int) -> set:
+        """
+        :param text: field of the cron expression
+        :param name: field name
+        :param minimum: smallest value of the field
+        :param maximum: biggest value of the field
+        :return: set of the values matched by the field
+        """
+        def value(word):
+            if word in cls.NAMES.get(name, []):
+                return cls.NAMES[name].index(word) + (1 if name == "month" else 0)
+            number = int(word)
+            if not minimum <= number <= maximum:
+                raise ValueError(f"Cron {name} value [{word}] is not in [{minimum}, {maximum}]")
+            return number
+
+        values = set()
+        for part in text.lower().split(","):
+            part, _, step = part.partition("/")
+            if part == "*":
+                start, end = minimum, maximum
+            elif "-" in part:
+                start, end = (value(word) for word in part.split("-", 1))
+            else:
+                start = value(part)
+                end = maximum if step else start
+            if start > end or (step and int(step) < 1):
+                raise ValueError(f"Cron {name} field [{text}] is not valid")
+            values.update(range(start, end + 1, int(step) if step else 1))
+        return values
+
+    def day_matches(self, day: date) -> bool:
+        day_match = day.day in self.days
+        # Cron counts the days of week from Sunday
+        weekday_match = (day.weekday() + 1) % 7 in self.weekdays
+        if self.any_day or self.any_weekday:
+            return day_match and weekday_match
+        return day_match or weekday_match
+
+    def next_run(self, after: datetime) -> datetime:
+        """
+        :param after: reference time
+        :return: first time of the schedule after the reference time
+        """
+        candidate = after.replace(second=0, microsecond=0) + timedelta(minutes=1)
+        last_day = candidate + timedelta(days=self.MAX_DAYS)
+        while candidate < last_day:
+            if candidate.month not in self.months or not self.day_matches(candidate):
+                candidate = candidate.replace(hour=0, minute=0) + timedelta(days=1)
+            elif candidate.hour not in self.hours:
+                candidate = candidate.replace(minute=0) + timedelta(hours=1)
+            elif candidate.minute not in self.minutes:
+                candidate += timedelta(minutes=1)
+            else:
+                return candidate
+        raise ValueError(f"Cron expression [{self.expression}] has no run in the next {self.MAX_DAYS} days")
+
+    def __str__(self) -> str:
+        return f"cron '{self.expression}'"
+
+
+class SyncScheduler:
+    """
+    Runs the sync passes of a FolderSync in a single thread: at the times of a schedule and whenever trigger() is
+    called (e.g. by the console 'sync' command). Triggers do not wait for the sync: they are queued and all the
+    triggers received before a pass starts (or while one is running) are coalesced into one pass. Scheduled times
+    which passed while a sync was running are skipped.
+    """
+
+    def __init__(self, run, schedule=None, run_at_start: bool = False):
+        """
+        :param run: function which runs a sync pass, called with the set of trigger reasons
+        :param schedule: FixedRateSchedule, CronSchedule or None for triggered syncs only
+        :param run_at_start: run a pass as soon as the scheduler starts
+        """
+        self.run = run
+        self.schedule = schedule
+        self.condition = threading.Condition()
+        self.pending = {"start"} if run_at_start else set()
+        self.next_run = None
+        self.stopped = False
+
+    def trigger(self, reason: str = "manual") -> bool:
+        """
+        Queues a sync pass.
+        :param reason: why the pass is needed (logged)
+        :return: False if it was coalesced with a pass which is already queued
+        """
+        with self.condition:
+            coalesced = bool(self.pending)
+            self.pending.add(reason)
+            self.condition.notify()
+        if coalesced:
+            logger.info(f"Sync trigger [{reason}] coalesced with the queued sync")
+        return not coalesced
+
+    def stop(self) -> None:
+        with self.condition:
+            self.stopped = True
+            self.condition.notify()
+
+    def wait_for_trigger(self) -> set | None:
+        """
+        Waits until a pass is triggered or scheduled.
+        :return: set of trigger reasons, or None if the scheduler was stopped
+        """
+        with self.condition:
+            while not self.pending and not self.stopped:
+                timeout = None
+                if self.next_run:
+                    timeout = (self.next_run - datetime.now()).total_seconds()
+                    if timeout <= 0:
+                        self.pending.add("schedule")
+                        self.next_run = self.schedule.next_run(self.next_run)
+                        break
+                self.condition.wait(timeout)
+            if self.stopped:
+                return None
+            reasons, self.pending = self.pending, set()
+            return reasons
+
+    def run_forever(self) -> None:
+        if self.schedule:
+            self.next_run = self.schedule.next_run(datetime.now())
+            logger.info(f"Sync scheduled {self.schedule}, next sync at {self.next_run}")
+        while (reasons := self.wait_for_trigger()) is not None:
+            try:
+                self.run(reasons)
+            except Exception as exception:
+                # A failed pass does not stop the scheduler: the next pass runs (and resumes it) as scheduled
+                logger.exception(exception)
+            if self.next_run:
+                now = datetime.now()
+                if self.next_run <= now:
+                    # Skip if running: the scheduled times which passed during the sync are not run late
+                    next_run = self.schedule.next_run(now)
+                    logger.warning(f"Scheduled sync at {self.next_run} skipped, the previous sync was still running")
+                    self.next_run = next_run
+                logger.info(f"Next sync at {self.next_run}")
+
+
+class Scrubber:
     """
-    Used to create a custom logger object.
-    :param filename: name of the file where logs are saved
-    :return: logging.Logger object
+    Low-priority integrity scrub of the local destinations of a FolderSync: destination files whose metadata matches
+    their folder1 file (so the syncs skip them) are read again and their digest compared with the folder1 digest, to
+    detect silent corruption; a mismatching file is repaired by copying the folder1 file over it.
+    The files are visited in walk order, reading at most budget bytes per hour (folder1 files whose digest is not in
+    the index count too), and every verification is recorded in the index: a file is verified again once period
+    passed since its last verification, so the whole tree is covered every period while the budget allows it. An
+    interrupted scrub pass resumes where it stopped, as the verified files are not due yet.
     """
-    logging.addLevelName(logging.INFO, "I")
-    logging.addLevelName(logging.WARNING, "W")
+    BUFFER_SIZE = 1048576
+    # Wait between the scrub passes, when no file is due
+    IDLE = timedelta(minutes=10)
+
+    def __init__(self, folder_sync, budget: int, period: timedelta):
+        """
+        :param folder_sync: FolderSync object, whose destinations are scrubbed; it must have an index
+        :param budget: bytes read per hour
+        :param period: a file is verified once per period
+        """
+        self.folder_sync = folder_sync
+        self.budget = budget
+        self.period = period
+        # Paces the reads at budget bytes per hour, on top of the I/O limits shared with the syncs
+        self.bucket = TokenBucket(budget / 3600)
+        self.stopped = threading.Event()
+        self.counters = Counter()
+        self.thread = None
+
+    def start(self) -> threading.Thread:
+        self.thread = threading.Thread(target=self.run_forever, daemon=True)
+        self.thread.start()
+        return self.thread
+
+    def stop(self) -> None:
+        """
+        Stops the scrub and waits for its thread (a file being read is abandoned), so the index could be closed.
+        """
+        self.stopped.set()
+        if self.thread is not None:
+            self.thread.join()
 
-    logging.basicConfig(
-        filename=filename,
-        encoding="utf-8",
-        filemode="a",
-        datefmt="%y-%m-%d %H:%M:%S",
-        format="[{asctime}][{levelname}] {message} - {funcName}",
-        style="{",
-        level=logging.INFO,
-    )
-    return logging.getLogger()
+    def run_forever(self) -> None:
+        if hasattr(os, "setpriority") and sys.platform.startswith("linux"):
+            # On Linux the nice value is per thread, and the I/O scheduler priority follows it
+            os.setpriority(os.PRIO_PROCESS, threading.get_native_id(), 19)
+        while not self.stopped.is_set():
+            started = time.monotonic()
+            try:
+                self.scrub_pass()
+            except Exception as exception:
+                logger.error(f"Scrub of [{self.folder_sync.folder1}] failed: {exception}", exc_info=exception)
+            if time.monotonic() - started > self.period.total_seconds():
+                logger.warning(f"Scrub pass of [{self.folder_sync.folder1}] took longer than the scrub period: the "
+                               f"budget of {self.budget / 1048576:.0f} MB per hour is too low to cover the tree.")
+            self.stopped.wait(self.IDLE.total_seconds())
+
+    def scrub_pass(self) -> None:
+        """
+        Verifies the destination files which are due, in walk order.
+        :return: None
+        """
+        self.counters.clear()
+        folder_sync = self.folder_sync
+        for relpath, src_stat in walk_tree(folder_sync.folder1, folder_sync.planner().path_filter):
+            if self.stopped.is_set():
+                break
+            if src_stat is None:
+                continue
+            try:
+                self.scrub_file(relpath, src_stat)
+            except Exception as exception:
+                logger.error(f"Scrub of [{relpath}] failed: {exception}")
+                self.counters["errors"] += 1
+        folder_sync.index.commit()
+        if self.counters["files_verified"] or self.counters["errors"]:
+            logger.info(f"Scrub pass of [{folder_sync.folder1}]: {self.counters['files_verified']} files verified "
+                        f"({self.counters['bytes_verified']} bytes), {self.counters['repairs']} corrupted files "
+                        f"repaired, {self.counters['errors']} errors.")
+
+    def scrub_file(self, relpath: str, src_stat: os.stat_result) -> None:
+        """
+        Verifies the destination copies of a folder1 file which are due, and repairs the corrupted ones.
+        :param relpath: path of the file, relative to folder1
+        :param src_stat: os.stat() result of the folder1 file
+        :return: None
+        """
+        folder_sync, index = self.folder_sync, self.folder_sync.index
+        algorithm = folder_sync.hash_engine.algorithm
+        file1_path = os.path.join(folder_sync.folder1, relpath)
+        due_before = time.time() - self.period.total_seconds()
+        digest = None
+        for destination in folder_sync.destinations:
+            file2_path = os.path.join(destination, relpath)
+            try:
+                dst_stat = os.stat(file2_path)
+            except FileNotFoundError:
+                continue
+            # Files which differ in metadata are updated by the syncs
+            if dst_stat.st_size != src_stat.st_size or dst_stat.st_mtime_ns != src_stat.st_mtime_ns:
+                continue
+            verified_at = index.get_verified(os.path.abspath(file2_path), dst_stat, algorithm)
+            if verified_at is not None and verified_at > due_before:
+                continue
+            if digest is None:
+                digest = folder_sync.cached_digest(file1_path, src_stat)
+                if digest is None:
+                    digest = self.read_digest(file1_path)
+                    if digest is None:
+                        return
+                    folder_sync.store_digest(file1_path, src_stat, digest)
+            file2_digest = self.read_digest(file2_path)
+            if file2_digest is None:
+                return
+            self.counters["files_verified"] += 1
+            self.counters["bytes_verified"] += dst_stat.st_size
+            if file2_digest != digest:
+                self.repair(file1_path, file2_path, src_stat)
+                continue
+            index.set_verified(os.path.abspath(file2_path), dst_stat, digest, algorithm, time.time())
 
+    def read_digest(self, file_path: str) -> str | None:
+        """
+        :return: hash value of file_path, read from the disk (not from the index) within the scrub budget, or None if
+                 the scrub was stopped before the whole file was read
+        """
+        hasher = self.folder_sync.hash_engine.new_hasher()
+        buffer = memoryview(bytearray(self.BUFFER_SIZE))
+        throttle = self.folder_sync.throttle
+        with open(file_path, 'rb', buffering=0) as file:
+            remaining = os.fstat(file.fileno()).st_size
+            while True:
+                # Only the bytes left are charged, so a small file does not cost a whole buffer of budget
+                read_size = min(len(buffer), max(remaining, 0))
+                self.bucket.acquire(read_size, self.stopped)
+                if self.stopped.is_set():
+                    return None
+                with throttle.io(read=read_size):
+                    read_size = file.readinto(buffer)
+                if not read_size:
+                    break
+                hasher.update(buffer[:read_size])
+                remaining -= read_size
+        return hasher.hexdigest()
 
-logger = get_logger("folder_sync_logs.log")
+    def repair(self, file1_path: str, file2_path: str, src_stat: os.stat_result) -> None:
+        """
+        Replaces a corrupted destination file with the folder1 file, unless the folder1 file changed meanwhile (the
+        next sync updates it).
+        """
+        folder_sync = self.folder_sync
+        logger.warning(f"Scrub: [{file2_path}] does not match [{file1_path}], it is repaired.")
+        with folder_sync.sync_lock:
+            current = os.stat(file1_path)
+            if (current.st_size, current.st_mtime_ns) != (src_stat.st_size, src_stat.st_mtime_ns):
+                return
+            folder_sync.copier.copy(file1_path, file2_path)
+        self.counters["repairs"] += 1
+        folder_sync.index.remove(os.path.abspath(file2_path))
 
 
 class ParseArguments:
-    def __init__(self):
-        self.arguments = self.parse_arguments()
+    def __init__(self, argv: list | None = None):
+        """
+        :param argv: command line arguments, sys.argv[1:] by default
+        """
+        self.arguments = self.parse_arguments(argv)
 
     @staticmethod
     def check_interval(value, max_value) -> int:
@@ -77,7 +3792,19 @@ class ParseArguments:
         except ValueError:
             raise argparse.ArgumentTypeError("The time must be in 24-hour format 'HH:MM' (e.g. 19:45)")
 
-    def parse_arguments(self) -> argparse.Namespace:
+    @staticmethod
+    def check_cron(value) -> CronSchedule:
+        """
+        Create CronSchedule object from string value. Raise ArgumentTypeError if it is not a valid cron expression.
+        :param value: input string representing the cron expression
+        :return: CronSchedule object
+        """
+        try:
+            return CronSchedule(value)
+        except ValueError as exception:
+            raise argparse.ArgumentTypeError(str(exception))
+
+    def parse_arguments(self, argv: list | None = None) -> argparse.Namespace:
         """
         Used to create a small overview for new script users.
         Parse input arguments when the script is started. Every argument is checked based on particular constraints.
@@ -90,14 +3817,18 @@ class ParseArguments:
             Once the script was started, the synchronization could also be manually triggered, on-demand, before scheduled time or 
             between periodic intervals, at any time, by typing 'sync' in terminal.""",
             usage="""
-            python %(prog)s <folder1> <folder2> [-s SECONDS] [-m MINUTES] [-hr HOURS] [-d DAYS] [-t TIME] [-h].""",
+            python %(prog)s <folder1> <folder2> [<folder2> ...] [-s SECONDS] [-m MINUTES] [-hr HOURS] [-d DAYS] [-t TIME] [-h].""",
             epilog="""Examples:
-            - For Scheduled sync at 19:45, run: python %(prog)s /path/to/folder1 /path/to/folder2 -t 19:45
+            - For Scheduled sync every day at 19:45, run: python %(prog)s /path/to/folder1 /path/to/folder2 -t 19:45
             - For Periodic sync at every 3 hours 4 minutes and 5 seconds, run: python %(prog)s /path/to/folder1 /path/to/folder2 -hr 3 -m 4 -s 5""",
             formatter_class=argparse.RawTextHelpFormatter)
 
         parser.add_argument("folder1", type=str, help="First folder path")
-        parser.add_argument("folder2", type=str, help="Second folder path")
+        parser.add_argument("folder2", type=str, nargs="+",
+                            help="Second folder path. Several paths could be given, all of them are synced from\n"
+                                 "folder1, which is read only once. A folder served by 'serve' on another machine\n"
+                                 "is given as sync://host:port. A snapshot://<store> path records every sync as\n"
+                                 "a snapshot in a chunk store, see the 'snapshots' and 'restore' commands.")
         parser.add_argument("-s", "--seconds", type=lambda value: self.check_interval(value, max_value=60),
                             help="For periodic sync, specify the seconds interval value.")
         parser.add_argument("-m", "--minutes", type=lambda value: self.check_interval(value, max_value=60),
@@ -107,16 +3838,227 @@ class ParseArguments:
         parser.add_argument("-d", "--days", type=lambda value: self.check_interval(value, max_value=30),
                             help="For periodic sync, specify the days interval value.")
         parser.add_argument("-t", "--time", type=self.check_hour_format,
-                            help="For scheduled sync, specify the time in 24-hour format (e.g. 19:45).")
-        return parser.parse_args()
+                            help="For scheduled sync, specify the time in 24-hour format (e.g. 19:45). The sync runs\n"
+                                 "every day at this time (not only once, as in earlier versions); use --cron\n"
+                                 "for other schedules.")
+        parser.add_argument("--cron", type=self.check_cron, metavar="EXPRESSION",
+                            help="For scheduled sync, specify a cron expression: 'minute hour day month weekday'\n"
+                                 "(e.g. '*/30 8-18 * * mon-fri') or @hourly, @daily, @weekly, @monthly, @yearly.")
+        parser.add_argument("--index", type=str, default="folder_sync_index.db",
+                            help="SQLite file used to cache file digests between syncs (default: %(default)s).")
+        parser.add_argument("--no-index", action="store_true",
+                            help="Do not use the digest index; every compared file is hashed on every sync.")
+        parser.add_argument("--hash", choices=HashEngine.available_algorithms(), default="sha256",
+                            help="Hash algorithm used to compare files (default: %(default)s).")
+        parser.add_argument("--hash-processes", type=int, default=0, metavar="PROCESSES",
+                            help="Hash files in a pool of PROCESSES worker processes, for CPU-bound hashing.\n"
+                                 "By default files are hashed in threads.")
+        parser.add_argument("--delta-threshold", type=int, metavar="MB",
+                            help="Update changed files of at least MB megabytes with a block delta, writing only the\n"
+                                 "changed regions. By default changed files are copied in full.")
+        parser.add_argument("-w", "--watch", action="store_true",
+                            help="Linux only. Watch folder1 for changes and sync only the changed paths. Interval\n"
+                                 "params (-s, -m, -hr, -d) set the period of the full sync safety net (default 1h).")
+        parser.add_argument("--workers", type=int, default=min(32, (os.cpu_count() or 1) + 4),
+                            help="Number of worker threads which compare and copy files (default: %(default)s).")
+        parser.add_argument("--dry-run", action="store_true",
+                            help="Print the actions a sync would do, without changing folder2, and exit.")
+        parser.add_argument("--compress", choices=SyncConnection.available_compressions(), default="none",
+                            help="Compression of the data sent to sync:// folders (default: %(default)s).")
+        parser.add_argument("-c", "--compare", choices=FolderSync.COMPARE_TIERS, default="hash",
+                            help="Change detection strategy, cheapest checks first (default: %(default)s):\n"
+                                 "  hash   - size, then full digest\n"
+                                 "  quick  - size, then mtime (equal mtime means unchanged), then full digest\n"
+                                 "  sample - size, then mtime, then head/middle/tail digest, then full digest")
+        parser.add_argument("--read-limit", type=float, default=0, metavar="MB",
+                            help="Limit the disk reads of the sync to MB megabytes per second. The limits could be\n"
+                                 "changed while the script runs, with the 'limit' console command.")
+        parser.add_argument("--write-limit", type=float, default=0, metavar="MB",
+                            help="Limit the disk writes of the sync to MB megabytes per second.")
+        parser.add_argument("--ops-limit", type=float, default=0, metavar="OPS",
+                            help="Limit the file operations (open, list, remove, ...) to OPS per second.")
+        parser.add_argument("--latency-target", type=float, metavar="MS",
+                            help="Lower the limits while the I/O calls of the sync take more than MS milliseconds\n"
+                                 "on average (the disks are busy), and raise them back when they are faster.")
+        parser.add_argument("--report", type=str, metavar="FILE",
+                            help="Append the metrics of every sync (counters, phase times, per-file latency\n"
+                                 "histograms) to FILE, as one JSON object per line.")
+        parser.add_argument("--prometheus", type=str, metavar="FILE",
+                            help="Write the metrics of the last sync to FILE in Prometheus text format\n"
+                                 "(e.g. for the node_exporter textfile collector).")
+        parser.add_argument("--metrics-port", type=int, metavar="PORT",
+                            help="Serve the metrics of the last sync in Prometheus text format on PORT.")
+        parser.add_argument("--metrics-host", type=str, default=MetricsExporter.DEFAULT_HOST, metavar="HOST",
+                            help="Listening address of --metrics-port (default: %(default)s); e.g. 0.0.0.0 to be\n"
+                                 "scraped from other machines. The metrics are served without authentication.")
+        parser.add_argument("--exclude", dest="filters", action="append", metavar="PATTERN",
+                            type=lambda pattern: (False, pattern),
+                            help="Do not sync (nor remove from folder2) the paths matching PATTERN: a name at any\n"
+                                 "depth (*.tmp, .git/, a trailing / matches folders only) or a path from folder1\n"
+                                 "(/dist, docs/*.pdf); ** matches across folders. Could be repeated, the first\n"
+                                 "matching --include/--exclude decides. Rules are also read from the .syncignore\n"
+                                 "file of every folder ('- pattern' or 'pattern' excludes, '+ pattern' includes).")
+        parser.add_argument("--include", dest="filters", action="append", metavar="PATTERN",
+                            type=lambda pattern: (True, pattern),
+                            help="Sync the paths matching PATTERN, even if a later rule excludes them.")
+        parser.add_argument("--dedup", choices=("reflink", "link"),
+                            help="Copy every content once per destination: files with the same digest as an already\n"
+                                 "synced file are reflink clones of it (reflink) or, where reflink is not supported,\n"
+                                 "hard links to it (link), if they have the same mode, owner and mtime. Hard links\n"
+                                 "of folder1 are kept as hard links.")
+        parser.add_argument("--priority", choices=("mtime", "size", "patterns"),
+                            help="Copy the changed files in priority order: the most recently modified first\n"
+                                 "(mtime), the smallest first (size) or the files matching the --priority-pattern\n"
+                                 "patterns first (patterns, the default with --priority-pattern).")
+        parser.add_argument("--priority-pattern", dest="priority_patterns", action="append", metavar="PATTERN",
+                            help="Copy the files matching PATTERN (same syntax as --exclude) before the others.\n"
+                                 "Could be repeated, the files of the first pattern are copied first; the files of\n"
+                                 "a pattern are copied the most recently modified first.")
+        parser.add_argument("--background-size", type=float, default=0, metavar="MB",
+                            help="With --priority, copy the files of at least MB megabytes in a background lane,\n"
+                                 "served by a quarter of the workers, so they do not hold back the small files.")
+        parser.add_argument("--scrub-budget", type=float, default=0, metavar="MB",
+                            help="Scrub the local destinations in the background, reading at most MB megabytes per\n"
+                                 "hour: files whose metadata matches folder1 are read again and compared with the\n"
+                                 "folder1 digest, and corrupted files are repaired. Needs the digest index.")
+        parser.add_argument("--scrub-period", type=parse_duration, default="30d",
+                            metavar="DURATION",
+                            help="Verify every file once per DURATION, e.g. 7d or 12h (default: %(default)s).")
+        parser.add_argument("--journal", type=str, metavar="FILE",
+                            help="Journal of the sync in progress, used to resume an interrupted sync (default:\n"
+                                 "folder_sync_journal_<id>.jsonl, with an id of the synced folders).")
+        parser.add_argument("--no-journal", action="store_true",
+                            help="Do not journal the syncs; an interrupted sync is redone by the next one.")
+        parser.add_argument("--no-fsync", action="store_true",
+                            help="Do not fsync the copied files before they are renamed into place (faster, but a\n"
+                                 "power loss could leave empty or partial files).")
+        parser.add_argument("--parallel-copy", type=float, default=FileCopier.PARALLEL_SIZE / 1048576, metavar="MB",
+                            help="Copy the files of at least MB megabytes in parallel ranges, to reach the bandwidth\n"
+                                 "of striped or NVMe storage (default: %(default)s MB, 0 to disable).")
+        parser.add_argument("--copy-streams", type=int, default=FileCopier.STREAMS, metavar="STREAMS",
+                            help="Ranges of a parallel copy copied at the same time (default: %(default)s).")
+        parser.add_argument("--copy-range", type=float, default=FileCopier.RANGE_SIZE / 1048576, metavar="MB",
+                            help="Size of the ranges of a parallel copy (default: %(default)s MB).")
+        ParseArguments.add_log_arguments(parser)
+        return parser.parse_args(argv)
+
+    @staticmethod
+    def add_log_arguments(parser: argparse.ArgumentParser) -> None:
+        """
+        Adds the logging arguments, shared by all the commands.
+        :param parser: argument parser of a command
+        :return: None
+        """
+        parser.add_argument("--log-file", type=str, default="folder_sync_logs.log", metavar="FILE",
+                            help="File where logs are saved (default: %(default)s).")
+        parser.add_argument("--log-level", choices=("files", "summary"), default="files",
+                            help="files: log every copied, removed or created file and folder; summary: log only\n"
+                                 "the sync summaries and the errors (default: %(default)s).")
+        parser.add_argument("--log-format", choices=("text", "json"), default="text",
+                            help="Log lines format, json is one JSON object per line (default: %(default)s).")
+        parser.add_argument("--log-max-size", type=int, default=0, metavar="MB",
+                            help="Rotate the log file when it is bigger than MB megabytes.")
+        parser.add_argument("--log-rotate", choices=("hourly", "daily"),
+                            help="Rotate the log file every hour or every day.")
+        parser.add_argument("--log-backups", type=int, default=5, metavar="COUNT",
+                            help="Rotated log files kept, compressed with gzip (default: %(default)s).")
+
+    @staticmethod
+    def parse_serve_arguments(argv: list) -> argparse.Namespace:
+        """
+        Parse input arguments of the 'serve' command, which serves a folder to sync clients on other machines.
+        :param argv: arguments after 'serve'
+        :return: arguments object
+        """
+        parser = argparse.ArgumentParser(
+            prog="sync_folders.py serve",
+            description="Serve a folder to be synced, as sync://host:port, by sync_folders.py running on other "
+                        "machines.")
+        parser.add_argument("folder", type=str, help="Served folder path")
+        parser.add_argument("--host", type=str, default="127.0.0.1",
+                            help="Listening address (default: %(default)s); e.g. 0.0.0.0 to serve other machines.")
+        parser.add_argument("--port", type=int, default=SyncServer.DEFAULT_PORT,
+                            help="Listening port (default: %(default)s).")
+        parser.add_argument("--index", type=str, default="folder_sync_index.db",
+                            help="SQLite file used to cache file digests (default: %(default)s).")
+        parser.add_argument("--no-index", action="store_true", help="Do not use the digest index.")
+        parser.add_argument("--no-fsync", action="store_true",
+                            help="Do not fsync the received files before they are renamed into place.")
+        parser.add_argument("--token-file", type=str,
+                            help=f"File holding the token the clients must know (default: the "
+                                 f"{SyncServer.TOKEN_VARIABLE} environment variable). The clients read it from "
+                                 f"{SyncServer.TOKEN_VARIABLE}.")
+        parser.add_argument("--no-auth", action="store_true",
+                            help="Serve without token: anyone who can reach the port can write to the folder.")
+        ParseArguments.add_log_arguments(parser)
+        return parser.parse_args(argv)
+
+    @staticmethod
+    def parse_restore_arguments(argv: list) -> argparse.Namespace:
+        """
+        Parse input arguments of the 'restore' command, which restores a snapshot of a snapshot:// store.
+        :param argv: arguments after 'restore'
+        :return: arguments object
+        """
+        parser = argparse.ArgumentParser(
+            prog="sync_folders.py restore",
+            description="Restore the files of a snapshot recorded by a sync to snapshot://<store>.")
+        parser.add_argument("store", type=str, help="Snapshot store path")
+        parser.add_argument("target", type=str, help="Folder the files are restored into")
+        parser.add_argument("--snapshot", type=str, metavar="ID",
+                            help="Snapshot to restore (default: the last one), as listed by 'snapshots'.")
+        parser.add_argument("--path", type=str, default="", metavar="PATH",
+                            help="Restore only PATH (a file, or a folder with its content), relative to the\n"
+                                 "synced folder.")
+        ParseArguments.add_log_arguments(parser)
+        return parser.parse_args(argv)
+
+    @staticmethod
+    def parse_snapshots_arguments(argv: list) -> argparse.Namespace:
+        """
+        Parse input arguments of the 'snapshots' command, which lists the snapshots of a store, or the files of one.
+        :param argv: arguments after 'snapshots'
+        :return: arguments object
+        """
+        parser = argparse.ArgumentParser(
+            prog="sync_folders.py snapshots",
+            description="List the snapshots recorded by the syncs to snapshot://<store>, or the files of one of them.")
+        parser.add_argument("store", type=str, help="Snapshot store path")
+        parser.add_argument("snapshot", type=str, nargs="?", help="List the files of this snapshot.")
+        parser.add_argument("--path", type=str, default="", metavar="PATH",
+                            help="List only PATH (a file, or a folder with its content).")
+        return parser.parse_args(argv)
+
+    @staticmethod
+    def parse_daemon_arguments(argv: list) -> argparse.Namespace:
+        """
+        Parse input arguments of the 'daemon' command, which runs the sync jobs of a config file in one process.
+        :param argv: arguments after 'daemon'
+        :return: arguments object
+        """
+        parser = argparse.ArgumentParser(
+            prog="sync_folders.py daemon",
+            description="Run many sync jobs, each with its own schedule, in one process sharing a worker pool and an "
+                        "I/O budget.")
+        parser.add_argument("config", type=str,
+                            help="Config file (INI, or TOML if it ends with .toml): a [daemon] section with the "
+                                 "shared settings and one section per job.")
+        ParseArguments.add_log_arguments(parser)
+        return parser.parse_args(argv)
 
     def get_interval_schedule(self) -> tuple:
         """
         Used to decide which sync method (interval or schedule) to be used based on arguments.
-        Interval arguments (-s, -m, -hr, -d) could not be used together with schedule argument (-t).
-        :return: (interval, schedule)
+        Interval arguments (-s, -m, -hr, -d) could not be used together with schedule arguments (-t, --cron).
+        :return: (interval, schedule); schedule is a datetime (-t) or a CronSchedule (--cron)
         """
-        if any([self.arguments.seconds, self.arguments.minutes, self.arguments.hours, self.arguments.days]):
+        if self.arguments.cron:
+            if any([self.arguments.seconds, self.arguments.minutes, self.arguments.hours, self.arguments.days,
+                    self.arguments.time]):
+                print("[ERROR] --cron could not be used together with -t or interval params (e.g. -s, -m, -hr or -d)")
+                exit(0)
+            return None, self.arguments.cron
+        elif any([self.arguments.seconds, self.arguments.minutes, self.arguments.hours, self.arguments.days]):
             if self.arguments.time:
                 print("[ERROR] -t could not be used together with interval params (e.g. -s, -m, -hr or -d)")
                 exit(0)
@@ -134,186 +4076,1286 @@ class ParseArguments:
                 return interval, None
 
         elif self.arguments.time:
+            if self.arguments.watch:
+                print("[ERROR] -t could not be used together with -w")
+                exit(0)
             return None, self.arguments.time
+        elif self.arguments.watch:
+            return None, None
         else:
             print(f"[ERROR] Invalid arguments. Run: python {os.path.basename(__file__)} --help.")
             exit(0)
 
 
 class FolderSync:
-    def __init__(self, folder1: str, folder2: str, interval: timedelta, schedule: datetime):
+    # Change detection tiers, in the order they are checked, for every --compare strategy
+    COMPARE_TIERS = {
+        "hash": ("size", "hash"),
+        "quick": ("size", "mtime", "hash"),
+        "sample": ("size", "mtime", "sample", "hash"),
+    }
+    # Bytes read from head, middle and tail of a file for the sampled digest
+    SAMPLE_SIZE = 65536
+    # Watch mode: a batch of changes is synced once no event was received for DEBOUNCE seconds (or after
+    # MAX_DEBOUNCE seconds of continuous changes); a full sync runs every RECONCILE_INTERVAL if no interval is given.
+    DEBOUNCE = 0.5
+    MAX_DEBOUNCE = 5
+    RECONCILE_INTERVAL = timedelta(hours=1)
+    # File actions are applied in tasks of BATCH_SIZE actions; at most QUEUE_FACTOR tasks per worker are queued
+    BATCH_SIZE = 256
+    QUEUE_FACTOR = 4
+    # Priority mode: at most PRIORITY_WINDOW copies are queued to be ordered; a quarter of the workers (at least one)
+    # copy the files of the background lane
+    PRIORITY_WINDOW = 16384
+    BACKGROUND_SHARE = 4
+
+    def __init__(self, folder1: str, folder2: str | list, interval: timedelta, schedule: datetime,
+                 index: FileIndex | None = None, compare: str = "hash", hash_engine: HashEngine | None = None,
+                 delta: DeltaTransfer | None = None, watch: bool = False, copier: FileCopier | None = None,
+                 workers: int | None = None, compression: str = "none", exporter: MetricsExporter | None = None,
+                 throttle: IOThrottle | None = None, pool: SharedWorkerPool | None = None, name: str | None = None,
+                 journal: SyncJournal | None = None, dedup: str | None = None, filters: list | None = None,
+                 priority: str | None = None, priority_patterns: list | None = None, background_size: int = 0,
+                 scrub_budget: int = 0, scrub_period: timedelta = timedelta(days=30)):
         self.folder1 = folder1
-        self.folder2 = folder2
+        # Destination folders, all synced from folder1; sync:// folders are synced over the network
+        folders = [folder2] if isinstance(folder2, str) else list(folder2)
+        self.destinations = [folder for folder in folders
+                             if not RemoteDestination.is_remote(folder) and not SnapshotStore.is_snapshot(folder)]
+        self.remotes = [RemoteDestination(folder, compression) for folder in folders
+                        if RemoteDestination.is_remote(folder)]
         self.interval = interval
         self.schedule = schedule
-        # Lock to ensure that manual and auto syncs don't run at the same time
+        self.index = index
+        self.compare = compare
+        # I/O limits shared by all the workers; the engines should be created with the same throttle
+        self.throttle = throttle or IOThrottle()
+        self.hash_engine = hash_engine or HashEngine(throttle=self.throttle)
+        self.delta = delta
+        self.watch = watch
+        self.copier = copier or FileCopier(self.throttle)
+        # snapshot:// targets, which record every sync as a snapshot; their chunks are compressed with zlib, or zstd
+        self.snapshots = [SnapshotStore(folder, "zstd" if compression == "zstd" else "zlib", self.throttle,
+                                        self.copier.fsync) for folder in folders if SnapshotStore.is_snapshot(folder)]
+        self.workers = workers or min(32, (os.cpu_count() or 1) + 4)
+        # Daemon mode: the file actions are run by the worker pool shared by all the jobs
+        self.pool = pool
+        self.name = name
+        # Counters and timings of the current sync, published by exporter after every sync
+        self.metrics = SyncMetrics(name)
+        self.exporter = exporter
+        # Write-ahead journal of the local destinations, to resume an interrupted sync
+        self.journal = journal
+        # Deduplication of the local destinations: None, "reflink" (clone the duplicates) or "link" (clone them, or
+        # hard link them where reflink is not supported)
+        self.dedup = dedup
+        # (destination, digest or folder1 (st_dev, st_ino)) -> destination file with that content, for the current sync
+        self.duplicates = {}
+        self.duplicates_lock = threading.Lock()
+        # Command line include/exclude rules, list of (include, pattern), checked before the .syncignore files
+        self.filters = filters or []
+        # Order of the copies: None (walk order), "mtime" (most recently modified first), "size" (smallest first) or
+        # "patterns" (files matching the first priority pattern first, then the second...; most recent first)
+        self.priority = priority or ("patterns" if priority_patterns else None)
+        self.priority_rules = FilterRules([(True, pattern) for pattern in priority_patterns or []])
+        self.priority_count = len(priority_patterns or [])
+        # Priority mode: files of at least background_size bytes (if not 0) are copied in the background lane
+        self.background_size = background_size
+        # Runs the copies of the current sync in priority mode, created by run_plan()
+        self.copy_scheduler = None
+        # Lock to ensure that full syncs and watch mode path syncs don't run at the same time
         self.sync_lock = threading.Lock()
+        # Runs the full syncs, created by start_auto_sync()
+        self.scheduler = None
+        # Integrity scrub of the local destinations (with an index): bytes read per hour, 0 to disable, and period
+        # after which a verified file is verified again
+        self.scrub_budget = scrub_budget
+        self.scrub_period = scrub_period
+        # Runs the scrub passes, created by start_auto_sync()
+        self.scrubber = None
 
-    @staticmethod
-    def file_hash(file_path) -> str:
+    def file_hash(self, file_path: str, size: int | None = None) -> str:
         """
-        Generates hash value of file_path. Files will be read in chuncks of 1MB.
-        :param file_path:
+        Generates hash value of file_path with the configured hash engine.
+        :param file_path: file path
+        :param size: size of file_path, if already known
         :return: hash value of file_path
         """
-        md5_hash = hashlib.md5()
-        with open(file_path, 'rb') as file:
-            while chunk := file.read(1048576):
-                md5_hash.update(chunk)
-        return md5_hash.hexdigest()
+        with self.metrics.measure("hash", "hash"):
+            digest = self.hash_engine.hash_file(file_path)
+        self.metrics.add("bytes_hashed", os.path.getsize(file_path) if size is None else size)
+        return digest
 
-    @staticmethod
-    def process_file(folder1: str, folder2: str, dirpath: str, filenames: list) -> None:
-        """
-        Used to compare dirpath content from folder1 and folder2. If a file from folder2 does not exist or has a
-        different hash value that the one from folder1, will be replaced from folder1.
-        :param folder1: Folder1 full path
-        :param folder2: Folder2 full path
-        :param dirpath: folder from folder1
-        :param filenames: files from folder1
+    def cached_digest(self, file_path: str, stat_result: os.stat_result) -> str | None:
+        """
+        Returns the digest of file_path from the index, if the file metadata did not change since it was stored.
+        :param file_path: file path
+        :param stat_result: os.stat() result of file_path
+        :return: hash value of file_path or None
+        """
+        if self.index is None:
+            return None
+        return self.index.get_digest(os.path.abspath(file_path), stat_result, self.hash_engine.algorithm)
+
+    def store_digest(self, file_path: str, stat_result: os.stat_result, digest: str) -> None:
+        if self.index:
+            self.index.set_digest(os.path.abspath(file_path), stat_result, digest, self.hash_engine.algorithm)
+
+    def file_digest(self, file_path: str, stat_result: os.stat_result | None = None) -> str:
+        """
+        Returns the hash value of file_path, taken from the index while the file metadata is unchanged.
+        The file is stat-ed before hashing, so a file modified during hashing is hashed again on the next sync.
+        :param file_path: file path
+        :param stat_result: os.stat() result of file_path, if already known
+        :return: hash value of file_path
+        """
+        stat_result = stat_result or os.stat(file_path)
+        digest = self.cached_digest(file_path, stat_result)
+        if digest is None:
+            digest = self.file_hash(file_path, stat_result.st_size)
+            self.store_digest(file_path, stat_result, digest)
+        return digest
+
+    def file_digests(self, file1_path: str, file2_path: str, stat1: os.stat_result, stat2: os.stat_result) -> tuple:
+        """
+        Returns the hash values of two files; when neither is in the index, both files are hashed concurrently.
+        :param file1_path: file from folder1
+        :param file2_path: file from folder2
+        :param stat1: os.stat() result of file1_path
+        :param stat2: os.stat() result of file2_path
+        :return: (hash value of file1_path, hash value of file2_path)
+        """
+        digest1, digest2 = self.cached_digest(file1_path, stat1), self.cached_digest(file2_path, stat2)
+        if digest1 is None and digest2 is None:
+            with self.metrics.measure("hash", "hash", files=2):
+                digest1, digest2 = self.hash_engine.hash_pair(file1_path, file2_path)
+            self.metrics.add("bytes_hashed", stat1.st_size + stat2.st_size)
+            self.store_digest(file1_path, stat1, digest1)
+            self.store_digest(file2_path, stat2, digest2)
+        return digest1 or self.file_digest(file1_path, stat1), digest2 or self.file_digest(file2_path, stat2)
+
+    def sample_hash(self, file_path: str, size: int) -> str:
+        """
+        Generates hash value of SAMPLE_SIZE bytes read from the head, middle and tail of file_path.
+        Equal sample hashes do not prove equal content, so they are always followed by a full hash.
+        :param file_path: file path
+        :param size: file size
+        :return: hash value of the sampled bytes
+        """
+        hasher = self.hash_engine.new_hasher()
+        with self.metrics.measure("hash", "sample"), self.throttle.io(read=3 * self.SAMPLE_SIZE, ops=1), \
+                open(file_path, 'rb') as file:
+            for offset in (0, (size - self.SAMPLE_SIZE) // 2, size - self.SAMPLE_SIZE):
+                file.seek(offset)
+                hasher.update(file.read(self.SAMPLE_SIZE))
+        self.metrics.add("bytes_hashed", 3 * self.SAMPLE_SIZE)
+        return hasher.hexdigest()
+
+    def compare_files(self, file1_path: str, file2_path: str, stat1: os.stat_result, stat2: os.stat_result,
+                      digest1: str | None = None) -> tuple:
+        """
+        Runs the content change detection tiers of the compare strategy (the metadata ones are decided by the planner).
+        :param file1_path: file from folder1
+        :param file2_path: file from a destination folder
+        :param stat1: os.stat() result of file1_path
+        :param stat2: os.stat() result of file2_path
+        :param digest1: hash value of file1_path, if already computed for another destination
+        :return: (tier which decided, True if file2 must be replaced, digest of file1 or None if it was not hashed)
+        """
+        for tier in self.COMPARE_TIERS[self.compare]:
+            if tier == "sample":
+                # Small files are cheaper to hash in full than to sample
+                if stat1.st_size > 3 * self.SAMPLE_SIZE and \
+                        self.sample_hash(file1_path, stat1.st_size) != self.sample_hash(file2_path, stat2.st_size):
+                    return tier, True, None
+            elif tier == "hash":
+                if digest1 is None:
+                    digest1, digest2 = self.file_digests(file1_path, file2_path, stat1, stat2)
+                else:
+                    digest2 = self.file_digest(file2_path, stat2)
+                return tier, digest1 != digest2, digest1
+
+    def copy_file(self, file1_path: str, file2_paths: list, hash_content: bool = False) -> str | None:
+        """
+        Copies file1_path to every path of file2_paths, reading it once. Big files which already exist in a destination
+        are updated with a block delta, if enabled.
+        :param file1_path: file from folder1
+        :param file2_paths: files from destination folders
+        :param hash_content: compute the digest of file1_path from the data read by the copy, if it reads it all
+        :return: hash value of file1_path, if it was computed by the copy
+        """
+        copies, written, digest = [], 0, None
+        with self.metrics.measure("copy", "copy"):
+            for file2_path in file2_paths:
+                if self.delta and os.path.exists(file2_path) and os.path.getsize(file1_path) >= self.delta.threshold:
+                    if self.journal:
+                        # Journaled so the temporary file of an interrupted rebuild is removed
+                        self.journal.copy_started(file1_path, file2_path, file2_path + TEMP_SUFFIX,
+                                                  os.stat(file1_path))
+                    delta_written = self.delta.sync_file(file1_path, file2_path)
+                    if self.journal:
+                        self.journal.copy_done(file2_path)
+                    logger.log(FILE_EVENT, "Delta update of [%s]: %d bytes written.", file2_path, delta_written)
+                    written += delta_written
+                else:
+                    copies.append(file2_path)
+            if copies:
+                hasher = self.hash_engine.new_hasher() if hash_content else None
+                if self.copier.copy_many(file1_path, copies, self.journal, hasher):
+                    digest = hasher.hexdigest()
+                written += os.path.getsize(file1_path) * len(copies)
+        self.metrics.add("files_copied", len(file2_paths))
+        self.metrics.add("bytes_copied", written)
+        return digest
+
+    def count_tier(self, tier: str, changed: bool) -> None:
+        self.metrics.count_tier(tier, changed)
+
+    def apply_actions(self, actions: list) -> None:
+        """
+        Applies a batch of file actions ("create", "update", "compare", "delete", "skip") of the sync plan.
+        The actions of one folder1 file are applied together: its digest is computed once and it is read once for all
+        the destinations which need it. An error is counted for the file and the other files of the batch are applied.
+        :param actions: list of SyncAction
         :return: None
         """
-        relpath = os.path.relpath(dirpath, folder1)
-        folder2_dirpath = os.path.join(folder2, relpath)
-        if not os.path.exists(folder2_dirpath):
-            logger.warning(f'Creating folder [{relpath}] in [{folder2}]')
-            os.makedirs(folder2_dirpath)
+        for relpath, group in groupby(actions, key=lambda action: action.relpath):
+            try:
+                self.apply_file_actions(relpath, list(group))
+            except Exception as exception:
+                self.metrics.fail(relpath, exception)
 
-        for file in filenames:
-            file1_path = os.path.join(dirpath, file)
-            file2_path = os.path.join(folder2_dirpath, file)
-            if not os.path.exists(file2_path) or FolderSync.file_hash(file1_path) != FolderSync.file_hash(file2_path):
-                logger.warning(f"Sync file [{file}] from [{folder2_dirpath}].")
-                shutil.copy2(src=file1_path, dst=file2_path)
+    def apply_file_actions(self, relpath: str, group: list) -> None:
+        """
+        Applies the actions of one folder1 file, for all the destinations.
+        :param relpath: path of the file, relative to folder1
+        :param group: list of SyncAction of relpath
+        :return: None
+        """
+        file1_path = os.path.join(self.folder1, relpath)
+        targets, digest, scanned = [], None, False
+        # Destination files which already have folder1 file content, and the destination of every file
+        unchanged, destinations = [], {}
+        for action in group:
+            file2_path = os.path.join(action.destination, relpath)
+            destinations[file2_path] = action.destination
+            if action.kind == "delete":
+                logger.log(FILE_EVENT, "Remove file [%s] from [%s].", relpath, action.destination)
+                with self.metrics.measure("delete"), self.throttle.io(ops=1):
+                    os.remove(file2_path)
+                self.metrics.add("deletes")
+                if self.index:
+                    self.index.remove(os.path.abspath(file2_path))
+                continue
 
-    @staticmethod
-    def remove_files(folder2: str, folder1: str, dirpath: str, filenames: list) -> None:
-        relpath = os.path.relpath(dirpath, folder2)
-        folder1_dirpath = os.path.join(folder1, relpath)
+            scanned = True
 
-        if not os.path.exists(folder1_dirpath):
-            logger.warning(f'Removing folder [{dirpath}] in [{folder2}]')
-            shutil.rmtree(dirpath)
+            tier, changed = action.tier, action.kind in ("create", "update")
+            if action.kind == "compare":
+                tier, changed, file1_digest = self.compare_files(file1_path, file2_path, action.src_stat,
+                                                                 action.dst_stat, digest)
+                digest = digest or file1_digest
+            self.count_tier(tier, changed)
+            if not changed:
+                unchanged.append(file2_path)
+                continue
+            if action.kind == "create" and action.dst_stat is not None:
+                # A folder with the same name as the file
+                shutil.rmtree(file2_path)
+            logger.log(FILE_EVENT, "Sync file [%s] to [%s].", relpath, action.destination)
+            targets.append(file2_path)
 
+        if scanned:
+            self.metrics.add("files_scanned")
+        if not scanned or not self.dedup:
+            copies = targets
         else:
-            for file in filenames:
-                file2_path = os.path.join(dirpath, file)
-                file1_path = os.path.join(folder1_dirpath, file)
-                if not os.path.exists(file1_path):
-                    logger.warning(f"Remove file [{file}] from [{folder2}].")
-                    os.remove(file2_path)
+            if targets:
+                digest = digest or self.file_digest(file1_path, group[0].src_stat)
+            copies = self.link_duplicates(file1_path, group[0].src_stat, digest, targets, destinations)
+        if copies and self.copy_scheduler:
+            # Queued copies are journaled as tasks of their own: the batch which planned them is done before they run
+            batch_id = self.journal.batch([relpath]) if self.journal else None
+            src_stat = group[0].src_stat
+            self.copy_scheduler.submit(self.copy_priority(relpath, src_stat), src_stat.st_size, self.run_copy,
+                                       batch_id, relpath, file1_path, group[0].src_stat, digest, copies, targets,
+                                       unchanged, destinations)
+            return
+        self.finish_file(file1_path, group[0].src_stat if scanned else None, digest, copies, targets, unchanged,
+                         destinations)
 
-    def _folder_sync(self) -> None:
+    def finish_file(self, file1_path: str, src_stat: os.stat_result | None, digest: str | None, copies: list,
+                    targets: list, unchanged: list, destinations: dict) -> None:
         """
-        Used to create a pool of executors.
+        Copies a folder1 file to the destinations, then indexes and registers the destination files for dedup.
+        :param file1_path: file from folder1
+        :param src_stat: os.stat() result of file1_path, None if it was not scanned (only deleted files)
+        :param digest: hash value of file1_path, if it was computed
+        :param copies: destination files to which file1_path is copied
+        :param targets: destination files replaced with file1_path (copies, and linked files)
+        :param unchanged: destination files which already have file1_path content
+        :param destinations: destination folder of every destination file
         :return: None
         """
-        with ThreadPoolExecutor() as executor:
-            results = [executor.submit(self.process_file, self.folder1, self.folder2, dirpath, filenames)
-                                              for dirpath, _, filenames in os.walk(self.folder1)]
+        if copies:
+            # With an index, the digest of a file read by the copy is stored, so it is not read again to be hashed
+            copy_digest = self.copy_file(file1_path, copies, hash_content=digest is None and self.index is not None)
+            if copy_digest:
+                digest = copy_digest
+                self.store_digest(file1_path, src_stat, digest)
+        if digest:
+            # The copies have the same content as folder1 file, so their digest is already known
+            for file2_path in targets:
+                self.store_digest(file2_path, os.stat(file2_path), digest)
+        if src_stat is not None and self.dedup:
+            self.register_duplicates(src_stat, digest, targets + unchanged, destinations)
 
-            results.extend([executor.submit(self.remove_files, self.folder2, self.folder1, dirpath, filenames)
-                       for dirpath, _, filenames in os.walk(self.folder2)])
+    def copy_priority(self, relpath: str, src_stat: os.stat_result) -> tuple:
+        """
+        :return: priority key of the copy of a folder1 file, the lowest copied first
+        """
+        if self.priority == "size":
+            return (src_stat.st_size,)
+        if self.priority == "patterns":
+            rank = self.priority_rules.first_match(relpath, False)
+            return (self.priority_count if rank is None else rank, -src_stat.st_mtime_ns)
+        return (-src_stat.st_mtime_ns,)
 
-            for result in as_completed(results):
-                try:
-                    result.result()
-                except Exception as exception:
-                    logger.exception(exception)
-                    exit(0)
-        print(f"Last sync: {datetime.now()}. Type 'sync' to trigger sync now or 'quit' to stop the script.")
+    def run_copy(self, batch_id: int | None, relpath: str, *args) -> None:
+        """
+        Runs finish_file(*args) for a copy queued in the copy scheduler, then marks its journal task done.
+        """
+        try:
+            self.finish_file(*args)
+        except Exception as exception:
+            self.metrics.fail(relpath, exception)
+        if batch_id is not None:
+            self.journal.batch_done(batch_id)
+
+    def duplicate_keys(self, src_stat: os.stat_result, digest: str | None) -> list:
+        """
+        :return: the keys of the destination files which could be linked to a folder1 file: its inode, if it has
+                 several hard links in folder1 (to preserve them), and its digest
+        """
+        keys = [(src_stat.st_dev, src_stat.st_ino)] if src_stat.st_nlink > 1 else []
+        # Kept for every file of the sync: binary digests take half the memory of the hex ones
+        return keys + [bytes.fromhex(digest)] if digest else keys
+
+    def link_duplicates(self, file1_path: str, src_stat: os.stat_result, digest: str, targets: list,
+                        destinations: dict) -> list:
+        """
+        Dedup mode: links the targets to destination files already synced in this sync with the same content. A hard
+        link of folder1 is preserved as a hard link; other identical files are reflink clones (or, with dedup
+        "link", hard links where reflink is not supported, if the linked file has the metadata of file1_path).
+        :param file1_path: file from folder1
+        :param src_stat: os.stat() result of file1_path
+        :param digest: hash value of file1_path
+        :param targets: files from destination folders to be replaced with file1_path
+        :param destinations: destination folder of every target
+        :return: the targets which could not be linked, to be copied
+        """
+        copies = []
+        for file2_path in targets:
+            with self.duplicates_lock:
+                existing = [self.duplicates.get((destinations[file2_path], key))
+                            for key in self.duplicate_keys(src_stat, digest)]
+            inode_path = existing[0] if src_stat.st_nlink > 1 else None
+            digest_path = existing[-1]
+            if inode_path and self.copier.hardlink(inode_path, file2_path):
+                method = "hard link"
+            elif digest_path and self.copier.clone(digest_path, file2_path, file1_path):
+                method = "reflink"
+            elif digest_path and self.dedup == "link" and self.same_metadata(digest_path, src_stat) and \
+                    self.copier.hardlink(digest_path, file2_path):
+                method = "hard link"
+            else:
+                copies.append(file2_path)
+                continue
+            logger.log(FILE_EVENT, "Linked [%s] to [%s] (%s).", file2_path, inode_path or digest_path, method)
+            self.metrics.add("files_linked")
+            self.metrics.add("bytes_linked", src_stat.st_size)
+        return copies
+
+    @staticmethod
+    def same_metadata(path: str, src_stat: os.stat_result) -> bool:
+        """
+        A hard link shares the metadata of the linked file: it replaces a copy only if they have the same metadata.
+        :return: True if path has the mode, owner and mtime of src_stat
+        """
+        try:
+            existing = os.stat(path)
+        except OSError:
+            return False
+        return (existing.st_mode, existing.st_uid, existing.st_gid, existing.st_mtime_ns) == \
+            (src_stat.st_mode, src_stat.st_uid, src_stat.st_gid, src_stat.st_mtime_ns)
 
-    def _interval_sync(self) -> None:
+    def register_duplicates(self, src_stat: os.stat_result, digest: str | None, file2_paths: list,
+                            destinations: dict) -> None:
         """
-        Used to trigger periodic syncs (accordingly with interval parameter) in an infinite loop.
+        Dedup mode: records destination files which have the content of a folder1 file, to be linked by its
+        duplicates. The first file of every content is kept.
+        """
+        with self.duplicates_lock:
+            for file2_path in file2_paths:
+                for key in self.duplicate_keys(src_stat, digest):
+                    self.duplicates.setdefault((destinations[file2_path], key), file2_path)
+
+    def remove_folder(self, destination: str, relpath: str) -> None:
+        folder2_path = os.path.join(destination, relpath)
+        logger.log(FILE_EVENT, "Removing folder [%s] in [%s]", relpath, destination)
+        try:
+            with self.metrics.measure("delete"), self.throttle.io(ops=1):
+                shutil.rmtree(folder2_path)
+        except OSError as exception:
+            self.metrics.fail(folder2_path, exception)
+            return
+        self.metrics.add("folders_removed")
+        if self.index:
+            self.index.remove(os.path.abspath(folder2_path))
+
+    def make_folder(self, action: SyncAction) -> None:
+        folder2_path = os.path.join(action.destination, action.relpath)
+        if action.dst_stat is not None:
+            # A file with the same name as the folder
+            os.remove(folder2_path)
+        logger.log(FILE_EVENT, "Creating folder [%s] in [%s]", action.relpath, action.destination)
+        with self.throttle.io(ops=1):
+            os.makedirs(folder2_path, exist_ok=True)
+        self.metrics.add("folders_created")
+
+    def run_plan(self, actions) -> None:
+        """
+        Applies a sync plan while it is generated. Folders are created by the planning thread, so they exist before
+        the actions of their content are applied; file actions are applied by the workers in batches of about
+        BATCH_SIZE (the actions of one file are never split between batches), and removed folders by one task each.
+        Every task is journaled before it is submitted and marked done once applied. Errors are counted per file and
+        the other files are still synced.
+        In priority mode, the batches only compare the files: their copies are queued in a copy scheduler, which runs
+        them in priority order, with the large files in a background lane.
+        :param actions: iterable of SyncAction
+        :return: None
+        """
+        device = self.device() if self.pool else None
+        executor = self.executor(self.workers * self.QUEUE_FACTOR, device)
+        with ExitStack() as stack:
+            if self.priority:
+                # In daemon mode, the copies are run by the shared pool too
+                self.copy_scheduler = stack.enter_context(CopyScheduler(
+                    self.workers, self.PRIORITY_WINDOW, self.background_size,
+                    max(1, self.workers // self.BACKGROUND_SHARE), self.pool, device, self.name))
+            # The executor is finished first: its batches queue the copies
+            stack.enter_context(executor)
+            batch = []
+            # The time spent to list the folders and merge them into the plan
+            for action in self.metrics.timed("walk", actions):
+                if action.kind == "mkdir":
+                    try:
+                        self.make_folder(action)
+                    except OSError as exception:
+                        self.metrics.fail(os.path.join(action.destination, action.relpath), exception)
+                elif action.kind == "rmdir":
+                    self.submit(executor, [action.relpath], self.remove_folder, action.destination, action.relpath)
+                else:
+                    if len(batch) >= self.BATCH_SIZE and batch[-1].relpath != action.relpath:
+                        self.submit(executor, self.batch_paths(batch), self.apply_actions, batch)
+                        batch = []
+                    batch.append(action)
+            if batch:
+                self.submit(executor, self.batch_paths(batch), self.apply_actions, batch)
+
+        errors = executor.errors + (self.copy_scheduler.errors if self.copy_scheduler else [])
+        self.copy_scheduler = None
+        for exception in errors:
+            logger.error(exception, exc_info=exception)
+        self.metrics.add("errors", len(errors))
+
+    def executor(self, max_pending: int, device=None):
+        """
+        :param max_pending: tasks waiting or running at most, submit() blocks while they are queued
+        :param device: device() of the job, computed if not given
+        :return: executor of the tasks of a sync: in daemon mode, a JobExecutor of the shared pool, otherwise a
+                 BoundedExecutor of workers threads
+        """
+        if self.pool:
+            return self.pool.executor(self.device() if device is None else device, self.name, max_pending)
+        return BoundedExecutor(self.workers, max_pending)
+
+    @staticmethod
+    def batch_paths(actions: list) -> list:
+        return list(dict.fromkeys(action.relpath for action in actions))
+
+    def submit(self, executor, relpaths: list, function, *args) -> None:
+        """
+        Journals the paths of a task, then submits it to executor.
+        """
+        batch_id = self.journal.batch(relpaths) if self.journal else None
+        executor.submit(self.run_task, batch_id, function, *args)
+
+    def run_task(self, batch_id: int | None, function, *args) -> None:
+        function(*args)
+        if batch_id is not None:
+            self.journal.batch_done(batch_id)
+
+    def resume(self) -> None:
+        """
+        Used at the start of a sync: if the journal was left by an interrupted sync, its copies in progress are
+        resumed from their last checkpoint (or their temporary file is removed) and the paths of its unfinished tasks
+        are synced first. A new journal is then started for this sync.
         :return: None
         """
+        if not self.journal:
+            return
+        pending, copies = self.journal.load()
+        self.journal.begin()
+        if not pending and not copies:
+            return
+        logger.info(f"Resuming an interrupted sync: {len(copies)} copies and {len(pending)} paths to sync.")
+        for dst_path, record in copies.items():
+            try:
+                src_stat = os.stat(record["src"])
+                tmp_stat = os.stat(record["tmp"])
+            except FileNotFoundError:
+                continue
+            try:
+                # A temporary file with other hard links is not written in place
+                if record["offset"] and tmp_stat.st_size >= record["offset"] and tmp_stat.st_nlink == 1 and \
+                        src_stat.st_size == record["size"] and src_stat.st_mtime_ns == record["mtime_ns"]:
+                    logger.warning(f"Resume copy of [{record['src']}] to [{dst_path}] at offset {record['offset']}.")
+                    with self.metrics.measure("copy", "copy"):
+                        self.copier.resume(record["src"], dst_path, record["offset"], self.journal)
+                    self.metrics.add("files_copied")
+                    self.metrics.add("bytes_copied", src_stat.st_size - record["offset"])
+                else:
+                    os.remove(record["tmp"])
+            except OSError as exception:
+                self.metrics.fail(dst_path, exception)
+        if pending and self.destinations:
+            planner = self.planner()
+            self.run_plan(action for relpath in sorted(pending) for action in planner.plan_path(relpath))
+
+    def device(self) -> int:
+        """
+        Used as fair scheduling key in the shared worker pool: the device written by the job (the first local
+        destination, or folder1 if all the destinations are remote). A folder which does not exist yet is on the
+        device of its nearest existing parent.
+        :return: st_dev of the device
+        """
+        path = os.path.abspath(self.destinations[0] if self.destinations else self.folder1)
         while True:
-            # lock before starting sync
-            with self.sync_lock:
-                logger.info("Sync started.")
-                self._folder_sync()
-                logger.info(f"Sync completed. Next sync after {self.interval.seconds} seconds")
-            time.sleep(self.interval.seconds)
+            try:
+                return os.stat(path).st_dev
+            except FileNotFoundError:
+                if os.path.dirname(path) == path:
+                    raise
+                path = os.path.dirname(path)
 
-    def _scheduled_sync(self) -> None:
+    def planner(self) -> SyncPlanner:
+        # The filter reads the .syncignore files again for every plan
+        return SyncPlanner(self.folder1, self.destinations, self.COMPARE_TIERS[self.compare], self.throttle,
+                           PathFilter(self.folder1, self.filters), self.metrics)
+
+    def print_plan(self, planned=None) -> None:
+        """
+        Used for --dry-run: prints the actions of the sync plan, without applying them.
+        "compare" actions are files whose content is compared during the sync, and replaced only if it differs.
+        :param planned: function called with every action, as (kind, path), instead of printing it
+        :return: None
+        """
+        planned = planned or (lambda kind, path: print(f"{kind:8} {path}"))
+        if self.destinations:
+            for action in self.planner().plan():
+                if action.kind != "skip":
+                    planned(action.kind, os.path.join(action.destination, action.relpath))
+        for remote in self.remotes + self.snapshots:
+            remote.sync(self, planned)
+
+    def _folder_sync(self) -> None:
         """
-        Used to perform folder sync at the scheduled time.
-        After sync is done, notify main function to stop the script execution.
+        Used to generate the sync plan of the whole tree and apply it.
         :return: None
         """
-        if datetime.now() > self.schedule:
-            self.schedule = self.schedule + timedelta(days=1)
-            logger.info(f"Your time has passed today. Scheduled for tomorrow at {self.schedule.strftime('%H:%M')}")
+        self.metrics.reset("full")
+        self.duplicates.clear()
+        try:
+            self.resume()
+            completed = True
+            if self.destinations:
+                try:
+                    self.run_plan(self.planner().plan())
+                except Exception as exception:
+                    # e.g. folder1 could not be listed: the journal is kept, so the next sync resumes this one
+                    self.metrics.fail(self.folder1, exception)
+                    completed = False
+            self.sync_remotes(self.remotes + self.snapshots)
+            if self.index:
+                self.index.commit()
+            if self.journal and completed:
+                self.journal.end()
+        finally:
+            self.publish_metrics()
+        logger.info("Files resolved by change detection tier: " +
+                    ", ".join(f"{tier}={self.metrics.tiers[tier]}"
+                              for tier in ("missing",) + self.COMPARE_TIERS[self.compare]))
 
-        print(f'Sync scheduled for: {self.schedule}')
-        waiting_time = (self.schedule - datetime.now()).seconds
-        logger.info(f'Waiting {waiting_time} seconds before starting scheduled sync')
-        time.sleep(waiting_time)
+    def run_pass(self, reasons: set) -> None:
+        """
+        Used by the scheduler to run a full sync pass.
+        :param reasons: triggers which were coalesced into this pass (e.g. "schedule", "manual")
+        :return: None
+        """
+        job = f" of job [{self.name}]" if self.name else ""
         with self.sync_lock:
-            logger.info("Sync started.")
+            logger.info(f"Sync{job} started ({', '.join(sorted(reasons))}).")
             self._folder_sync()
-            logger.info("Sync completed.")
+            logger.info(f"Sync{job} completed.")
+
+    def sync_paths(self, relpaths: set) -> None:
+        """
+        Syncs only the given paths: files and folders existing in folder1 are synced (folders recursively), the other
+        ones are removed from the local destination folders. Remote folders are fully synced.
+        :param relpaths: paths relative to folder1
+        :return: None
+        """
+        relpaths = {"" if relpath == "." else relpath for relpath in relpaths}
+        # Paths inside a changed folder are synced together with the folder
+        folders = {relpath for relpath in relpaths if os.path.isdir(os.path.join(self.folder1, relpath))}
+        if "" in folders:
+            relpaths = {""}
+        relpaths = [relpath for relpath in relpaths
+                    if not any(relpath.startswith(folder + os.sep) for folder in folders)]
+        self.metrics.reset("paths")
+        self.duplicates.clear()
+        try:
+            self.resume()
+            planner = self.planner()
+            self.run_plan(action for relpath in relpaths for action in planner.plan_path(relpath))
+            # The server manifest is needed anyway, so remote folders are fully synced; snapshots are only recorded by
+            # the full syncs
+            self.sync_remotes(self.remotes)
+            if self.index:
+                self.index.commit()
+            if self.journal:
+                self.journal.end()
+        finally:
+            self.publish_metrics()
+
+    def sync_remotes(self, remotes: list) -> None:
+        """
+        Syncs the sync:// and snapshot:// destinations. A destination which fails (e.g. a server which cannot be
+        reached) is counted as an error, and the other ones are still synced.
+        :param remotes: RemoteDestination and SnapshotStore objects
+        :return: None
+        """
+        for remote in remotes:
+            try:
+                remote.sync(self)
+            except Exception as exception:
+                self.metrics.fail(remote.url, exception)
+
+    def publish_metrics(self) -> None:
+        """
+        Used at the end of every sync: logs a summary of the sync metrics and exports them, if requested.
+        :return: None
+        """
+        self.metrics.add_time("throttle", self.throttle.take_waited())
+        self.metrics.finish()
+        report = self.metrics.report()
+        logger.info(f"Sync metrics: {report['files_scanned']} files scanned, {report['files_copied']} copied "
+                    f"({report['bytes_copied']} bytes), {report['bytes_hashed']} bytes hashed, "
+                    f"{report['deletes']} deletes, {report['errors']} errors in {report['duration_seconds']:.3f}s, "
+                    f"peak memory {report['peak_memory_bytes'] / 1048576:.1f} MB; "
+                    "phase seconds: " + ", ".join(f"{phase}={seconds:.3f}"
+                                                  for phase, seconds in report["phase_seconds"].items()))
+        if self.exporter:
+            try:
+                self.exporter.export(self.metrics)
+            except OSError as exception:
+                logger.error(f"Sync metrics could not be exported: {exception}")
+
+    def _watch_sync(self, watcher: InotifyWatcher) -> None:
+        """
+        Used to sync changes as soon as they are reported by inotify. Events are collected into a set of changed
+        paths until they settle, then only those paths are synced. Full syncs (at start, periodically, when the event
+        queue overflowed or a path sync failed) are run by the scheduler.
+        :param watcher: watcher of folder1, created before the first full sync so no change is missed
+        :return: None
+        """
+        changed = set()
+        while True:
+            changed |= watcher.read_events(None)
+            if watcher.overflow:
+                watcher.overflow = False
+                changed.clear()
+                self.scheduler.trigger("overflow")
+                continue
+            if not changed:
+                continue
+            # Debounce: wait until no event is received for DEBOUNCE seconds
+            debounce_end = time.monotonic() + self.MAX_DEBOUNCE
+            while time.monotonic() < debounce_end and (events := watcher.read_events(self.DEBOUNCE)):
+                changed |= events
+            with self.sync_lock:
+                logger.info(f"Sync of {len(changed)} changed paths started.")
+                try:
+                    self.sync_paths(changed)
+                except Exception as exception:
+                    # A failed path sync is repaired by a full sync
+                    logger.exception(exception)
+                    self.scheduler.trigger("repair")
+                logger.info("Sync of changed paths completed.")
+            changed = set()
+
+    def auto_schedule(self):
+        """
+        Used to create the schedule of the full syncs, accordingly with input parameters: a fixed rate for interval,
+        a daily run for a time (-t), a cron expression as is, and a fixed rate of RECONCILE_INTERVAL for watch mode.
+        :return: FixedRateSchedule or CronSchedule
+        """
+        if self.interval:
+            return FixedRateSchedule(self.interval)
+        if isinstance(self.schedule, datetime):
+            return CronSchedule(f"{self.schedule.minute} {self.schedule.hour} * * *")
+        return self.schedule or FixedRateSchedule(self.RECONCILE_INTERVAL)
 
-    def start_auto_sync(self) -> threading.Thread:
+    def start_auto_sync(self, on_stop=None, on_pass=None) -> threading.Thread:
         """
-        Used to trigger the sync method in a new thread, acordingly with input parameters (schedule or interval).
-        :return: thread object created
+        Used to start the scheduler of the syncs in a new thread (and the inotify watcher thread, in watch mode).
+        Interval and watch syncs start with a full sync.
+        :param on_stop: function called when the scheduler thread stops
+        :param on_pass: function called after every full sync pass (e.g. to prompt the console user)
+        :return: scheduler thread object
         """
-        logger.info(f'- Start sync folder [{self.folder2}] from [{self.folder1}].')
-        sync_thread = threading.Thread(target=self._interval_sync if self.interval else self._scheduled_sync)
+        folders = self.destinations + [remote.url for remote in self.remotes + self.snapshots]
+        logger.info(f'- Start sync folder [{", ".join(folders)}] from [{self.folder1}].')
+        def run_pass(reasons):
+            try:
+                self.run_pass(reasons)
+            finally:
+                if on_pass:
+                    on_pass()
+
+        self.scheduler = SyncScheduler(run_pass, self.auto_schedule(), run_at_start=bool(self.interval) or self.watch)
+        if self.watch:
+            watcher = InotifyWatcher(self.folder1)
+            threading.Thread(target=self._watch_sync, args=(watcher,), daemon=True).start()
+        if self.scrub_budget and self.index and self.destinations:
+            self.scrubber = Scrubber(self, self.scrub_budget, self.scrub_period)
+            self.scrubber.start()
+
+        def run_scheduler():
+            try:
+                self.scheduler.run_forever()
+            finally:
+                if on_stop:
+                    on_stop()
+
+        sync_thread = threading.Thread(target=run_scheduler)
         sync_thread.daemon = True
         sync_thread.start()
         return sync_thread
 
     def manual_sync(self) -> None:
         """
-        Used to trigger on-demand sync, at any time.
+        Used to trigger on-demand sync, at any time. The sync runs in the scheduler thread as soon as the running one
+        (if any) is completed; several triggers received meanwhile result in a single sync.
         :return: None
         """
-        with self.sync_lock:
-            logger.info("Sync started")
-            self._folder_sync()
-            logger.info("Sync completed")
+        self.scheduler.trigger("manual")
+
+
+# Result of sync(): ok is True if no path failed; the counters, failures and timings are those of the metrics report,
+# which is also given whole (report); planned lists the actions of a dry run, as (kind, path)
+SyncReport = namedtuple("SyncReport", ("ok",) + SyncMetrics.COUNTERS +
+                        ("failures", "tiers", "duration_seconds", "peak_memory_bytes", "planned", "report"))
+
+
+def sync(src: str, dst: str | list, dry_run: bool = False, **options) -> SyncReport:
+    """
+    Library entry point: syncs dst from src once, in the calling thread, and returns the metrics of the sync.
+    Nothing is printed, logged (unless the application configured logging) or written outside of dst and the given
+    index and journal files, and errors are raised or reported instead of exiting. Repeated calls should share their
+    index, hash_engine and copier objects, so the digests of unchanged files are not computed again.
+    :param src: source folder (folder1)
+    :param dst: destination folder, or list of destinations (folders, sync://host:port or snapshot://store)
+    :param dry_run: list the actions of the sync plan in the report (planned), without changing dst
+    :param options: FolderSync keyword arguments (compare, workers, filters, dedup, priority...); index, hash_engine
+    and journal could also be given as file paths (index and journal) or algorithm name (hash_engine), in which case
+    they are opened for this call only
+    :return: SyncReport of the sync
+    """
+    if not os.path.isdir(src):
+        raise FileNotFoundError(f"Source folder [{src}] does not exist")
+    # The engines use the I/O limits of the sync; a hash engine created for this call is closed with its threads
+    options.setdefault("throttle", IOThrottle())
+    options.setdefault("hash_engine", "sha256")
+    owned = []
+    if isinstance(options.get("index"), str):
+        options["index"] = FileIndex(options["index"])
+        owned.append(options["index"])
+    if isinstance(options.get("hash_engine"), str):
+        options["hash_engine"] = HashEngine(options["hash_engine"], throttle=options.get("throttle"))
+        owned.append(options["hash_engine"])
+    if isinstance(options.get("journal"), str):
+        options["journal"] = SyncJournal(options["journal"])
+        owned.append(options["journal"])
+    planned = [] if dry_run else None
+    try:
+        folder_sync = FolderSync(src, dst, None, None, **options)
+        if dry_run:
+            folder_sync.print_plan(lambda kind, path: planned.append((kind, path)))
+        else:
+            folder_sync._folder_sync()
+    finally:
+        for opened in owned:
+            opened.close()
+    report = folder_sync.metrics.report()
+    return SyncReport(ok=not report["errors"], **{name: report[name] for name in SyncReport._fields[1:-2]},
+                      planned=planned, report=report)
+
+
+async def sync_async(src: str, dst: str | list, **options) -> SyncReport:
+    """
+    Asynchronous variant of sync(): the sync runs in a thread (asyncio.to_thread), so the event loop is not
+    blocked. The objects given in options must not be used by another sync at the same time, except the index.
+    :return: SyncReport of the sync
+    """
+    import asyncio
+    return await asyncio.to_thread(sync, src, dst, **options)
 
 
-def get_input_thread(read_input: list) -> None:
+def get_input_thread(read_input: queue.Queue) -> None:
     """
-    Read user input from console and append it to a list
-    :param read_input: contains inputs read from console
+    Read user input from console and put it in a queue
+    :param read_input: queue of inputs read from console
     :return: None
     """
     while True:
-        user_input = input().strip().lower()
-        read_input.append(user_input)
+        try:
+            user_input = input().strip().lower()
+        except EOFError:
+            # Console closed: the script keeps running its scheduled syncs
+            break
+        read_input.put(user_input)
         if "quit" == user_input:
             break
 
 
-def main():
-    parser = ParseArguments()
-    interval, schedule = parser.get_interval_schedule()
+def limit_command(throttle: IOThrottle, text: str) -> str:
+    """
+    Handles the 'limit' console command: 'limit' shows the I/O limits, 'limit read|write MB', 'limit ops OPS' change
+    one of them (0 for unlimited) and 'limit off' removes all of them.
+    :param throttle: I/O throttle of the syncs
+    :param text: command typed in console
+    :return: message for the user
+    """
+    words = text.split()
+    if words == ["limit", "off"]:
+        for kind in throttle.limits:
+            throttle.set_limit(kind, 0)
+    elif len(words) == 3 and words[1] in throttle.limits:
+        try:
+            value = float(words[2])
+        except ValueError:
+            value = -1
+        if value < 0:
+            return f"[ERROR] Invalid limit value: {words[2]}"
+        throttle.set_limit(words[1], value if words[1] == "ops" else value * 1048576)
+        logger.info(f"I/O limits changed from console: {throttle.describe()}")
+    elif len(words) != 1:
+        return "Usage: limit [read MB | write MB | ops OPS | off]"
+    return f"I/O limits: {throttle.describe()}"
+
+
+def start_logging(arguments: argparse.Namespace) -> None:
+    """
+    Configures the logger with the logging arguments of a command (see ParseArguments.add_log_arguments).
+    :param arguments: arguments of the command
+    :return: None
+    """
+    setup_logging(arguments.log_file, arguments.log_level, arguments.log_format, arguments.log_max_size * 1048576,
+                  arguments.log_rotate, arguments.log_backups)
+
+
+def serve(arguments: argparse.Namespace) -> None:
+    """
+    Serves a folder to sync clients, until the script is stopped with Ctrl+C.
+    :param arguments: arguments of the 'serve' command
+    :return: None
+    """
+    token = None
+    if arguments.token_file:
+        with open(arguments.token_file, encoding="utf-8") as file:
+            token = file.read().strip()
+    elif not arguments.no_auth:
+        token = os.environ.get(SyncServer.TOKEN_VARIABLE)
+    if not token and not arguments.no_auth:
+        print(f"[ERROR] serve needs a token: set {SyncServer.TOKEN_VARIABLE} or give --token-file (or --no-auth)")
+        exit(0)
+    start_logging(arguments)
+    index = None if arguments.no_index else FileIndex(arguments.index)
+    with SyncServer((arguments.host, arguments.port), arguments.folder, index, not arguments.no_fsync,
+                    token) as server:
+        logger.info(f"- Serving folder [{arguments.folder}] on {arguments.host}:{arguments.port}.")
+        print(f"Serving [{arguments.folder}] on {arguments.host}:{arguments.port}. Press Ctrl+C to stop.")
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            logger.info("Ctrl+C was received, stop serving")
+    if index:
+        index.close()
+
+
+def restore(arguments: argparse.Namespace) -> None:
+    """
+    Restores a snapshot of a snapshot store into a folder.
+    :param arguments: arguments of the 'restore' command
+    :return: None
+    """
+    start_logging(arguments)
+    store = SnapshotStore(arguments.store)
+    ids = store.snapshot_ids()
+    if not ids:
+        print(f"[ERROR] No snapshot in [{arguments.store}]")
+        exit(0)
+    snapshot_id = arguments.snapshot or ids[-1]
+    try:
+        restored = store.restore(snapshot_id, arguments.target, arguments.path)
+    except (OSError, ValueError) as exception:
+        logger.error(f"Restore of snapshot [{snapshot_id}] failed: {exception}")
+        print(f"[ERROR] Restore failed: {exception}")
+        exit(0)
+    logger.info(f"Restored {restored} files of snapshot [{snapshot_id}] into [{arguments.target}].")
+    print(f"Restored {restored} files of snapshot [{snapshot_id}] into [{arguments.target}].")
+
+
+def snapshots(arguments: argparse.Namespace) -> None:
+    """
+    Prints the snapshots of a snapshot store, or the folders and files of one snapshot.
+    :param arguments: arguments of the 'snapshots' command
+    :return: None
+    """
+    store = SnapshotStore(arguments.store)
+    if not arguments.snapshot:
+        for snapshot_id in store.snapshot_ids():
+            try:
+                summary = store.summary(snapshot_id)
+            except OSError:
+                print(snapshot_id)
+                continue
+            print(f"{snapshot_id}  {summary['created'][:19]}  {summary['files']} files  {summary['bytes']} bytes  "
+                  f"{summary['bytes_written']} bytes written  {summary['source']}")
+        return
+    prefix = arguments.path.strip(os.sep)
+    try:
+        for entry in store.read_manifest(arguments.snapshot):
+            if prefix and entry["path"] != prefix and not entry["path"].startswith(prefix + os.sep):
+                continue
+            mtime = datetime.fromtimestamp(entry["mtime_ns"] / 1e9).strftime("%Y-%m-%d %H:%M:%S")
+            kind = "d" if entry.get("dir") else "-"
+            size = "" if entry.get("dir") else entry["size"]
+            print(f"{kind}{stat.filemode(entry['mode'])[1:]} {size:>14} {mtime}  {entry['path']}")
+    except ValueError as exception:
+        print(f"[ERROR] {exception}")
+
+
+def parse_duration(value) -> timedelta:
+    """
+    Parses a duration of the daemon config: a number of seconds, or numbers with units (e.g. "90s", "1h30m", "2d").
+    :param value: duration text or number
+    :return: timedelta object
+    """
+    text = str(value).strip().lower()
+    units = {"s": "seconds", "m": "minutes", "h": "hours", "d": "days"}
+    if text.isdigit():
+        duration = timedelta(seconds=int(text))
+    else:
+        parts = re.findall(r"(\d+)\s*([smhd])", text)
+        if not parts or re.sub(r"\d+\s*[smhd]", "", text).strip():
+            raise ValueError(f"Invalid duration [{value}], use e.g. 90s, 15m, 1h30m or 2d")
+        duration = sum((timedelta(**{units[unit]: int(number)}) for number, unit in parts), timedelta())
+    if not duration:
+        raise ValueError(f"Invalid duration [{value}], it must be greater than 0")
+    return duration
+
+
+def load_daemon_config(path: str) -> tuple:
+    """
+    Reads the daemon config, an INI file or (.toml) a TOML file. The [daemon] section holds the settings shared by all
+    the jobs; every other section is a job, named after the section, e.g.:
+        [daemon]
+        workers = 16
+        write_limit = 50
+        journal_dir = /var/lib/folder_sync
+
+        [photos]
+        source = /data/photos
+        destinations = /backup/photos, sync://nas:8730
+        interval = 1h
+    :param path: config file path
+    :return: (daemon settings dict, list of job dicts)
+    """
+    if path.endswith(".toml"):
+        import tomllib
+        with open(path, 'rb') as file:
+            sections = tomllib.load(file)
+    else:
+        import configparser
+        parser = configparser.ConfigParser(interpolation=None)
+        if not parser.read(path, encoding="utf-8"):
+            raise OSError(f"Config file [{path}] could not be read")
+        sections = {name: dict(parser[name]) for name in parser.sections()}
+
+    def boolean(value) -> bool:
+        return value if isinstance(value, bool) else str(value).strip().lower() in ("1", "yes", "true", "on")
+
+    settings = {"workers": min(32, (os.cpu_count() or 1) + 4), "device_workers": 0, "read_limit": 0,
+                "write_limit": 0, "ops_limit": 0, "latency_target": 0, "index": "folder_sync_index.db",
+                "no_index": False, "report": None, "journal_dir": ".", "no_journal": False, "no_fsync": False,
+                "parallel_copy": FileCopier.PARALLEL_SIZE / 1048576, "copy_streams": FileCopier.STREAMS,
+                "copy_range": FileCopier.RANGE_SIZE / 1048576}
+    for key, value in sections.pop("daemon", {}).items():
+        if key not in settings:
+            raise ValueError(f"Unknown option [{key}] in section [daemon]")
+        settings[key] = boolean(value) if key in ("no_index", "no_journal", "no_fsync") else \
+            value if key in ("index", "report", "journal_dir") else float(value)
+    for key in ("workers", "device_workers", "copy_streams"):
+        settings[key] = int(settings[key])
+
+    jobs = []
+    job_options = {"source", "destinations", "interval", "time", "cron", "watch", "compare", "hash",
+                   "delta_threshold", "compress", "dedup", "include", "exclude", "priority", "priority_patterns",
+                   "background_size", "scrub_budget", "scrub_period"}
+    for name, options in sections.items():
+        unknown = set(options) - job_options
+        if unknown:
+            raise ValueError(f"Unknown option [{', '.join(sorted(unknown))}] in job [{name}]")
+        if "source" not in options or "destinations" not in options:
+            raise ValueError(f"Job [{name}] needs a source and destinations")
+        def listing(value) -> list:
+            # Comma or newline separated values of an INI file, or a TOML list
+            if isinstance(value, str):
+                return [item.strip() for item in re.split(r"[,\n]", value) if item.strip()]
+            return list(value)
+
+        destinations = listing(options["destinations"])
+        job = {"name": name, "source": options["source"], "destinations": destinations,
+               "interval": parse_duration(options["interval"]) if "interval" in options else None,
+               "schedule": None, "watch": boolean(options.get("watch", False)),
+               "compare": options.get("compare", "hash"), "hash": options.get("hash", "sha256"),
+               "delta_threshold": int(options.get("delta_threshold", 0)), "compress": options.get("compress", "none"),
+               "dedup": options.get("dedup"),
+               # Include rules first: they are exceptions to the exclude rules
+               "filters": [(True, pattern) for pattern in listing(options.get("include", []))] +
+                          [(False, pattern) for pattern in listing(options.get("exclude", []))],
+               "priority": options.get("priority"),
+               "priority_patterns": listing(options.get("priority_patterns", [])),
+               "background_size": float(options.get("background_size", 0)),
+               "scrub_budget": float(options.get("scrub_budget", 0)),
+               "scrub_period": parse_duration(options.get("scrub_period", "30d"))}
+        if "time" in options:
+            job["schedule"] = datetime.combine(date.today(), datetime.strptime(str(options["time"])[:5], "%H:%M").time())
+        if "cron" in options:
+            job["schedule"] = CronSchedule(options["cron"])
+        if sum(key in options for key in ("interval", "time", "cron")) > 1 or ("time" in options and job["watch"]):
+            raise ValueError(f"Job [{name}]: interval, time and cron could not be used together, nor time with watch")
+        if not (job["interval"] or job["schedule"] or job["watch"]):
+            raise ValueError(f"Job [{name}] needs an interval, a time, a cron expression or watch")
+        if job["compare"] not in FolderSync.COMPARE_TIERS:
+            raise ValueError(f"Job [{name}]: compare must be one of {', '.join(FolderSync.COMPARE_TIERS)}")
+        if job["hash"] not in HashEngine.available_algorithms():
+            raise ValueError(f"Job [{name}]: hash must be one of {', '.join(HashEngine.available_algorithms())}")
+        if job["compress"] not in SyncConnection.available_compressions():
+            raise ValueError(f"Job [{name}]: compress must be one of "
+                             f"{', '.join(SyncConnection.available_compressions())}")
+        if job["dedup"] not in (None, "reflink", "link"):
+            raise ValueError(f"Job [{name}]: dedup must be reflink or link")
+        if job["priority"] not in (None, "mtime", "size", "patterns"):
+            raise ValueError(f"Job [{name}]: priority must be mtime, size or patterns")
+        if job["watch"] and not sys.platform.startswith("linux"):
+            raise ValueError(f"Job [{name}]: watch is supported only on Linux")
+        jobs.append(job)
+    if not jobs:
+        raise ValueError(f"Config file [{path}] has no job")
+    return settings, jobs
+
+
+def daemon(arguments: argparse.Namespace) -> None:
+    """
+    Runs all the jobs of the daemon config, each with its own schedule, until the script is stopped with Ctrl+C or
+    SIGTERM. The jobs share one worker pool (fair between the jobs of a device), one I/O budget and one digest index.
+    :param arguments: arguments of the 'daemon' command
+    :return: None
+    """
+    start_logging(arguments)
+    try:
+        settings, jobs = load_daemon_config(arguments.config)
+    except (OSError, ValueError, KeyError) as exception:
+        print(f"[ERROR] Invalid daemon config: {exception}")
+        exit(0)
+
+    index = None if settings["no_index"] else FileIndex(settings["index"])
+    throttle = IOThrottle(settings["read_limit"] * 1048576, settings["write_limit"] * 1048576,
+                          settings["ops_limit"],
+                          settings["latency_target"] / 1000 if settings["latency_target"] else None)
+    pool = SharedWorkerPool(settings["workers"], settings["device_workers"])
+    exporter = MetricsExporter(settings["report"]) if settings["report"] else None
+    hash_engines = {}
+    fsync = not settings["no_fsync"]
+    # Names of the jobs whose scheduler stopped
+    stopped = queue.Queue()
+    folder_syncs = []
+    for job in jobs:
+        if job["hash"] not in hash_engines:
+            hash_engines[job["hash"]] = HashEngine(job["hash"], throttle=throttle)
+        delta = DeltaTransfer(job["delta_threshold"] * 1048576, throttle, fsync) if job["delta_threshold"] else None
+        journal = None if settings["no_journal"] else \
+            SyncJournal(SyncJournal.default_path(job["source"], job["destinations"], settings["journal_dir"]))
+        folder_sync = FolderSync(job["source"], job["destinations"], job["interval"], job["schedule"], index,
+                                 job["compare"], hash_engines[job["hash"]], delta, job["watch"],
+                                 FileCopier(throttle, fsync, settings["copy_streams"],
+                                            int(settings["copy_range"] * 1048576),
+                                            int(settings["parallel_copy"] * 1048576)),
+                                 settings["workers"], job["compress"], exporter,
+                                 throttle, pool, job["name"], journal, job["dedup"], job["filters"], job["priority"],
+                                 job["priority_patterns"], int(job["background_size"] * 1048576),
+                                 int(job["scrub_budget"] * 1048576), job["scrub_period"])
+        folder_sync.start_auto_sync(on_stop=lambda name=job["name"]: stopped.put(name))
+        folder_syncs.append(folder_sync)
+    logger.info(f"- Daemon started with {len(jobs)} jobs, {settings['workers']} workers, I/O limits: "
+                f"{throttle.describe()}")
+    print(f"Daemon running {len(jobs)} jobs. Press Ctrl+C to stop.")
+
+    # SIGTERM stops the daemon like Ctrl+C
+    signal.signal(signal.SIGTERM, signal.default_int_handler)
+    try:
+        for _ in folder_syncs:
+            logger.error(f"Job [{stopped.get()}] stopped")
+        logger.error("All the jobs stopped, stop the daemon")
+    except KeyboardInterrupt:
+        logger.info("Stop signal was received, stop the daemon")
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+    # The scrubbers use the index until they are stopped
+    for folder_sync in folder_syncs:
+        if folder_sync.scrubber:
+            folder_sync.scrubber.stopped.set()
+    for folder_sync in folder_syncs:
+        if folder_sync.scrubber:
+            folder_sync.scrubber.stop()
+        folder_sync.scheduler.stop()
+    # Running syncs are completed before the index is closed
+    for folder_sync in folder_syncs:
+        folder_sync.sync_lock.acquire()
+    pool.shutdown()
+    if index:
+        index.close()
+    for folder_sync in folder_syncs:
+        if folder_sync.journal:
+            folder_sync.journal.close()
+    for hash_engine in hash_engines.values():
+        hash_engine.close()
+    if exporter:
+        exporter.close()
+
+
+def main(argv: list | None = None):
+    """
+    Runs the script command line.
+    :param argv: command line arguments, sys.argv[1:] by default
+    """
+    argv = sys.argv[1:] if argv is None else argv
+    if argv[:1] == ["serve"]:
+        serve(ParseArguments.parse_serve_arguments(argv[1:]))
+        return
+    if argv[:1] == ["daemon"]:
+        daemon(ParseArguments.parse_daemon_arguments(argv[1:]))
+        return
+    if argv[:1] == ["restore"]:
+        restore(ParseArguments.parse_restore_arguments(argv[1:]))
+        return
+    if argv[:1] == ["snapshots"]:
+        snapshots(ParseArguments.parse_snapshots_arguments(argv[1:]))
+        return
+    parser = ParseArguments(argv)
+    start_logging(parser.arguments)
+    interval, schedule = (None, None) if parser.arguments.dry_run else parser.get_interval_schedule()
+    if parser.arguments.watch and not sys.platform.startswith("linux"):
+        print("[ERROR] -w is supported only on Linux")
+        exit(0)
+    if parser.arguments.scrub_budget and parser.arguments.no_index:
+        print("[ERROR] --scrub-budget needs the digest index")
+        exit(0)
 
-    folder_sync = FolderSync(parser.arguments.folder1, parser.arguments.folder2, interval, schedule)
-    auto_sync = folder_sync.start_auto_sync()
+    index = None if parser.arguments.no_index else FileIndex(parser.arguments.index)
+    throttle = IOThrottle(parser.arguments.read_limit * 1048576, parser.arguments.write_limit * 1048576,
+                          parser.arguments.ops_limit,
+                          parser.arguments.latency_target / 1000 if parser.arguments.latency_target else None)
+    hash_engine = HashEngine(parser.arguments.hash, parser.arguments.hash_processes, throttle)
+    fsync = not parser.arguments.no_fsync
+    delta = DeltaTransfer(parser.arguments.delta_threshold * 1048576, throttle, fsync) \
+        if parser.arguments.delta_threshold else None
+    journal = None
+    if not parser.arguments.dry_run and not parser.arguments.no_journal:
+        journal = SyncJournal(parser.arguments.journal or
+                              SyncJournal.default_path(parser.arguments.folder1, parser.arguments.folder2))
+    exporter = None
+    if not parser.arguments.dry_run and \
+            (parser.arguments.report or parser.arguments.prometheus or parser.arguments.metrics_port):
+        exporter = MetricsExporter(parser.arguments.report, parser.arguments.prometheus, parser.arguments.metrics_port,
+                                   parser.arguments.metrics_host)
+    folder_sync = FolderSync(parser.arguments.folder1, parser.arguments.folder2, interval, schedule, index,
+                             parser.arguments.compare, hash_engine, delta, parser.arguments.watch,
+                             FileCopier(throttle, fsync, parser.arguments.copy_streams,
+                                        int(parser.arguments.copy_range * 1048576),
+                                        int(parser.arguments.parallel_copy * 1048576)),
+                             parser.arguments.workers, parser.arguments.compress,
+                             exporter, throttle, journal=journal, dedup=parser.arguments.dedup,
+                             filters=parser.arguments.filters, priority=parser.arguments.priority,
+                             priority_patterns=parser.arguments.priority_patterns,
+                             background_size=int(parser.arguments.background_size * 1048576),
+                             scrub_budget=int(parser.arguments.scrub_budget * 1048576),
+                             scrub_period=parser.arguments.scrub_period)
+    if parser.arguments.dry_run:
+        folder_sync.print_plan()
+    else:
+        # Console commands, the end time of every sync pass, and None when the scheduler thread stopped
+        commands = queue.Queue()
+        folder_sync.start_auto_sync(on_stop=lambda: commands.put(None), on_pass=lambda: commands.put(datetime.now()))
+        if folder_sync.scheduler.schedule:
+            print(f"Sync scheduled {folder_sync.scheduler.schedule}. "
+                  f"Next sync: {folder_sync.scheduler.schedule.next_run(datetime.now())}")
 
-    # Start a dedicated thread to read user input from console
-    input_list = []
-    input_thread = threading.Thread(target=get_input_thread, args=(input_list,))
-    input_thread.daemon = True
-    input_thread.start()
+        # Start a dedicated thread to read user input from console
+        input_thread = threading.Thread(target=get_input_thread, args=(commands,))
+        input_thread.daemon = True
+        input_thread.start()
 
-    print("Type 'sync' to trigger sync now or 'quit' to stop the script.")
-    while auto_sync.is_alive():
-        if input_list:
-            text = input_list.pop(0)
-            print(text)
+        print("Type 'sync' to trigger sync now, 'limit' to show or change the I/O limits or 'quit' to stop the script.")
+        while (text := commands.get()) is not None:
+            if isinstance(text, datetime):
+                print(f"Last sync: {text}. Type 'sync' to trigger sync now or 'quit' to stop the script.")
+                continue
             if "sync" == text:
                 folder_sync.manual_sync()
+            if text.startswith("limit"):
+                print(limit_command(throttle, text))
             if "quit" == text:
                 logger.info("'quit' was received, stop the script")
+                if folder_sync.scrubber:
+                    folder_sync.scrubber.stop()
+                folder_sync.scheduler.stop()
+                # A running sync is completed before the index is closed
+                folder_sync.sync_lock.acquire()
                 break
-        time.sleep(1)
+        # The scheduler thread could also have stopped by itself: the scrubber uses the index until it is stopped
+        if folder_sync.scrubber:
+            folder_sync.scrubber.stop()
+    if index:
+        index.close()
+    if journal:
+        journal.close()
+    hash_engine.close()
+    if exporter:
+        exporter.close()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,32 @@
+import os
+import sys
+
+import pytest
+
+# sync_folders.py is a script, imported from its folder
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+def write_file(path, content) -> None:
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'wb') as file:
+        file.write(content.encode() if isinstance(content, str) else content)
+
+
+def read_tree(root) -> dict:
+    """
+    :return: {path relative to root: content} of the files of root
+    """
+    tree = {}
+    for folder, _, files in os.walk(root):
+        for name in files:
+            with open(os.path.join(folder, name), 'rb') as file:
+                tree[os.path.relpath(os.path.join(folder, name), root)] = file.read()
+    return tree
+
+
+@pytest.fixture
+def folders(tmp_path):
+    src, dst = tmp_path / "src", tmp_path / "dst"
+    src.mkdir()
+    return str(src), str(dst)
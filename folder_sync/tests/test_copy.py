@@ -0,0 +1,72 @@
+import errno
+import os
+import stat
+
+import pytest
+
+import sync_folders as sf
+from conftest import write_file
+
+
+def unsupported(*args):
+    raise OSError(errno.EOPNOTSUPP, "not supported")
+
+
+@pytest.fixture
+def source(tmp_path):
+    path = str(tmp_path / "src")
+    write_file(path, os.urandom(300000))
+    os.chmod(path, 0o640)
+    os.utime(path, ns=(1_600_000_000 * 10 ** 9, 1_600_000_000 * 10 ** 9))
+    return path
+
+
+def assert_copied(src_path, dst_path):
+    with open(src_path, 'rb') as src, open(dst_path, 'rb') as dst:
+        assert src.read() == dst.read()
+    assert os.stat(dst_path).st_mtime_ns == os.stat(src_path).st_mtime_ns
+    assert stat.S_IMODE(os.stat(dst_path).st_mode) == 0o640
+    assert not os.path.exists(dst_path + sf.TEMP_SUFFIX)
+
+
+def test_copy_keeps_content_and_metadata(source, tmp_path):
+    method = sf.FileCopier().copy(source, str(tmp_path / "dst"))
+    assert method in sf.FileCopier.METHODS
+    assert_copied(source, str(tmp_path / "dst"))
+
+
+@pytest.mark.parametrize("methods, expected", [
+    (("reflink",), "copy_file_range"),
+    (("reflink", "copy_file_range"), "sendfile"),
+    (("reflink", "copy_file_range", "sendfile"), "buffered"),
+])
+def test_unsupported_methods_fall_back(source, tmp_path, methods, expected):
+    copier = sf.FileCopier()
+    if expected not in copier.available_methods((0, 0)):
+        pytest.skip(f"{expected} is not available on this platform")
+    calls = []
+    for method in methods:
+        setattr(copier, f"_copy_{method}", lambda *args, method=method: calls.append(method) or unsupported())
+    assert copier.copy(source, str(tmp_path / "dst")) == expected
+    assert_copied(source, str(tmp_path / "dst"))
+    # The unsupported methods are not tried again for the same devices
+    assert copier.copy(source, str(tmp_path / "dst2")) == expected
+    assert calls == list(methods)
+
+
+def test_copy_error_is_raised_and_the_temporary_file_removed(source, tmp_path):
+    copier = sf.FileCopier()
+
+    def failing(src, dst, *args):
+        dst.write(b"partial")
+        raise OSError(errno.EIO, "I/O error")
+
+    for method in sf.FileCopier.METHODS:
+        setattr(copier, f"_copy_{method}", failing)
+    dst_path = str(tmp_path / "dst")
+    write_file(dst_path, "old")
+    with pytest.raises(OSError):
+        copier.copy(source, dst_path)
+    assert not os.path.exists(dst_path + sf.TEMP_SUFFIX)
+    with open(dst_path) as file:
+        assert file.read() == "old"
@@ -0,0 +1,144 @@
+import threading
+from datetime import timedelta
+
+import pytest
+
+import sync_folders as sf
+
+
+@pytest.mark.parametrize("value, expected", [
+    ("90", timedelta(seconds=90)),
+    (300, timedelta(minutes=5)),
+    ("15m", timedelta(minutes=15)),
+    ("1h30m", timedelta(hours=1, minutes=30)),
+    ("2d", timedelta(days=2)),
+])
+def test_parse_duration(value, expected):
+    assert sf.parse_duration(value) == expected
+
+
+@pytest.mark.parametrize("value", ["", "0", "0s", "1x", "1h foo", "h"])
+def test_parse_duration_invalid(value):
+    with pytest.raises(ValueError):
+        sf.parse_duration(value)
+
+
+def test_load_ini_config(tmp_path):
+    config = tmp_path / "daemon.ini"
+    config.write_text("""
+[daemon]
+workers = 8
+device_workers = 2
+write_limit = 50
+no_fsync = yes
+
+[photos]
+source = /data/photos
+destinations = /backup/photos, sync://nas:8730
+interval = 1h
+
+[documents]
+source = /data/documents
+destinations = /backup/documents
+cron = */15 8-18 * * mon-fri
+compare = quick
+exclude = .git/, *.tmp
+""")
+    settings, jobs = sf.load_daemon_config(str(config))
+    assert (settings["workers"], settings["device_workers"]) == (8, 2)
+    assert settings["write_limit"] == 50 and settings["no_fsync"] is True
+    photos, documents = jobs
+    assert photos["name"] == "photos"
+    assert photos["destinations"] == ["/backup/photos", "sync://nas:8730"]
+    assert photos["interval"] == timedelta(hours=1) and photos["schedule"] is None
+    assert isinstance(documents["schedule"], sf.CronSchedule)
+    assert documents["compare"] == "quick"
+    assert documents["filters"] == [(False, ".git/"), (False, "*.tmp")]
+
+
+def test_load_toml_config(tmp_path):
+    config = tmp_path / "daemon.toml"
+    config.write_text("""
+[daemon]
+workers = 4
+
+[photos]
+source = "/data/photos"
+destinations = ["/backup/photos", "/backup2/photos"]
+watch = true
+""")
+    settings, jobs = sf.load_daemon_config(str(config))
+    assert settings["workers"] == 4
+    assert jobs[0]["destinations"] == ["/backup/photos", "/backup2/photos"]
+    assert jobs[0]["watch"] is True
+
+
+@pytest.mark.parametrize("config", [
+    "[daemon]\nthreads = 4\n[job]\nsource = a\ndestinations = b\ninterval = 1h\n",
+    "[job]\nsource = a\ndestinations = b\ninterval = 1h\nspeed = 2\n",
+    "[job]\nsource = a\ninterval = 1h\n",
+    "[job]\nsource = a\ndestinations = b\n",
+    "[job]\nsource = a\ndestinations = b\ninterval = 1h\ncron = @daily\n",
+    "[job]\nsource = a\ndestinations = b\ninterval = 1h\ncompare = size\n",
+    "[daemon]\nworkers = 4\n",
+])
+def test_invalid_config(tmp_path, config):
+    path = tmp_path / "daemon.ini"
+    path.write_text(config)
+    with pytest.raises(ValueError):
+        sf.load_daemon_config(str(path))
+
+
+def test_pool_takes_the_jobs_of_a_device_in_turn():
+    pool = sf.SharedWorkerPool(1)
+    gate = threading.Event()
+    order = []
+    done = threading.Semaphore(0)
+    pool.submit("disk", "gate", gate.wait, (5,), lambda error: None)
+    for task in ("a1", "a2", "a3"):
+        pool.submit("disk", "a", order.append, (task,), lambda error: done.release())
+    pool.submit("disk", "b", order.append, ("b1",), lambda error: done.release())
+    gate.set()
+    for _ in range(4):
+        assert done.acquire(timeout=5)
+    pool.shutdown()
+    assert order == ["a1", "b1", "a2", "a3"]
+
+
+def test_pool_limits_the_tasks_running_on_a_device():
+    pool = sf.SharedWorkerPool(6, device_workers=2)
+    lock = threading.Lock()
+    running = {"ssd": 0, "hdd": 0}
+    peak = {"ssd": 0, "hdd": 0}
+
+    def task(device):
+        with lock:
+            running[device] += 1
+            peak[device] = max(peak[device], running[device])
+        threading.Event().wait(0.02)
+        with lock:
+            running[device] -= 1
+
+    executors = [pool.executor(device, job, 8) for device in ("ssd", "hdd") for job in ("a", "b")]
+    for _ in range(6):
+        for executor in executors:
+            executor.submit(task, executor.device)
+    for executor in executors:
+        with executor:
+            pass
+        assert not executor.errors
+    pool.shutdown()
+    assert peak == {"ssd": 2, "hdd": 2}
+
+
+def test_job_executor_collects_errors():
+    pool = sf.SharedWorkerPool(2)
+
+    def fail():
+        raise OSError("failed")
+
+    with pool.executor("disk", "job", 2) as executor:
+        executor.submit(fail)
+        executor.submit(int, "1")
+    pool.shutdown()
+    assert [str(error) for error in executor.errors] == ["failed"]
@@ -0,0 +1,51 @@
+import os
+
+import sync_folders as sf
+from conftest import write_file, read_tree
+
+
+def test_delta_sync_of_a_linked_duplicate_keeps_the_other_link(folders, monkeypatch):
+    src, dst = folders
+    content = os.urandom(256 * 1024)
+    write_file(os.path.join(src, "h1", "one.bin"), content)
+    write_file(os.path.join(src, "h2", "one.bin"), content)
+    os.utime(os.path.join(src, "h1", "one.bin"), ns=(10 ** 18, 10 ** 18))
+    os.utime(os.path.join(src, "h2", "one.bin"), ns=(10 ** 18, 10 ** 18))
+    # Filesystem without reflink: the duplicates with the same metadata are hard linked
+    monkeypatch.setattr(sf.FileCopier, "clone", lambda self, *args: False)
+    report = sf.sync(src, dst, dedup="link", delta=sf.DeltaTransfer(1024))
+    assert report.ok and report.files_linked == 1
+    assert os.path.samefile(os.path.join(dst, "h1", "one.bin"), os.path.join(dst, "h2", "one.bin"))
+
+    changed = bytearray(content)
+    changed[100000:100100] = b"x" * 100
+    write_file(os.path.join(src, "h1", "one.bin"), bytes(changed))
+    report = sf.sync(src, dst, dedup="link", delta=sf.DeltaTransfer(1024))
+    assert report.ok
+    assert read_tree(dst) == read_tree(src)
+
+
+def test_duplicates_with_other_metadata_are_copied(folders, monkeypatch):
+    src, dst = folders
+    for name, mode, mtime_ns in (("a.bin", 0o644, 10 ** 18), ("b.bin", 0o644, 2 * 10 ** 18),
+                                 ("c.bin", 0o600, 10 ** 18)):
+        write_file(os.path.join(src, name), b"same content")
+        os.chmod(os.path.join(src, name), mode)
+        os.utime(os.path.join(src, name), ns=(mtime_ns, mtime_ns))
+    monkeypatch.setattr(sf.FileCopier, "clone", lambda self, *args: False)
+    report = sf.sync(src, dst, dedup="link")
+    assert report.ok and report.files_linked == 0
+    for name in ("a.bin", "b.bin", "c.bin"):
+        src_stat, dst_stat = os.stat(os.path.join(src, name)), os.stat(os.path.join(dst, name))
+        assert dst_stat.st_nlink == 1
+        assert (dst_stat.st_mode, dst_stat.st_mtime_ns) == (src_stat.st_mode, src_stat.st_mtime_ns)
+
+
+def test_copy_does_not_write_through_a_stale_linked_temporary_file(folders):
+    src, dst = folders
+    write_file(os.path.join(src, "a.txt"), "new content")
+    write_file(os.path.join(dst, "b.txt"), "kept")
+    # Left by an interrupted hard link of b.txt to a.txt
+    os.link(os.path.join(dst, "b.txt"), os.path.join(dst, "a.txt" + sf.TEMP_SUFFIX))
+    sf.FileCopier().copy(os.path.join(src, "a.txt"), os.path.join(dst, "a.txt"))
+    assert read_tree(dst) == {"a.txt": b"new content", "b.txt": b"kept"}
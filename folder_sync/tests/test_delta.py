@@ -0,0 +1,63 @@
+import os
+import random
+
+import pytest
+
+import sync_folders as sf
+from conftest import write_file
+
+BASE = random.Random(1).randbytes(300 * 1024)
+
+
+@pytest.mark.parametrize("change", [
+    lambda data: data,
+    lambda data: data[:100000] + b"x" * 500 + data[100500:],
+    lambda data: data[:100000] + b"inserted" * 1000 + data[100000:],
+    lambda data: data[:50000] + data[90000:],
+    lambda data: data + b"appended" * 100,
+    lambda data: data[:200000],
+    lambda data: data[150000:] + data[:150000],
+    lambda data: random.Random(2).randbytes(1000),
+])
+def test_delta_rebuilds_the_source(tmp_path, change):
+    src, dst = str(tmp_path / "src.bin"), str(tmp_path / "dst.bin")
+    write_file(src, change(BASE))
+    write_file(dst, BASE)
+    sf.DeltaTransfer(1024).sync_file(src, dst)
+    with open(dst, 'rb') as file:
+        assert file.read() == change(BASE)
+    assert os.stat(dst).st_mtime_ns == os.stat(src).st_mtime_ns
+    assert not os.path.exists(dst + sf.TEMP_SUFFIX)
+
+
+def test_delta_writes_only_the_changed_regions(tmp_path):
+    src, dst = str(tmp_path / "src.bin"), str(tmp_path / "dst.bin")
+    write_file(src, BASE[:100000] + b"inserted" + BASE[100000:])
+    write_file(dst, BASE)
+    delta = sf.DeltaTransfer(1024)
+    block_size = delta.block_size_for(os.path.getsize(src))
+    operations = delta.delta(src, delta.signature(dst, block_size), block_size)
+    assert sum(length for kind, _, length in operations if kind == "data") <= 2 * block_size + len(b"inserted")
+
+
+def test_delta_patch_in_place_keeps_the_inode(tmp_path):
+    src, dst = str(tmp_path / "src.bin"), str(tmp_path / "dst.bin")
+    write_file(src, BASE[:100000] + b"y" * 10 + BASE[100010:])
+    write_file(dst, BASE)
+    inode = os.stat(dst).st_ino
+    written = sf.DeltaTransfer(1024).sync_file(src, dst)
+    assert os.stat(dst).st_ino == inode
+    assert written < len(BASE) // 10
+
+
+def test_sync_updates_big_files_with_a_delta(folders):
+    src, dst = folders
+    write_file(os.path.join(src, "big"), BASE[:100000] + b"z" * 10 + BASE[100010:])
+    write_file(os.path.join(src, "small"), "small")
+    write_file(os.path.join(dst, "big"), BASE)
+    report = sf.sync(src, dst, delta=sf.DeltaTransfer(100 * 1024))
+    assert report.ok and report.files_copied == 2
+    # The small file is copied in full, only a few blocks of the big one are written
+    assert len("small") < report.bytes_copied < len("small") + len(BASE) // 10
+    with open(os.path.join(dst, "big"), 'rb') as file:
+        assert file.read() == BASE[:100000] + b"z" * 10 + BASE[100010:]
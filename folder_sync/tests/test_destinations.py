@@ -0,0 +1,48 @@
+import os
+from contextlib import contextmanager
+
+import sync_folders as sf
+from conftest import write_file, read_tree
+
+
+class CountingThrottle(sf.IOThrottle):
+    """
+    Counts the bytes read through the throttle, without limiting them.
+    """
+    def __init__(self):
+        super().__init__()
+        self.read = 0
+
+    @contextmanager
+    def io(self, read=0, write=0, ops=0):
+        self.read += read
+        yield
+
+
+def test_folder1_is_read_once_for_all_destinations(folders, tmp_path):
+    src, _ = folders
+    sizes = {"a": 300000, os.path.join("sub", "b"): 5000, "c": 1}
+    for name, size in sizes.items():
+        write_file(os.path.join(src, name), os.urandom(size))
+    destinations = [str(tmp_path / f"dst{i}") for i in range(3)]
+    throttle = CountingThrottle()
+    report = sf.sync(src, destinations, throttle=throttle)
+    assert report.ok and report.files_copied == 3 * len(sizes)
+    # Cloned destinations (reflink) read nothing, the other ones share the reads
+    assert throttle.read <= sum(sizes.values())
+    for destination in destinations:
+        assert read_tree(destination) == read_tree(src)
+
+
+def test_only_stale_destinations_are_written(folders, tmp_path):
+    src, _ = folders
+    write_file(os.path.join(src, "a"), "new")
+    fresh, stale = str(tmp_path / "fresh"), str(tmp_path / "stale")
+    write_file(os.path.join(fresh, "a"), "new")
+    write_file(os.path.join(stale, "a"), "old")
+    write_file(os.path.join(stale, "removed"), "removed")
+    report = sf.sync(src, [fresh, stale])
+    assert report.ok and report.files_copied == 1 and report.deletes == 1
+    # folder1 "a" is hashed once, for both destinations
+    assert report.bytes_hashed == 3 * len("new")
+    assert read_tree(fresh) == read_tree(stale) == {"a": b"new"}
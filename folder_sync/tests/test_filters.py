@@ -0,0 +1,62 @@
+import os
+
+import pytest
+
+import sync_folders as sf
+from conftest import write_file, read_tree
+
+
+@pytest.mark.parametrize("pattern, relpath, is_dir, expected", [
+    ("*.tmp", "a.tmp", False, False),
+    ("*.tmp", "x/y/a.tmp", False, False),
+    ("*.tmp", "a.tmpx", False, None),
+    ("build/", "build", True, False),
+    ("build/", "build", False, None),
+    ("build/", "src/build", True, False),
+    ("/dist", "dist", True, False),
+    ("/dist", "src/dist", True, None),
+    ("a/b", "a/b", False, False),
+    ("a/b", "x/a/b", False, None),
+    ("a/*.c", "a/x.c", False, False),
+    ("a/*.c", "a/x/y.c", False, None),
+    ("a/**.c", "a/x/y.c", False, False),
+    ("**/cache", "cache", True, False),
+    ("**/cache", "x/y/cache", True, False),
+    ("file?.txt", "file1.txt", False, False),
+    ("file?.txt", "file10.txt", False, None),
+    ("[ab].txt", "b.txt", False, False),
+    ("[!ab].txt", "b.txt", False, None),
+    ("[!ab].txt", "c.txt", False, False),
+])
+def test_pattern_semantics(pattern, relpath, is_dir, expected):
+    assert sf.FilterRules([(False, pattern)]).match(relpath, is_dir) is expected
+
+
+def test_first_matching_rule_decides():
+    rules = sf.FilterRules([(True, "keep.log"), (False, "*.log"), (True, "*")])
+    assert rules.match("keep.log", False) is True
+    assert rules.match("x/other.log", False) is False
+    assert rules.match("x/other.txt", False) is True
+    assert rules.first_match("x/other.txt", False) == 2
+
+
+def test_parse_syncignore_lines():
+    rules = sf.FilterRules.parse(["# comment", "", "+ important.tmp", "- *.tmp", "cache/"], base="sub")
+    assert rules.match("sub/important.tmp", False) is True
+    assert rules.match("sub/x.tmp", False) is False
+    assert rules.match("sub/cache", True) is False
+    assert rules.match("sub/cache.txt", False) is None
+
+
+def test_excluded_paths_are_neither_copied_nor_removed(folders):
+    src, dst = folders
+    write_file(os.path.join(src, "a.txt"), "a")
+    write_file(os.path.join(src, "a.tmp"), "tmp")
+    write_file(os.path.join(src, "sub", ".syncignore"), "+ keep.log\n*.log\n")
+    write_file(os.path.join(src, "sub", "keep.log"), "keep")
+    write_file(os.path.join(src, "sub", "drop.log"), "drop")
+    write_file(os.path.join(dst, "old.tmp"), "old")
+    report = sf.sync(src, dst, filters=[(False, "*.tmp")])
+    assert report.ok
+    assert read_tree(dst) == {"a.txt": b"a", "old.tmp": b"old", os.path.join("sub", "keep.log"): b"keep",
+                              os.path.join("sub", ".syncignore"): b"+ keep.log\n*.log\n"}
@@ -0,0 +1,56 @@
+import os
+
+import sync_folders as sf
+from conftest import write_file
+
+
+def test_unchanged_files_are_not_hashed_again(folders, tmp_path):
+    src, dst = folders
+    for name in ("a", "b", "c"):
+        write_file(os.path.join(src, name), name * 1000)
+        write_file(os.path.join(dst, name), name * 1000)
+    index = sf.FileIndex(str(tmp_path / "index.db"))
+    first = sf.sync(src, dst, index=index)
+    assert first.ok and first.bytes_hashed == 6 * 1000 and first.files_copied == 0
+
+    second = sf.sync(src, dst, index=index)
+    assert second.ok and second.bytes_hashed == 0 and second.files_copied == 0
+    index.close()
+
+
+def test_index_is_kept_between_processes(folders, tmp_path):
+    src, dst = folders
+    write_file(os.path.join(src, "a"), "a" * 1000)
+    write_file(os.path.join(dst, "a"), "a" * 1000)
+    assert sf.sync(src, dst, index=str(tmp_path / "index.db")).bytes_hashed == 2000
+    # Reopened from its file, as by the next run of the script
+    assert sf.sync(src, dst, index=str(tmp_path / "index.db")).bytes_hashed == 0
+
+
+def test_changed_file_is_hashed_again(folders, tmp_path):
+    src, dst = folders
+    write_file(os.path.join(src, "a"), "a" * 1000)
+    write_file(os.path.join(dst, "a"), "a" * 1000)
+    index = sf.FileIndex(str(tmp_path / "index.db"))
+    sf.sync(src, dst, index=index)
+    write_file(os.path.join(src, "a"), "b" * 1000)
+    stat_result = os.stat(os.path.join(dst, "a"))
+    os.utime(os.path.join(src, "a"), ns=(stat_result.st_atime_ns, stat_result.st_mtime_ns + 10 ** 9))
+
+    report = sf.sync(src, dst, index=index)
+    assert report.files_copied == 1 and report.bytes_hashed == 1000
+    with open(os.path.join(dst, "a")) as file:
+        assert file.read() == "b" * 1000
+    index.close()
+
+
+def test_digest_of_another_algorithm_is_not_trusted(tmp_path):
+    path = str(tmp_path / "a")
+    write_file(path, "a")
+    index = sf.FileIndex(str(tmp_path / "index.db"))
+    index.set_digest(path, os.stat(path), "digest", "md5")
+    assert index.get_digest(path, os.stat(path), "md5") == "digest"
+    assert index.get_digest(path, os.stat(path), "sha256") is None
+    index.remove(str(tmp_path))
+    assert index.get_digest(path, os.stat(path), "md5") is None
+    index.close()
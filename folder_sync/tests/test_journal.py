@@ -0,0 +1,94 @@
+import os
+import threading
+
+import sync_folders as sf
+from conftest import write_file, read_tree
+
+
+def interrupted_journal(path, src, dst, offset):
+    """
+    Writes the journal of a sync interrupted while copying src/big (offset bytes were fsynced) with the batch of
+    x/small not done.
+    """
+    journal = sf.SyncJournal(path)
+    journal.begin()
+    journal.batch(["x/small"])
+    src_path, dst_path = os.path.join(src, "big"), os.path.join(dst, "big")
+    journal.copy_started(src_path, dst_path, dst_path + sf.TEMP_SUFFIX, os.stat(src_path))
+    with open(src_path, 'rb') as source:
+        write_file(dst_path + sf.TEMP_SUFFIX, source.read(offset))
+    journal.write({"op": "offset", "dst": dst_path, "offset": offset})
+    journal.close()
+
+
+def test_resume_after_interruption(folders, tmp_path):
+    src, dst = folders
+    write_file(os.path.join(src, "big"), os.urandom(3 * 1048576))
+    write_file(os.path.join(src, "x", "small"), "small")
+    os.makedirs(dst)
+    journal_path = str(tmp_path / "journal.jsonl")
+    interrupted_journal(journal_path, src, dst, 1048576)
+
+    report = sf.sync(src, dst, journal=journal_path)
+    assert report.ok, report.failures
+    assert read_tree(dst) == read_tree(src)
+    # Only the rest of the big file was copied
+    assert report.bytes_copied == 2 * 1048576 + len("small")
+    assert not os.path.exists(journal_path)
+
+
+def test_resume_discards_a_temporary_file_of_a_changed_source(folders, tmp_path):
+    src, dst = folders
+    write_file(os.path.join(src, "big"), os.urandom(2 * 1048576))
+    write_file(os.path.join(src, "x", "small"), "small")
+    os.makedirs(dst)
+    journal_path = str(tmp_path / "journal.jsonl")
+    interrupted_journal(journal_path, src, dst, 1048576)
+    write_file(os.path.join(src, "big"), os.urandom(1048576))
+
+    report = sf.sync(src, dst, journal=journal_path)
+    assert report.ok, report.failures
+    assert read_tree(dst) == read_tree(src)
+
+
+def test_journal_is_kept_when_the_sync_fails(folders, tmp_path):
+    src, dst = folders
+    write_file(os.path.join(src, "a"), "a")
+    journal_path = str(tmp_path / "journal.jsonl")
+    folder_sync = sf.FolderSync(src, dst, None, None, journal=sf.SyncJournal(journal_path))
+    folder_sync.planner = lambda: (_ for _ in ()).throw(PermissionError("folder1 cannot be listed"))
+    folder_sync._folder_sync()
+    assert folder_sync.metrics.report()["errors"] == 1
+    assert os.path.exists(journal_path)
+
+
+def test_unreachable_remote_does_not_stop_the_other_destinations(folders):
+    src, dst = folders
+    write_file(os.path.join(src, "a"), "a")
+    folder_sync = sf.FolderSync(src, [dst, "sync://127.0.0.1:1"], None, None)
+    folder_sync.run_pass({"manual"})
+    report = folder_sync.metrics.report()
+    assert report["errors"] == 1 and report["failures"][0]["path"] == "sync://127.0.0.1:1"
+    assert read_tree(dst) == {"a": b"a"}
+
+
+def test_scheduler_keeps_running_after_a_failed_pass():
+    passes = []
+    done = threading.Event()
+
+    def run(reasons):
+        passes.append(reasons)
+        if len(passes) == 1:
+            raise ConnectionRefusedError("unreachable")
+        done.set()
+
+    scheduler = sf.SyncScheduler(run, run_at_start=True)
+    thread = threading.Thread(target=scheduler.run_forever, daemon=True)
+    thread.start()
+    while not passes:
+        threading.Event().wait(0.01)
+    scheduler.trigger("manual")
+    assert done.wait(5)
+    scheduler.stop()
+    thread.join(5)
+    assert passes == [{"start"}, {"manual"}]
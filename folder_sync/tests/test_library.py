@@ -0,0 +1,78 @@
+import asyncio
+import os
+import subprocess
+import sys
+
+import pytest
+
+import sync_folders as sf
+from conftest import write_file, read_tree
+
+
+def test_sync_report(folders):
+    src, dst = folders
+    write_file(os.path.join(src, "a.txt"), "aaa")
+    write_file(os.path.join(src, "sub", "b.txt"), "bb")
+    report = sf.sync(src, dst)
+    assert report.ok and report.failures == [] and report.planned is None
+    assert (report.files_scanned, report.files_copied, report.bytes_copied, report.errors) == (2, 2, 5, 0)
+    assert report.report["files_copied"] == 2 and report.tiers["missing"] == 2
+    assert read_tree(dst) == read_tree(src)
+
+    report = sf.sync(src, dst)
+    assert report.ok and report.files_scanned == 2 and report.files_copied == 0
+
+
+def test_sync_errors_are_reported_not_raised(folders):
+    src, dst = folders
+    write_file(os.path.join(src, "a.txt"), "a")
+    os.symlink(os.path.join(src, "missing"), os.path.join(src, "dangling"))
+    report = sf.sync(src, dst)
+    assert not report.ok and report.errors == 1
+    assert [failure["path"] for failure in report.failures] == [os.path.join(src, "dangling")]
+    assert read_tree(dst) == {"a.txt": b"a"}
+
+
+def test_sync_missing_source_raises(tmp_path):
+    with pytest.raises(FileNotFoundError):
+        sf.sync(str(tmp_path / "missing"), str(tmp_path / "dst"))
+
+
+def test_dry_run_lists_the_plan_without_changes(folders):
+    src, dst = folders
+    write_file(os.path.join(src, "sub", "new.txt"), "new")
+    write_file(os.path.join(dst, "old.txt"), "old")
+    report = sf.sync(src, dst, dry_run=True)
+    assert report.ok and report.files_copied == 0
+    assert sorted(report.planned) == [("create", os.path.join(dst, "sub", "new.txt")),
+                                      ("delete", os.path.join(dst, "old.txt")),
+                                      ("mkdir", os.path.join(dst, "sub"))]
+    assert read_tree(dst) == {"old.txt": b"old"}
+
+
+def test_sync_async(folders):
+    src, dst = folders
+    write_file(os.path.join(src, "a.txt"), "a")
+    report = asyncio.run(sf.sync_async(src, dst, compare="quick"))
+    assert report.ok and report.files_copied == 1
+    assert read_tree(dst) == read_tree(src)
+
+
+def test_import_has_no_side_effect(tmp_path):
+    folder = os.path.dirname(os.path.abspath(sf.__file__))
+    code = ("import sys; sys.path.insert(0, sys.argv[1]); import sync_folders; "
+            "print(' '.join(sorted({'socketserver', 'gzip', 'sqlite3', 'http.server', 'configparser'} & "
+            "set(sys.modules))))")
+    output = subprocess.run([sys.executable, "-c", code, folder], cwd=tmp_path, capture_output=True, text=True,
+                            check=True).stdout
+    assert output.strip() == ""
+    assert os.listdir(tmp_path) == []
+
+
+def test_dry_run_of_a_snapshot(folders, tmp_path):
+    src, _ = folders
+    write_file(os.path.join(src, "a.txt"), "a")
+    store = f"snapshot://{tmp_path / 'store'}"
+    report = sf.sync(src, store, dry_run=True)
+    assert report.planned == [("snapshot", f"{store}/a.txt")]
+    assert not os.path.exists(tmp_path / "store")
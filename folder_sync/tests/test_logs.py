@@ -0,0 +1,77 @@
+import gzip
+import json
+import logging
+import os
+import time
+
+import pytest
+
+import sync_folders as sf
+
+
+def record(message) -> logging.LogRecord:
+    return logging.LogRecord("folder_sync", logging.INFO, __file__, 1, message, None, None)
+
+
+@pytest.fixture
+def restore_logger():
+    yield sf.logger
+    for handler in list(sf.logger.handlers):
+        sf.logger.removeHandler(handler)
+        handler.close()
+    sf.logger.addHandler(logging.NullHandler())
+    sf.logger.setLevel(logging.NOTSET)
+    sf.logger.propagate = True
+
+
+def test_rotation_by_size_keeps_the_compressed_backups(tmp_path, monkeypatch):
+    # One record per write, so the size is checked after every record
+    monkeypatch.setattr(sf.LogWriter, "BATCH_SIZE", 1)
+    filename = str(tmp_path / "sync.log")
+    writer = sf.LogWriter(filename, logging.Formatter("%(message)s"), max_bytes=1, backups=2)
+    for number in range(4):
+        writer.queue.put(record(f"message {number}"))
+    writer.stop()
+    assert sorted(os.listdir(tmp_path)) == ["sync.log", "sync.log.1.gz", "sync.log.2.gz"]
+    with gzip.open(f"{filename}.1.gz", 'rt') as file:
+        assert file.read() == "message 3\n"
+    with gzip.open(f"{filename}.2.gz", 'rt') as file:
+        assert file.read() == "message 2\n"
+    assert os.path.getsize(filename) == 0
+
+
+def test_rotation_by_time(tmp_path, monkeypatch):
+    monkeypatch.setattr(sf.LogWriter, "BATCH_SIZE", 1)
+    filename = str(tmp_path / "sync.log")
+    writer = sf.LogWriter(filename, logging.Formatter("%(message)s"), rotate="hourly")
+    now = time.time()
+    assert now < writer.rotate_at <= now + 3600
+    assert (writer.rotate_at + time.localtime(now).tm_gmtoff) % 3600 == 0
+    # The rotation time passed: rotated after the next write
+    writer.rotate_at = time.time() - 1
+    writer.queue.put(record("rotated"))
+    writer.queue.put(record("after"))
+    writer.stop()
+    with gzip.open(f"{filename}.1.gz", 'rt') as file:
+        assert file.read() == "rotated\n"
+    with open(filename) as file:
+        assert file.read() == "after\n"
+    assert writer.rotate_at > time.time()
+
+
+def test_summary_level_in_json(tmp_path, restore_logger):
+    filename = str(tmp_path / "sync.log")
+    logger = sf.setup_logging(filename, level="summary", log_format="json")
+    logger.log(sf.FILE_EVENT, "Copied a.txt")
+    logger.info("Sync completed")
+    try:
+        raise OSError("disk failed")
+    except OSError:
+        logger.exception("Sync failed")
+    for handler in logger.handlers:
+        handler.close()
+    with open(filename) as file:
+        entries = [json.loads(line) for line in file]
+    assert [(entry["level"], entry["message"]) for entry in entries] == [("I", "Sync completed"),
+                                                                         ("ERROR", "Sync failed")]
+    assert "disk failed" in entries[1]["exception"]
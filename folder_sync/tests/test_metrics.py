@@ -0,0 +1,36 @@
+import json
+import os
+import socket
+import urllib.request
+
+import sync_folders as sf
+from conftest import write_file
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def test_metrics_are_served_on_localhost_by_default(folders, tmp_path):
+    src, dst = folders
+    write_file(os.path.join(src, "a"), "a")
+    exporter = sf.MetricsExporter(str(tmp_path / "report.jsonl"), port=free_port())
+    try:
+        assert exporter.server.server_address[0] == "127.0.0.1"
+        folder_sync = sf.FolderSync(src, dst, None, None, exporter=exporter)
+        folder_sync._folder_sync()
+        with urllib.request.urlopen(f"http://127.0.0.1:{exporter.server.server_address[1]}/metrics") as response:
+            assert "folder_sync_files_copied" in response.read().decode()
+    finally:
+        exporter.close()
+    with open(tmp_path / "report.jsonl") as file:
+        report = json.loads(file.readline())
+    assert report["files_copied"] == 1 and report["errors"] == 0
+
+
+def test_metrics_host_is_an_option():
+    assert sf.ParseArguments(["src", "dst", "--metrics-port", "9730"]).arguments.metrics_host == "127.0.0.1"
+    arguments = sf.ParseArguments(["src", "dst", "--metrics-port", "9730", "--metrics-host", "0.0.0.0"]).arguments
+    assert arguments.metrics_host == "0.0.0.0"
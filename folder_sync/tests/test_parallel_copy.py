@@ -0,0 +1,82 @@
+import errno
+import hashlib
+import os
+
+import pytest
+
+import sync_folders as sf
+from conftest import write_file, read_tree
+
+
+def unsupported(*args):
+    raise OSError(errno.EOPNOTSUPP, "not supported")
+
+
+def assert_copied(src_path, dst_path):
+    with open(src_path, 'rb') as src, open(dst_path, 'rb') as dst:
+        assert src.read() == dst.read()
+    assert os.stat(dst_path).st_mode == os.stat(src_path).st_mode
+    assert not os.path.exists(dst_path + sf.TEMP_SUFFIX)
+
+
+@pytest.fixture
+def copier():
+    # Small ranges, so a small file is copied in many ranges by several threads; no reflink, which copies nothing
+    copier = sf.FileCopier(streams=3, range_size=65536, parallel_size=1)
+    copier._copy_reflink = unsupported
+    return copier
+
+
+@pytest.fixture
+def source(tmp_path):
+    path = str(tmp_path / "src")
+    write_file(path, os.urandom(1000003))
+    os.chmod(path, 0o640)
+    return path
+
+
+def test_parallel_copy_computes_the_digest(copier, source, tmp_path):
+    hasher = hashlib.sha256()
+    assert copier.copy(source, str(tmp_path / "dst"), hasher=hasher) == "parallel"
+    assert_copied(source, str(tmp_path / "dst"))
+    with open(source, 'rb') as file:
+        assert hasher.hexdigest() == hashlib.sha256(file.read()).hexdigest()
+
+
+def test_parallel_copy_to_several_destinations(copier, source, tmp_path):
+    hasher = hashlib.sha256()
+    dst_paths = [str(tmp_path / f"dst{number}") for number in range(3)]
+    assert copier.copy_many(source, dst_paths, hasher=hasher)
+    for dst_path in dst_paths:
+        assert_copied(source, dst_path)
+    with open(source, 'rb') as file:
+        assert hasher.hexdigest() == hashlib.sha256(file.read()).hexdigest()
+
+
+def test_parallel_copy_resumes_from_offset(copier, source, tmp_path):
+    dst_path = str(tmp_path / "dst")
+    with open(source, 'rb') as file:
+        # An interrupted copy, with garbage after its checkpoint
+        write_file(dst_path + sf.TEMP_SUFFIX, file.read(300000) + b"garbage")
+    assert copier.resume(source, dst_path, 300000) == "parallel"
+    assert_copied(source, dst_path)
+
+
+def test_small_files_are_not_copied_in_parallel(source, tmp_path):
+    copier = sf.FileCopier(streams=3, parallel_size=2000000)
+    assert copier.copy(source, str(tmp_path / "dst"), hasher=hashlib.sha256()) != "parallel"
+    assert_copied(source, str(tmp_path / "dst"))
+
+
+def test_sync_indexes_the_digest_of_the_parallel_copy(folders, copier, tmp_path):
+    src, dst = folders
+    content = os.urandom(500000)
+    write_file(os.path.join(src, "big.bin"), content)
+    index = sf.FileIndex(str(tmp_path / "index.db"))
+    report = sf.sync(src, dst, index=index, copier=copier)
+    assert report.ok and read_tree(dst) == {"big.bin": content}
+    # The digest is computed from the copied data: the file is not read again to be hashed
+    assert report.bytes_hashed == 0
+    file1_path = os.path.abspath(os.path.join(src, "big.bin"))
+    assert index.get_digest(file1_path, os.stat(file1_path), "sha256") == hashlib.sha256(content).hexdigest()
+    index.close()
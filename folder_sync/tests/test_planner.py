@@ -0,0 +1,106 @@
+import os
+
+import sync_folders as sf
+from conftest import write_file, read_tree
+
+
+def test_dangling_symlink_is_an_error_of_its_own(folders):
+    src, dst = folders
+    write_file(os.path.join(src, "a", "1"), "1")
+    os.symlink(os.path.join(src, "missing"), os.path.join(src, "a", "2bad"))
+    write_file(os.path.join(src, "a", "3"), "3")
+    write_file(os.path.join(src, "b", "4"), "4")
+    report = sf.sync(src, dst)
+    assert not report.ok and report.errors == 1
+    assert report.failures[0]["path"] == os.path.join(src, "a", "2bad")
+    assert read_tree(dst) == {os.path.join("a", "1"): b"1", os.path.join("a", "3"): b"3",
+                              os.path.join("b", "4"): b"4"}
+
+
+def test_file_removed_while_its_folder_is_planned(folders):
+    src, dst = folders
+    for name in ("a", "vanished", "z"):
+        write_file(os.path.join(src, name), name)
+    write_file(os.path.join(dst, "vanished"), "old")
+    folder_sync = sf.FolderSync(src, dst, None, None)
+    planner = folder_sync.planner
+
+    def planner_removing_a_listed_file():
+        folder_planner = planner()
+        scan = folder_planner.scan
+
+        def scan_then_remove(folder):
+            entries = scan(folder)
+            if folder == os.path.join(src, ""):
+                os.remove(os.path.join(src, "vanished"))
+            return entries
+        folder_planner.scan = scan_then_remove
+        return folder_planner
+
+    folder_sync.planner = planner_removing_a_listed_file
+    folder_sync._folder_sync()
+    report = folder_sync.metrics.report()
+    assert report["errors"] == 1 and report["failures"][0]["path"] == os.path.join(src, "vanished")
+    # The destination file is kept: it is removed by the next sync, which does not list it in folder1
+    assert read_tree(dst) == {"a": b"a", "vanished": b"old", "z": b"z"}
+
+
+def test_folder_which_cannot_be_listed_is_left_as_is(folders):
+    src, dst = folders
+    write_file(os.path.join(src, "a"), "a")
+    write_file(os.path.join(src, "locked", "b"), "b")
+    write_file(os.path.join(dst, "locked", "old"), "old")
+    folder_sync = sf.FolderSync(src, dst, None, None)
+    planner = folder_sync.planner
+
+    def planner_failing_to_list():
+        folder_planner = planner()
+        scan = folder_planner.scan
+
+        def scan_or_fail(folder):
+            if folder == os.path.join(src, "locked"):
+                raise PermissionError("Permission denied")
+            return scan(folder)
+        folder_planner.scan = scan_or_fail
+        return folder_planner
+
+    folder_sync.planner = planner_failing_to_list
+    folder_sync._folder_sync()
+    assert folder_sync.metrics.report()["errors"] == 1
+    assert read_tree(dst) == {"a": b"a", os.path.join("locked", "old"): b"old"}
+
+
+def test_path_sync_does_not_walk_a_destination_link_to_a_folder(folders, tmp_path):
+    src, dst = folders
+    outside = str(tmp_path / "outside")
+    write_file(os.path.join(outside, "victim"), "victim")
+    write_file(os.path.join(src, "x", "a"), "a")
+    os.makedirs(dst)
+    os.symlink(outside, os.path.join(dst, "x"))
+    folder_sync = sf.FolderSync(src, dst, None, None)
+    folder_sync.sync_paths({"x"})
+    assert folder_sync.metrics.report()["errors"] == 0
+    assert read_tree(outside) == {"victim": b"victim"}
+    assert not os.path.islink(os.path.join(dst, "x")) and read_tree(dst) == {os.path.join("x", "a"): b"a"}
+
+
+def test_path_sync_removes_a_destination_link_not_its_target(folders, tmp_path):
+    src, dst = folders
+    outside = str(tmp_path / "outside")
+    write_file(os.path.join(outside, "victim"), "victim")
+    os.makedirs(dst)
+    os.symlink(outside, os.path.join(dst, "x"))
+    folder_sync = sf.FolderSync(src, dst, None, None)
+    folder_sync.sync_paths({"x"})
+    assert not os.path.lexists(os.path.join(dst, "x"))
+    assert read_tree(outside) == {"victim": b"victim"}
+
+
+def test_path_sync_of_a_dangling_symlink_keeps_the_destination(folders):
+    src, dst = folders
+    write_file(os.path.join(dst, "link"), "old")
+    os.symlink(os.path.join(src, "missing"), os.path.join(src, "link"))
+    folder_sync = sf.FolderSync(src, dst, None, None)
+    folder_sync.sync_paths({"link"})
+    assert folder_sync.metrics.report()["errors"] == 1
+    assert read_tree(dst) == {"link": b"old"}
@@ -0,0 +1,50 @@
+import os
+import threading
+
+import sync_folders as sf
+from conftest import write_file, read_tree
+
+
+def record_copies(monkeypatch) -> list:
+    """
+    :return: list of (file name, thread) of the copies, in the order they run
+    """
+    copies = []
+    finish_file = sf.FolderSync.finish_file
+
+    def recorded(self, file1_path, *args):
+        copies.append((os.path.basename(file1_path), threading.current_thread()))
+        finish_file(self, file1_path, *args)
+
+    monkeypatch.setattr(sf.FolderSync, "finish_file", recorded)
+    return copies
+
+
+def test_copies_run_in_the_shared_pool_in_priority_order(folders, monkeypatch):
+    src, dst = folders
+    for number, size in enumerate((5000, 10, 3000, 200)):
+        write_file(os.path.join(src, f"{number}.bin"), os.urandom(size))
+    copies = record_copies(monkeypatch)
+    # One pool thread: the batch which queues the copies runs before them
+    pool = sf.SharedWorkerPool(1)
+    report = sf.sync(src, dst, pool=pool, name="job", workers=1, priority="size")
+    pool.shutdown()
+    assert report.ok and read_tree(dst) == read_tree(src)
+    assert [name for name, _ in copies] == ["1.bin", "3.bin", "2.bin", "0.bin"]
+    assert all(thread in pool.threads for _, thread in copies)
+
+
+def test_full_priority_window_does_not_block_the_shared_pool(folders, monkeypatch):
+    src, dst = folders
+    for number in range(20):
+        write_file(os.path.join(src, f"{number:02}.txt"), f"file {number}")
+    monkeypatch.setattr(sf.FolderSync, "PRIORITY_WINDOW", 2)
+    pool = sf.SharedWorkerPool(1)
+    result = []
+    thread = threading.Thread(target=lambda: result.append(
+        sf.sync(src, dst, pool=pool, name="job", workers=1, priority="mtime", background_size=5)), daemon=True)
+    thread.start()
+    thread.join(10)
+    pool.shutdown()
+    assert result and result[0].ok
+    assert read_tree(dst) == read_tree(src)
@@ -0,0 +1,53 @@
+import threading
+from datetime import datetime, timedelta
+
+import pytest
+
+import sync_folders as sf
+
+
+@pytest.mark.parametrize("expression, after, expected", [
+    ("*/15 * * * *", datetime(2026, 1, 1, 10, 7), datetime(2026, 1, 1, 10, 15)),
+    ("*/15 * * * *", datetime(2026, 1, 1, 10, 45, 30), datetime(2026, 1, 1, 11, 0)),
+    ("30 8-18/2 * * *", datetime(2026, 1, 1, 9, 0), datetime(2026, 1, 1, 10, 30)),
+    ("0 9 * * mon-fri", datetime(2026, 1, 2, 10, 0), datetime(2026, 1, 5, 9, 0)),
+    ("0 0 * * 7", datetime(2026, 1, 1, 0, 0), datetime(2026, 1, 4, 0, 0)),
+    ("0 0 1 jan,jul *", datetime(2026, 2, 1, 0, 0), datetime(2026, 7, 1, 0, 0)),
+    ("0 0 29 2 *", datetime(2026, 3, 1, 0, 0), datetime(2028, 2, 29, 0, 0)),
+    # Both day fields restricted: a day matching any of them
+    ("0 12 13 * fri", datetime(2026, 1, 1, 0, 0), datetime(2026, 1, 2, 12, 0)),
+    ("@daily", datetime(2026, 1, 1, 23, 59), datetime(2026, 1, 2, 0, 0)),
+])
+def test_cron_next_run(expression, after, expected):
+    assert sf.CronSchedule(expression).next_run(after) == expected
+
+
+@pytest.mark.parametrize("expression", ["* * * *", "60 * * * *", "* 24 * * *", "5-1 * * * *", "*/0 * * * *",
+                                        "0 0 30 2 *", "0 0 * foo *"])
+def test_cron_invalid_expressions(expression):
+    with pytest.raises(ValueError):
+        sf.CronSchedule(expression)
+
+
+def test_fixed_rate_does_not_drift():
+    start = datetime(2026, 1, 1, 10, 0)
+    schedule = sf.FixedRateSchedule(timedelta(minutes=10), start)
+    assert schedule.next_run(start - timedelta(hours=1)) == start
+    assert schedule.next_run(datetime(2026, 1, 1, 10, 27, 13)) == datetime(2026, 1, 1, 10, 30)
+
+
+def test_time_schedules_a_daily_sync(folders):
+    src, dst = folders
+    folder_sync = sf.FolderSync(src, dst, None, sf.ParseArguments.check_hour_format("19:45"))
+    schedule = folder_sync.auto_schedule()
+    assert schedule.next_run(datetime(2026, 1, 1, 20, 0)) == datetime(2026, 1, 2, 19, 45)
+    assert schedule.next_run(datetime(2026, 1, 2, 19, 45)) == datetime(2026, 1, 3, 19, 45)
+
+
+def test_sync_passes_do_not_print(folders, capsys):
+    src, dst = folders
+    with open(f"{src}/a.txt", "w") as file:
+        file.write("a")
+    sf.FolderSync(src, dst, None, None).run_pass({"manual"})
+    assert sf.sync(src, dst).ok
+    assert capsys.readouterr().out == ""
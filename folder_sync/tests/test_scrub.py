@@ -0,0 +1,71 @@
+import os
+import threading
+
+import sync_folders as sf
+from conftest import write_file, read_tree
+
+
+def synced_folders(folders, tmp_path, count=20):
+    src, dst = folders
+    for number in range(count):
+        write_file(os.path.join(src, f"f{number}"), f"content {number}")
+    index = sf.FileIndex(str(tmp_path / "index.db"))
+    folder_sync = sf.FolderSync(src, dst, None, None, index, compare="quick")
+    folder_sync._folder_sync()
+    return folder_sync
+
+
+def test_scrub_repairs_corrupted_files_within_the_budget(folders, tmp_path):
+    folder_sync = synced_folders(folders, tmp_path)
+    src, dst = folders
+    corrupted = os.path.join(dst, "f3")
+    stat_result = os.stat(corrupted)
+    write_file(corrupted, "CONTENT 3")
+    os.utime(corrupted, ns=(stat_result.st_atime_ns, stat_result.st_mtime_ns))
+    # 20 small files in a budget of 10 MB per hour (3 KB per second): only their size is charged
+    scrubber = sf.Scrubber(folder_sync, 10 * 1048576, sf.timedelta(days=30))
+    scrubber.scrub_pass()
+    assert scrubber.counters["files_verified"] == 20 and scrubber.counters["repairs"] == 1
+    assert read_tree(dst) == read_tree(src)
+    folder_sync.index.close()
+
+
+class StopAfterFirstRead(sf.TokenBucket):
+    """
+    Bucket without limit which stops the scrub once the first buffer was read.
+    """
+    def __init__(self, scrubber):
+        super().__init__()
+        self.scrubber, self.calls = scrubber, 0
+
+    def acquire(self, amount, stopped=None):
+        self.calls += 1
+        if self.calls > 1:
+            self.scrubber.stopped.set()
+        return 0.0
+
+
+def test_stopped_scrub_does_not_use_a_partial_digest(folders, tmp_path):
+    folder_sync = synced_folders(folders, tmp_path, 1)
+    src, dst = folders
+    write_file(os.path.join(src, "big"), os.urandom(3 * 1048576))
+    folder_sync._folder_sync()
+    scrubber = sf.Scrubber(folder_sync, 1048576, sf.timedelta(days=30))
+    scrubber.bucket = StopAfterFirstRead(scrubber)
+    assert scrubber.read_digest(os.path.join(dst, "big")) is None
+    scrubber.scrub_file("big", os.stat(os.path.join(src, "big")))
+    assert scrubber.counters["repairs"] == 0
+    assert folder_sync.index.get_verified(os.path.abspath(os.path.join(dst, "big")), os.stat(os.path.join(dst, "big")),
+                                          folder_sync.hash_engine.algorithm) is None
+    folder_sync.index.close()
+
+
+def test_stop_interrupts_the_budget_wait_and_joins_the_thread(folders, tmp_path):
+    folder_sync = synced_folders(folders, tmp_path)
+    # 1 byte per hour: the first read waits for hours
+    scrubber = sf.Scrubber(folder_sync, 1, sf.timedelta(days=30))
+    scrubber.start()
+    threading.Event().wait(0.2)
+    scrubber.stop()
+    assert not scrubber.thread.is_alive()
+    folder_sync.index.close()
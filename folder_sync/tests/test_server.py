@@ -0,0 +1,128 @@
+import os
+import socket
+import threading
+
+import pytest
+
+import sync_folders as sf
+from conftest import write_file, read_tree
+
+
+@pytest.fixture
+def server(tmp_path):
+    root = tmp_path / "served"
+    root.mkdir()
+    server = sf.SyncServer(("127.0.0.1", 0), str(root), token="secret")
+    threading.Thread(target=server.serve_forever, args=(0.05,), daemon=True).start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def url(server) -> str:
+    return f"sync://127.0.0.1:{server.server_address[1]}"
+
+
+def test_sync_with_the_token(folders, server, monkeypatch):
+    src, _ = folders
+    write_file(os.path.join(src, "a", "b.txt"), "b")
+    monkeypatch.setenv(sf.SyncServer.TOKEN_VARIABLE, "secret")
+    report = sf.sync(src, url(server))
+    assert report.ok, report.failures
+    assert read_tree(server.root) == {os.path.join("a", "b.txt"): b"b"}
+
+
+@pytest.mark.parametrize("token", [None, "wrong"])
+def test_sync_without_the_token_is_refused(folders, server, monkeypatch, token):
+    src, _ = folders
+    write_file(os.path.join(src, "a.txt"), "a")
+    monkeypatch.delenv(sf.SyncServer.TOKEN_VARIABLE, raising=False)
+    folder_sync = sf.FolderSync(src, url(server), None, None)
+    folder_sync.remotes[0].token = token
+    folder_sync._folder_sync()
+    assert folder_sync.metrics.report()["errors"] == 1
+    assert read_tree(server.root) == {}
+
+
+def test_requests_before_authentication_are_refused(server):
+    with socket.create_connection(server.server_address) as sock:
+        connection = sf.SyncConnection(sock)
+        with pytest.raises(OSError, match="Authentication required"):
+            connection.request({"op": "delete", "path": "x"})
+
+
+def test_symbolic_links_do_not_lead_outside_of_the_root(server, tmp_path, monkeypatch):
+    outside = tmp_path / "outside"
+    write_file(str(outside / "secret.txt"), "secret")
+    os.symlink(str(outside), os.path.join(server.root, "link"))
+    monkeypatch.setenv(sf.SyncServer.TOKEN_VARIABLE, "secret")
+    remote = sf.RemoteDestination(url(server))
+    with socket.create_connection(server.server_address) as sock:
+        connection = remote.connect(sock)
+        with pytest.raises(OSError, match="outside of the served folder"):
+            connection.request({"op": "digests", "algorithm": "sha256"}, b'["link/secret.txt"]')
+        with pytest.raises(OSError, match="outside of the served folder"):
+            connection.request({"op": "delete", "path": "link/secret.txt"})
+        # The link itself is removed, not followed
+        connection.request({"op": "delete", "path": "link"})
+    assert not os.path.lexists(os.path.join(server.root, "link"))
+    assert read_tree(str(outside)) == {"secret.txt": b"secret"}
+
+
+def test_changes_are_sent_in_bounded_windows(folders, server, monkeypatch):
+    src, _ = folders
+    for number in range(30):
+        write_file(os.path.join(src, f"d{number % 4}", f"e{number % 3}", f"f{number}"), str(number))
+    write_file(os.path.join(server.root, "old", "x"), "x")
+    write_file(os.path.join(server.root, "d1"), "file replaced by a folder")
+    monkeypatch.setenv(sf.SyncServer.TOKEN_VARIABLE, "secret")
+    monkeypatch.setattr(sf.RemoteDestination, "CHANGES_WINDOW", 3)
+    monkeypatch.setattr(sf.RemoteDestination, "PAGE_SIZE", 5)
+    windows = []
+    send_changes = sf.RemoteDestination.send_changes
+
+    def record(self, connection, folder_sync, removed, mkdirs, changed, dry_run=False):
+        windows.append(len(removed) + len(mkdirs) + len(changed))
+        send_changes(self, connection, folder_sync, removed, mkdirs, changed, dry_run)
+
+    monkeypatch.setattr(sf.RemoteDestination, "send_changes", record)
+    report = sf.sync(src, url(server), priority="size")
+    assert report.ok, report.failures
+    assert read_tree(server.root) == read_tree(src)
+    assert max(windows) == 3 and len(windows) > 10
+
+
+@pytest.mark.parametrize("frame", [
+    sf.SyncConnection.FRAME.pack(2 ** 31, 0, 0),
+    sf.SyncConnection.FRAME.pack(2, 2 ** 31, 0),
+    # Requests accepted before authentication have no payload
+    sf.SyncConnection.FRAME.pack(2, 10, 0) + b"{}" + b"0" * 10,
+])
+def test_oversized_message_closes_the_connection(server, frame):
+    with socket.create_connection(server.server_address) as sock:
+        sock.settimeout(5)
+        sock.sendall(frame)
+        assert sock.recv(1) == b""
+
+
+def test_decompressed_payload_is_bounded(server, monkeypatch):
+    monkeypatch.setattr(sf.SyncConnection, "MAX_PAYLOAD", 65536)
+    monkeypatch.setenv(sf.SyncServer.TOKEN_VARIABLE, "secret")
+    remote = sf.RemoteDestination(url(server), compression="zlib")
+    with socket.create_connection(server.server_address) as sock:
+        connection = remote.connect(sock)
+        paths = b"[" + b" " * 1048576 + b"]"
+        with pytest.raises(ConnectionError):
+            connection.request({"op": "digests", "algorithm": "sha256"}, paths)
+
+
+def test_big_file_is_patched_with_a_delta(folders, server, monkeypatch):
+    src, _ = folders
+    content = os.urandom(400000)
+    write_file(os.path.join(src, "big"), content[:200000] + b"changed" + content[200007:])
+    write_file(os.path.join(server.root, "big"), content)
+    monkeypatch.setenv(sf.SyncServer.TOKEN_VARIABLE, "secret")
+    report = sf.sync(src, url(server), delta=sf.DeltaTransfer(100000))
+    assert report.ok, report.failures
+    assert read_tree(server.root) == read_tree(src)
+    assert report.bytes_copied < len(content) // 10
@@ -0,0 +1,77 @@
+import os
+import threading
+
+import pytest
+
+import sync_folders as sf
+from conftest import write_file, read_tree
+
+
+@pytest.fixture
+def store(tmp_path):
+    return sf.SnapshotStore(str(tmp_path / "store"), fsync=False)
+
+
+def file_chunks(store, snapshot_id, relpath) -> list:
+    return next(entry["chunks"] for entry in store.read_manifest(snapshot_id) if entry["path"] == relpath)
+
+
+def test_snapshots_restore_and_reuse_chunks(folders, store, tmp_path):
+    src, _ = folders
+    big = os.urandom(4 * 1048576)
+    write_file(os.path.join(src, "big.bin"), big)
+    write_file(os.path.join(src, "docs", "a.txt"), "a")
+    os.utime(os.path.join(src, "docs", "a.txt"), ns=(10 ** 18, 10 ** 18))
+    assert sf.sync(src, f"snapshot://{store.path}").ok
+    first_tree = read_tree(src)
+
+    # An insertion in the middle of the big file only changes the chunks around it
+    write_file(os.path.join(src, "big.bin"), big[:2000000] + b"inserted" + big[2000000:])
+    write_file(os.path.join(src, "docs", "b.txt"), "b")
+    report = sf.sync(src, f"snapshot://{store.path}")
+    assert report.ok and report.files_copied == 2
+    first, second = store.snapshot_ids()
+    assert store.summary(second)["bytes_written"] < 2 * store.MAX_CHUNK
+    first_chunks, second_chunks = file_chunks(store, first, "big.bin"), file_chunks(store, second, "big.bin")
+    assert len(set(first_chunks) & set(second_chunks)) >= len(first_chunks) - 2
+    assert file_chunks(store, first, "docs/a.txt") == file_chunks(store, second, "docs/a.txt")
+
+    assert store.restore(first, str(tmp_path / "first")) == 2
+    assert read_tree(tmp_path / "first") == first_tree
+    assert os.stat(tmp_path / "first" / "docs" / "a.txt").st_mtime_ns == 10 ** 18
+    assert store.restore(second, str(tmp_path / "second")) == 3
+    assert read_tree(tmp_path / "second") == read_tree(src)
+    assert store.restore(second, str(tmp_path / "docs"), "docs") == 2
+    assert sorted(read_tree(tmp_path / "docs")) == [os.path.join("docs", "a.txt"), os.path.join("docs", "b.txt")]
+
+
+def test_corrupted_chunk_is_not_restored(folders, store, tmp_path):
+    src, _ = folders
+    write_file(os.path.join(src, "a.txt"), "content")
+    assert sf.sync(src, f"snapshot://{store.path}").ok
+    snapshot_id = store.snapshot_ids()[0]
+    chunk_path = store.chunk_path(file_chunks(store, snapshot_id, "a.txt")[0])
+    with open(chunk_path, 'r+b') as file:
+        file.seek(1)
+        file.write(b"X")
+    with pytest.raises(ValueError):
+        store.restore(snapshot_id, str(tmp_path / "restored"))
+
+
+def test_files_are_chunked_by_the_shared_pool(folders, store, monkeypatch):
+    src, _ = folders
+    for number in range(5):
+        write_file(os.path.join(src, f"{number}.txt"), f"file {number}")
+    threads = []
+    store_file = sf.SnapshotStore.store_file
+
+    def recorded(self, *args):
+        threads.append(threading.current_thread())
+        return store_file(self, *args)
+
+    monkeypatch.setattr(sf.SnapshotStore, "store_file", recorded)
+    pool = sf.SharedWorkerPool(2)
+    report = sf.sync(src, f"snapshot://{store.path}", pool=pool, name="job")
+    pool.shutdown()
+    assert report.ok and len(threads) == 5
+    assert all(thread in pool.threads for thread in threads)
@@ -0,0 +1,30 @@
+import os
+import time
+
+import sync_folders as sf
+from conftest import write_file, read_tree
+
+
+def test_small_files_are_charged_their_size(folders, tmp_path):
+    src, dst = folders
+    for number in range(20):
+        write_file(os.path.join(src, f"f{number}"), "data")
+    throttle = sf.IOThrottle(read_limit=4 * 1048576)
+    start = time.monotonic()
+    report = sf.sync(src, [dst, str(tmp_path / "dst2")], throttle=throttle,
+                     copier=sf.FileCopier(throttle, fsync=False))
+    assert report.ok and report.files_copied == 40
+    # A whole buffer charged per read would take about 10 seconds
+    assert time.monotonic() - start < 2
+    assert read_tree(dst) == read_tree(src)
+
+
+def test_buffered_copy_charges_the_bytes_left(tmp_path):
+    src, dst = str(tmp_path / "src"), str(tmp_path / "dst")
+    write_file(src, "x" * 1000)
+    charged = []
+    throttle = sf.IOThrottle(read_limit=1048576)
+    throttle.acquire = lambda read=0, write=0, ops=0: charged.append(read)
+    with open(src, 'rb') as source, open(dst, 'wb') as target:
+        sf.FileCopier(throttle)._copy_buffered(source, target, 1000)
+    assert sum(charged) == 1000
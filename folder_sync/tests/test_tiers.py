@@ -0,0 +1,56 @@
+import os
+
+import sync_folders as sf
+from conftest import write_file, read_tree
+
+
+def write_pair(src, dst, name, src_content, dst_content, same_mtime):
+    write_file(os.path.join(src, name), src_content)
+    write_file(os.path.join(dst, name), dst_content)
+    mtime_ns = 1_600_000_000 * 10 ** 9
+    os.utime(os.path.join(src, name), ns=(mtime_ns, mtime_ns))
+    os.utime(os.path.join(dst, name), ns=(mtime_ns, mtime_ns if same_mtime else mtime_ns + 10 ** 9))
+
+
+def test_size_tier_decides_without_reading(folders):
+    src, dst = folders
+    write_pair(src, dst, "a", "longer", "short", same_mtime=False)
+    report = sf.sync(src, dst, compare="quick")
+    assert report.tiers == {"size": 1} and report.bytes_hashed == 0
+    assert read_tree(dst) == {"a": b"longer"}
+
+
+def test_quick_trusts_an_equal_mtime(folders):
+    src, dst = folders
+    write_pair(src, dst, "a", "new", "old", same_mtime=True)
+    report = sf.sync(src, dst, compare="quick")
+    assert report.tiers == {"mtime": 1} and report.report["skipped"] == {"mtime": 1}
+    assert report.bytes_hashed == 0 and report.files_copied == 0
+
+
+def test_hash_does_not_trust_the_mtime(folders):
+    src, dst = folders
+    write_pair(src, dst, "same", "content", "content", same_mtime=True)
+    write_pair(src, dst, "changed", "new", "old", same_mtime=True)
+    report = sf.sync(src, dst, compare="hash")
+    assert report.tiers == {"hash": 2} and report.report["skipped"] == {"hash": 1}
+    assert report.files_copied == 1 and read_tree(dst)["changed"] == b"new"
+
+
+def test_sample_detects_a_change_without_a_full_hash(folders):
+    src, dst = folders
+    size = 4 * sf.FolderSync.SAMPLE_SIZE
+    write_pair(src, dst, "big", b"x" + b"\0" * (size - 1), b"\0" * size, same_mtime=False)
+    report = sf.sync(src, dst, compare="sample")
+    assert report.tiers == {"sample": 1} and report.files_copied == 1
+    assert report.bytes_hashed == 2 * 3 * sf.FolderSync.SAMPLE_SIZE
+
+
+def test_equal_samples_are_confirmed_by_a_full_hash(folders):
+    src, dst = folders
+    size = 4 * sf.FolderSync.SAMPLE_SIZE
+    # The change is outside of the sampled head, middle and tail
+    write_pair(src, dst, "big", b"\0" * 70000 + b"x" + b"\0" * (size - 70001), b"\0" * size, same_mtime=False)
+    report = sf.sync(src, dst, compare="sample")
+    assert report.tiers == {"hash": 1} and report.files_copied == 1
+    assert read_tree(dst) == read_tree(src)
@@ -0,0 +1,62 @@
+import os
+import sys
+import time
+
+import pytest
+
+import sync_folders as sf
+from conftest import write_file, read_tree
+
+pytestmark = pytest.mark.skipif(not sys.platform.startswith("linux"), reason="inotify is Linux only")
+
+
+def wait_for(condition, timeout=5):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if condition():
+            return True
+        time.sleep(0.02)
+    return False
+
+
+def test_watcher_reports_changes_in_new_folders(tmp_path):
+    watcher = sf.InotifyWatcher(str(tmp_path))
+    try:
+        os.mkdir(tmp_path / "new")
+        assert watcher.read_events(1) == {"new"}
+        # The new folder got its own watch
+        write_file(str(tmp_path / "new" / "a"), "a")
+        os.remove(tmp_path / "new" / "a")
+        assert watcher.read_events(1) == {os.path.join("new", "a")}
+        assert watcher.read_events(0.05) == set()
+    finally:
+        watcher.close()
+
+
+def test_sync_paths_syncs_only_the_given_paths(folders):
+    src, dst = folders
+    write_file(os.path.join(src, "a"), "a")
+    write_file(os.path.join(src, "sub", "b"), "b")
+    write_file(os.path.join(src, "c"), "c")
+    write_file(os.path.join(dst, "removed"), "removed")
+    folder_sync = sf.FolderSync(src, dst, None, None)
+    folder_sync.sync_paths({"a", "sub", os.path.join("sub", "b"), "removed"})
+    assert read_tree(dst) == {"a": b"a", os.path.join("sub", "b"): b"b"}
+    assert folder_sync.metrics.report()["mode"] == "paths"
+
+
+def test_watch_mode_syncs_a_change_without_a_full_sync(folders):
+    src, dst = folders
+    write_file(os.path.join(src, "a"), "a")
+    folder_sync = sf.FolderSync(src, dst, None, None, watch=True)
+    folder_sync.DEBOUNCE = 0.05
+    passes = []
+    folder_sync.start_auto_sync(on_pass=lambda: passes.append(1))
+    try:
+        assert wait_for(lambda: passes and read_tree(dst) == {"a": b"a"})
+        write_file(os.path.join(src, "sub", "b"), "b")
+        assert wait_for(lambda: read_tree(dst) == {"a": b"a", os.path.join("sub", "b"): b"b"})
+        # Only the start sync was a full sync
+        assert passes == [1]
+    finally:
+        folder_sync.scheduler.stop()
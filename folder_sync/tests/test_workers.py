@@ -0,0 +1,62 @@
+import os
+import threading
+import time
+
+import pytest
+
+import sync_folders as sf
+from conftest import write_file, read_tree
+
+
+class ConcurrencyProbe:
+    """
+    Wraps a function, recording how many calls run at the same time.
+    """
+    def __init__(self, function, delay=0.02):
+        self.function, self.delay = function, delay
+        self.lock = threading.Lock()
+        self.running = self.peak = 0
+
+    def __call__(self, *args):
+        with self.lock:
+            self.running += 1
+            self.peak = max(self.peak, self.running)
+        try:
+            time.sleep(self.delay)
+            return self.function(*args)
+        finally:
+            with self.lock:
+                self.running -= 1
+
+
+@pytest.mark.parametrize("workers", [1, 3])
+def test_sync_runs_the_given_number_of_workers(folders, workers):
+    src, dst = folders
+    for i in range(40):
+        write_file(os.path.join(src, f"{i:02}"), str(i))
+    folder_sync = sf.FolderSync(src, dst, None, None, workers=workers)
+    folder_sync.BATCH_SIZE = 2
+    probe = folder_sync.apply_actions = ConcurrencyProbe(folder_sync.apply_actions)
+    folder_sync._folder_sync()
+    assert probe.peak == workers
+    assert len(read_tree(dst)) == 40
+
+
+def test_executor_bounds_the_queued_tasks():
+    finished = []
+    probe = ConcurrencyProbe(lambda: finished.append(1), delay=0.01)
+    queued = []
+    with sf.BoundedExecutor(2, 5) as executor:
+        for submitted in range(1, 31):
+            executor.submit(probe)
+            queued.append(submitted - len(finished))
+    # submit() blocked while 5 tasks were waiting or running
+    assert max(queued) == 5 and probe.peak == 2
+    assert executor.errors == []
+
+
+def test_task_errors_are_collected():
+    with sf.BoundedExecutor(2, 4) as executor:
+        executor.submit(lambda: 1 / 0)
+        executor.submit(lambda: None)
+    assert len(executor.errors) == 1 and isinstance(executor.errors[0], ZeroDivisionError)